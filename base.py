@@ -1,15 +1,11 @@
-import configparser
-import os
 import subprocess
 import shlex
 import logging
 import threading
 import signal
-import re
 import time
 import mysql.connector
-import psutil
-from scapy.all import Dot11, Dot11FCS
+import settings
 
 
 def setup_logger():
@@ -17,8 +13,8 @@ def setup_logger():
     result.setLevel(logging.DEBUG)
     fmt = logging.Formatter('%(asctime)s - %(levelname)s - %(thread_name)s - %(message)s',
                             datefmt='%Y-%m-%d %H:%M:%S')
-    level = CFG['DEFAULT']['log_level']
-    f_handler = logging.FileHandler(CFG['DEFAULT']['log_path'])
+    level = settings.get().default.log_level
+    f_handler = logging.FileHandler(settings.get().default.log_path)
     f_handler.setLevel(level)
     f_handler.setFormatter(fmt)
     console = logging.StreamHandler()
@@ -26,6 +22,11 @@ def setup_logger():
     console.setFormatter(fmt)
     result.addHandler(f_handler)
     result.addHandler(console)
+
+    def apply_level(new, old):
+        f_handler.setLevel(new.default.log_level)
+        console.setLevel(new.default.log_level)
+    settings.subscribe(apply_level)
     return result
 
 class Dot11HunterUtils:
@@ -35,34 +36,7 @@ class Dot11HunterUtils:
     @staticmethod
     def get_frame_types():
         # Parse frame types in config
-        result = []
-        s = CFG['DOT11']['frame_types']
-        for t in s.split(', '):
-            result.append(t)
-        return result
-
-    @staticmethod
-    def get_mem_used_by_dot11hunter():
-        result = None
-        cmd = 'ps -aux | grep dot11hunter\.py | grep -v grep'
-        outs = subprocess.check_output(cmd, shell=True)
-        outs = outs.decode('utf-8')
-        if not outs:
-            return result
-        result = re.findall(r'^(?:[\w.]+?\s+?){3}([\w.]+?)\s+?', outs)[0]
-        return float(result)
-
-    @staticmethod
-    def get_sys_status():
-        result = (None, None, None)
-        try:
-            cpu_usage = psutil.cpu_percent()
-            mem_usage = psutil.virtual_memory().percent
-            temperature = psutil.sensors_temperatures()['cpu-thermal'][0].current
-            result = (cpu_usage, mem_usage, temperature)
-        except Exception as e:
-            logger.critical((str(e)), extra='Dot11HunterUtils')
-        return result
+        return list(settings.get().dot11.frame_types)
 
     @staticmethod
     def run_cmd(cmd, timeout=15, shell=False):
@@ -78,11 +52,12 @@ class Dot11HunterUtils:
 
     @staticmethod
     def connect_db():
+        mysql_cfg = settings.get().mysql
         config = {
-            'user': CFG['MYSQL']['user'],
-            'host': CFG['MYSQL']['host'],
-            'password': CFG['MYSQL']['password'],
-            'database': CFG['MYSQL']['database'],
+            'user': mysql_cfg.user,
+            'host': mysql_cfg.host,
+            'password': mysql_cfg.password,
+            'database': mysql_cfg.database,
             'connection_timeout': 180,
             'use_pure': True
         }
@@ -91,18 +66,16 @@ class Dot11HunterUtils:
         return db_conn, db_cursor
 
 
-CFG = configparser.ConfigParser(
-    interpolation=configparser.ExtendedInterpolation())
-CFG.read(os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                      'config.ini'))
 logger = setup_logger()
 
 
 class GeoFrame:
-    # Frame with Geo
-    def __init__(self, frame, geo, timestamp):
+    # Frame and its capture time in epoch seconds, the position is looked up
+    # by that time when a GEO row is written, see location.py
+    __slots__ = ('frame', 'timestamp')
+
+    def __init__(self, frame, timestamp):
         self.frame = frame
-        self.geo = geo
         self.timestamp = timestamp
 
 
@@ -131,16 +104,33 @@ class FrameSubType:
     DATA = (NULL_FUNC, QOS_DATA, QOS_NULL_FUNC)
 
     @staticmethod
-    def get_type_subtype(frame):
-        layer = None
-        if Dot11 in frame.layers():
-            layer = Dot11
-        elif Dot11FCS in frame.layers():
-            layer = Dot11FCS
-        frame_type = frame[layer].type
-        frame_subtype = frame[layer].subtype
-        type_subtype = frame_type * 16 + frame_subtype
-        return type_subtype
+    def get_type_subtype(buf):
+        # Read the frame control field straight from radiotap+802.11 bytes.
+        # Returns None for anything not 802.11.
+        if len(buf) < 4 or buf[0] != 0:
+            return None
+        rt_len = buf[2] | buf[3] << 8
+        if len(buf) <= rt_len:
+            return None
+        fc = buf[rt_len]
+        return (fc >> 2 & 0x03) * 16 + (fc >> 4)
+
+    @staticmethod
+    def get_frame_type(sts):
+        # Frame type in config (handler) of a type/sub_type, None if
+        # Dot11Hunter does not handle it. Beacon frames are handled
+        # independently because they are too frequent.
+        if sts == FrameSubType.BEACON:
+            return 'beacon'
+        if sts == FrameSubType.PROBE_REQ:
+            return 'probe_req'
+        if sts in FrameSubType.MGMT:
+            return 'mgmt'
+        if sts in FrameSubType.CTRL:
+            return 'ctrl'
+        if sts in FrameSubType.DATA:
+            return 'data'
+        return None
 
 
 class Dot11HunterBase(threading.Thread):
@@ -152,7 +142,8 @@ class Dot11HunterBase(threading.Thread):
         self.log_extra = None
 
     def setup_signal(self):
-        signal.signal(signal.SIGHUP, self.terminate)
+        # SIGHUP reloads config.ini, see settings.py
+        settings.install_sighup()
         signal.signal(signal.SIGTERM, self.terminate)
         signal.signal(signal.SIGINT, self.terminate)
 
@@ -174,10 +165,12 @@ class LogTimer(threading.Thread):
     def __init__(self, log_entity):
         super().__init__()
         self.log_entity = log_entity
+        # must not keep a process alive once its work is done (pcap ingest)
+        self.daemon = True
 
     def run(self):
         while True:
-            time.sleep(CFG['DEFAULT'].getfloat('log_interval'))
+            time.sleep(settings.get().default.log_interval)
             self.log_entity.dump_log()
 
 
@@ -0,0 +1,178 @@
+import argparse
+import bisect
+import json
+import random
+import time
+import settings
+from channel import ChannelScheduler, MacNovelty, scheduler_params
+
+# Offline comparison of channel hopping policies for device discovery. A
+# trace lists the frames a monitor would see on each channel, the simulator
+# hops over it with ChannelScheduler and reports how many devices each
+# policy found and how long after their first frame. Run from the
+# repository root:
+#   python3 -m benchmark.channels --duration 3600
+#   python3 -m benchmark.channels --trace trace.csv -o channels.json
+# A trace is CSV lines of seconds,channel,mac, --write-trace saves the
+# synthetic one.
+
+CHANNELS = tuple(range(1, 14))
+# Synthetic traffic: new devices per second and frames per second per
+# device on each channel, the rest of the channels are quiet
+BUSY = {1: (0.05, 2), 6: (0.1, 2), 11: (0.05, 2), 3: (0.005, 1)}
+QUIET = (0.0005, 0.5)
+
+
+class Trace:
+    def __init__(self, frames):
+        # frames: (seconds, channel, mac), indexed by channel in time order
+        self.times = dict()
+        self.macs = dict()
+        self.first_seen = dict()    # mac -> first frame on any channel
+        for ts, channel, mac in sorted(frames):
+            self.times.setdefault(channel, []).append(ts)
+            self.macs.setdefault(channel, []).append(mac)
+            self.first_seen.setdefault(mac, ts)
+        self.duration = max((t[-1] for t in self.times.values()), default=0)
+
+    def frames(self, channel, start, end):
+        # macs of the frames on channel in [start, end)
+        if channel not in self.times:
+            return []
+        times = self.times[channel]
+        i = bisect.bisect_left(times, start)
+        j = bisect.bisect_left(times, end)
+        return self.macs[channel][i:j]
+
+    @classmethod
+    def load(cls, path):
+        frames = []
+        with open(path) as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                ts, channel, mac = line.strip().split(',')
+                frames.append((float(ts), int(channel), mac))
+        return cls(frames)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            for channel, times in sorted(self.times.items()):
+                for ts, mac in zip(times, self.macs[channel]):
+                    f.write('{:.3f},{},{}\n'.format(ts, channel, mac))
+
+
+def synthetic_trace(duration, seed=0, stay=300):
+    # Devices arrive on a channel, stay about stay seconds and send frames
+    # at a steady rate meanwhile
+    rnd = random.Random(seed)
+    frames = []
+    n = 0
+    for channel in CHANNELS:
+        arrivals, rate = BUSY.get(channel, QUIET)
+        t = rnd.expovariate(arrivals)
+        while t < duration:
+            mac = '02:00:00:{:02x}:{:02x}:{:02x}'.format(
+                n >> 16 & 0xff, n >> 8 & 0xff, n & 0xff)
+            n += 1
+            end = min(duration, t + rnd.expovariate(1 / stay))
+            ts = t + rnd.expovariate(rate)
+            while ts < end:
+                frames.append((ts, channel, mac))
+                ts += rnd.expovariate(rate)
+            t += rnd.expovariate(arrivals)
+    return Trace(frames)
+
+
+def simulate(trace, params, hop_time, novelty_window):
+    # Hop over the trace as ChannelSwitch would, hop_time seconds lost per
+    # channel switch. Returns the discovery time of each mac found.
+    channels = sorted(set(CHANNELS) | set(trace.times))
+    scheduler = ChannelScheduler(channels, **params)
+    novelty = MacNovelty()
+    discovered = dict()
+    t = 0
+    rotated = 0
+    hops = 0
+    while t < trace.duration:
+        channel, dwell = scheduler.next()
+        start = t + hop_time
+        end = start + dwell
+        new_macs = novelty.new
+        macs = trace.frames(channel, start, end)
+        for i, mac in enumerate(macs):
+            novelty.see(mac)
+            discovered.setdefault(mac, start + dwell * i / len(macs))
+        scheduler.update(channel, dwell, len(macs), novelty.new - new_macs)
+        t = end
+        hops += 1
+        if t - rotated >= novelty_window:
+            novelty.rotate()
+            rotated = t
+    return discovered, hops
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def report(trace, discovered, hops):
+    delays = [ts - trace.first_seen[mac] for mac, ts in discovered.items()]
+    devices = len(trace.first_seen)
+    return {
+        'devices': devices,
+        'discovered': len(discovered),
+        'discovery_rate': len(discovered) / devices if devices else 0,
+        'hops': hops,
+        'delay_seconds': {'p50': percentile(delays, 0.5),
+                          'p90': percentile(delays, 0.9),
+                          'max': max(delays, default=None)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='compare channel hopping policies on a traffic trace')
+    parser.add_argument('--trace', help='CSV trace, synthetic by default')
+    parser.add_argument('--write-trace', metavar='PATH',
+                        help='save the trace used')
+    parser.add_argument('--duration', type=float, default=3600,
+                        help='seconds of synthetic trace')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--policies', default='fixed,adaptive')
+    parser.add_argument('--hop-time', type=float, default=0.1,
+                        help='seconds lost per channel switch')
+    parser.add_argument('-o', dest='output', help='write results as JSON')
+    args = parser.parse_args()
+    if args.trace:
+        trace = Trace.load(args.trace)
+    else:
+        trace = synthetic_trace(args.duration, args.seed)
+    if args.write_trace:
+        trace.save(args.write_trace)
+    cfg = settings.get()
+    result = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'trace': args.trace or 'synthetic', 'duration': trace.duration,
+              'policies': dict()}
+    for policy in args.policies.split(','):
+        params = dict(scheduler_params(cfg), policy=policy)
+        discovered, hops = simulate(trace, params, args.hop_time,
+                                    cfg.channel.novelty_window)
+        result['policies'][policy] = dict(report(trace, discovered, hops),
+                                          params=params)
+        r = result['policies'][policy]
+        print('{:10} {}/{} devices ({:.1%}), {} hops, delay p50 {:.1f} s, '
+              'p90 {:.1f} s'.format(policy, r['discovered'], r['devices'],
+                                    r['discovery_rate'], hops,
+                                    r['delay_seconds']['p50'] or 0,
+                                    r['delay_seconds']['p90'] or 0))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
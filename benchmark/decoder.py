@@ -0,0 +1,163 @@
+import argparse
+import time
+import dot11
+from base import FrameSubType
+from benchmark.frames import (AP_BASE, BROADCAST, CTRL_HEADER, STA_BASE,
+                              FrameGenerator, element, fc, mac)
+from capture import EMPTY_RADIOTAP, PcapCapture
+
+# Compare dot11.decode with scapy's dissection on a recorded pcap and time
+# both. Run from the repository root:
+#   python3 -m benchmark.decoder capture.pcap
+# --check asserts the decoder's fields on hand-built frames instead, and
+# parity with scapy on synthetic frames when scapy is installed:
+#   python3 -m benchmark.decoder --check
+
+
+def load_frames(path):
+    frames = []
+    PcapCapture(path).run(lambda buf, ts: frames.append(bytes(buf)))
+    return frames
+
+
+def scapy_fields(buf):
+    from scapy.all import RadioTap, Dot11, Dot11FCS, Dot11Elt
+    pkt = RadioTap(buf)
+    if Dot11FCS in pkt:
+        layer = pkt[Dot11FCS]
+    elif Dot11 in pkt:
+        layer = pkt[Dot11]
+    else:
+        return None
+    ssid = None
+    elt = layer.getlayer(Dot11Elt)
+    while elt is not None:
+        if elt.ID == dot11.ELT_SSID:
+            ssid = elt.info.decode('utf8', 'replace')
+            break
+        elt = elt.payload.getlayer(Dot11Elt)
+    type_subtype = layer.type * 16 + layer.subtype
+    seq = None if layer.type == dot11.CTRL else layer.SC >> 4
+    return (type_subtype, mac_int(layer.addr1), mac_int(layer.addr2), seq,
+            ssid)
+
+
+def mac_int(addr):
+    if addr is None:
+        return None
+    return int(addr.replace(':', ''), 16)
+
+
+def decoder_fields(buf):
+    frame = dot11.decode(buf)
+    if frame is None:
+        return None
+    return (frame.type_subtype, frame.addr1, frame.addr2, frame.seq,
+            frame.ssid)
+
+
+def parity(frames, verbose):
+    # (frames compared, mismatches)
+    compared = 0
+    mismatches = 0
+    for i, buf in enumerate(frames):
+        try:
+            expected = scapy_fields(buf)
+        except Exception:
+            # scapy cannot dissect it either, nothing to compare
+            continue
+        compared += 1
+        actual = decoder_fields(buf)
+        if expected is not None and actual != expected:
+            mismatches += 1
+            if verbose:
+                print('frame {}: scapy {} decoder {}'.format(
+                    i, expected, actual))
+    return compared, mismatches
+
+
+def check():
+    # Raises AssertionError on the first field decoded wrong
+    gen = FrameGenerator(seed=0)
+    sta = STA_BASE + 1
+    ap = AP_BASE + 2
+    bcast = int.from_bytes(BROADCAST, 'big')
+    cases = (
+        # type/sub_type, addr1, addr2, body after the header, ssid
+        (FrameSubType.BEACON, bcast, ap,
+         bytes(12) + element(dot11.ELT_SSID, b'office'), 'office'),
+        (FrameSubType.BEACON, bcast, ap,
+         bytes(12) + element(dot11.ELT_SSID, b'caf\xe9'), 'caf\ufffd'),
+        (FrameSubType.PROBE_REQ, bcast, sta, element(dot11.ELT_SSID, b''),
+         ''),
+        (FrameSubType.PROBE_RESP, sta, ap,
+         bytes(12) + element(dot11.ELT_SSID, b'office'), 'office'),
+        (FrameSubType.ASSOCIATION, ap, sta,
+         bytes(4) + element(dot11.ELT_SSID, b'\xff\xfe'), '\ufffd\ufffd'),
+        (FrameSubType.BEACON, bcast, ap,
+         bytes(12) + element(dot11.ELT_SSID, bytes(33)), None),
+        (FrameSubType.ACTION, ap, sta, b'\x04\x00', None),
+        (FrameSubType.QOS_DATA, ap, sta, bytes(2) + bytes(40), None),
+    )
+    for sts, addr1, addr2, body, ssid in cases:
+        buf = EMPTY_RADIOTAP + gen.header(sts, mac(addr1), mac(addr2),
+                                          mac(ap)) + body
+        fields = decoder_fields(buf)
+        expected = (sts, addr1, addr2, gen.seq, ssid)
+        assert fields == expected, '{:#04x}: {} != {}'.format(
+            sts, fields, expected)
+    rts = EMPTY_RADIOTAP + CTRL_HEADER.pack(
+        fc(FrameSubType.RTS), 0, 0, mac(ap), mac(sta)) + bytes(4)
+    fields = decoder_fields(rts)
+    assert fields == (FrameSubType.RTS, ap, sta, None, None), fields
+    assert decoder_fields(rts[:len(EMPTY_RADIOTAP) + 6]) is None
+    assert decoder_fields(rts[:len(EMPTY_RADIOTAP) + 10]) is None
+    assert decoder_fields(b'\x00\x00\x08') is None
+    try:
+        import scapy.all  # noqa: F401
+    except ImportError:
+        print('decoder checks passed, scapy not installed for parity')
+        return
+    frames = gen.frames(2000)
+    compared, mismatches = parity(frames, verbose=True)
+    assert compared, 'scapy dissected none of the frames'
+    assert mismatches == 0, '{} mismatches with scapy'.format(mismatches)
+    print('decoder checks passed, parity with scapy on {} frames'.format(
+        compared))
+
+
+def throughput(frames, fields):
+    start = time.perf_counter()
+    for buf in frames:
+        try:
+            fields(buf)
+        except Exception:
+            pass
+    return len(frames) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='dot11 decoder parity and throughput against scapy')
+    parser.add_argument('pcap', nargs='*', help='radiotap pcap files')
+    parser.add_argument('-v', dest='verbose', action='store_true',
+                        help='print every mismatching frame')
+    parser.add_argument('--check', action='store_true',
+                        help='assert decoded fields of built frames')
+    args = parser.parse_args()
+    if args.check:
+        check()
+    for path in args.pcap:
+        frames = load_frames(path)
+        compared, mismatches = parity(frames, args.verbose)
+        print('{}: {} frames, {} compared, {} mismatches'.format(
+            path, len(frames), compared, mismatches))
+        scapy_fps = throughput(frames, scapy_fields)
+        decoder_fps = throughput(frames, decoder_fields)
+        print('  scapy: {:.0f} frames/s, decoder: {:.0f} frames/s '
+              '({:.1f}x)'.format(scapy_fps, decoder_fps,
+                                 decoder_fps / scapy_fps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import random
+import struct
+import time
+from base import FrameSubType
+from capture import EMPTY_RADIOTAP, DLT_IEEE802_11_RADIO
+
+# Synthetic radiotap+802.11 frames with a controlled mix of frame types,
+# device population and SSID cardinality. Also writes them as a pcap for
+# replay or -r ingestion. Run from the repository root:
+#   python3 -m benchmark.frames out.pcap -n 100000
+
+DEFAULT_MIX = 'beacon=30,probe_req=10,mgmt=10,ctrl=20,data=30'
+HEADER = struct.Struct('<BBH6s6s6sH')
+CTRL_HEADER = struct.Struct('<BBH6s6s')
+# Subtypes generated for each frame type
+SUBTYPES = {
+    'mgmt': (FrameSubType.PROBE_RESP, FrameSubType.ACTION,
+             FrameSubType.ASSOCIATION),
+    'ctrl': FrameSubType.CTRL,
+    'data': FrameSubType.DATA,
+}
+BROADCAST = b'\xff' * 6
+# Locally administered address blocks of stations and access points
+STA_BASE = 0x02aa00000000
+AP_BASE = 0x02bb00000000
+
+
+def parse_mix(mix):
+    # 'beacon=30,data=70' -> {'beacon': 30.0, 'data': 70.0}
+    result = dict()
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        result[name.strip()] = float(weight)
+    return result
+
+
+def mac(addr):
+    return addr.to_bytes(6, 'big')
+
+
+def element(elt_id, info):
+    return bytes((elt_id, len(info))) + info
+
+
+def fc(sts):
+    # First frame control byte of a type/sub_type
+    return (sts & 0x0f) << 4 | (sts >> 4) << 2
+
+
+class FrameGenerator:
+    def __init__(self, mix=DEFAULT_MIX, devices=2000, aps=100, ssids=50,
+                 seed=0):
+        mix = parse_mix(mix) if isinstance(mix, str) else mix
+        self.types = list(mix.keys())
+        self.weights = list(mix.values())
+        self.stations = [mac(STA_BASE + i) for i in range(devices)]
+        self.aps = [mac(AP_BASE + i) for i in range(aps)]
+        self.ssids = [element(0, 'bench-{}'.format(i).encode())
+                      for i in range(ssids)]
+        # probe requests also go out with the wildcard (empty) SSID
+        self.probed = self.ssids + [element(0, b'')]
+        self.random = random.Random(seed)
+        self.seq = 0
+
+    def header(self, sts, addr1, addr2, addr3, flags=0):
+        self.seq = (self.seq + 1) & 0x0fff
+        return HEADER.pack(fc(sts), flags, 0, addr1, addr2, addr3,
+                           self.seq << 4)
+
+    def ap(self):
+        # (bssid, ssid element) of a random access point
+        i = self.random.randrange(len(self.aps))
+        return self.aps[i], self.ssids[i % len(self.ssids)]
+
+    def station(self):
+        return self.random.choice(self.stations)
+
+    def beacon(self):
+        bssid, ssid = self.ap()
+        return self.header(FrameSubType.BEACON, BROADCAST, bssid, bssid) + \
+            bytes(12) + ssid
+
+    def probe_req(self):
+        ssid = self.random.choice(self.probed)
+        return self.header(FrameSubType.PROBE_REQ, BROADCAST, self.station(),
+                           BROADCAST) + ssid
+
+    def mgmt(self):
+        sts = self.random.choice(SUBTYPES['mgmt'])
+        bssid, ssid = self.ap()
+        sta = self.station()
+        if sts == FrameSubType.PROBE_RESP:
+            return self.header(sts, sta, bssid, bssid) + bytes(12) + ssid
+        if sts == FrameSubType.ASSOCIATION:
+            return self.header(sts, bssid, sta, bssid) + bytes(4) + ssid
+        return self.header(sts, bssid, sta, bssid) + b'\x04\x00'
+
+    def ctrl(self):
+        sts = self.random.choice(SUBTYPES['ctrl'])
+        bssid, _ = self.ap()
+        return CTRL_HEADER.pack(fc(sts), 0, 0, bssid, self.station()) + \
+            bytes(4)
+
+    def data(self):
+        sts = self.random.choice(SUBTYPES['data'])
+        bssid, _ = self.ap()
+        # to DS: addr1 is the BSSID, addr2 the station
+        frame = self.header(sts, bssid, self.station(), BROADCAST, flags=1)
+        if sts & 0x08:
+            frame += bytes(2)   # QoS control
+        if sts == FrameSubType.QOS_DATA:
+            frame += bytes(self.random.randrange(40, 400))
+        return frame
+
+    def frame(self):
+        frm_type = self.random.choices(self.types, self.weights)[0]
+        return EMPTY_RADIOTAP + getattr(self, frm_type)()
+
+    def frames(self, n):
+        return [self.frame() for _ in range(n)]
+
+
+def write_pcap(path, frames, start=None, rate=1000):
+    # Classic pcap with a radiotap link type, frames rate per second
+    start = time.time() if start is None else start
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535,
+                            DLT_IEEE802_11_RADIO))
+        for i, frame in enumerate(frames):
+            ts = start + i / rate
+            sec = int(ts)
+            f.write(struct.pack('<4I', sec, int((ts - sec) * 1e6),
+                                len(frame), len(frame)))
+            f.write(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='write synthetic 802.11 frames to a pcap')
+    parser.add_argument('pcap', help='output file')
+    parser.add_argument('-n', dest='frames', type=int, default=100000)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='frame type weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--aps', type=int, default=100)
+    parser.add_argument('--ssids', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='frames per second of capture time')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generator = FrameGenerator(args.mix, args.devices, args.aps, args.ssids,
+                               args.seed)
+    write_pcap(args.pcap, generator.frames(args.frames), rate=args.rate)
+
+
+if __name__ == '__main__':
+    main()
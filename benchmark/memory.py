@@ -0,0 +1,98 @@
+import argparse
+import time
+import tracemalloc
+import settings
+from base import GeoFrame
+from event import Dot11Event
+
+# Memory held by full frame and event queues, and the cost of building
+# events, for the slotted records against the former dict-backed ones with
+# string MACs and datetime stamps. Run from the repository root:
+#   python3 -m benchmark.memory
+
+FRAME = bytes(120)
+
+
+class LegacyGeoFrame:
+    def __init__(self, frame, geo, timestamp):
+        self.frame = frame
+        self.geo = geo
+        self.timestamp = timestamp
+
+
+class LegacyDot11Event:
+    def __init__(self, src=None, dst=None, timestamp=None, geo=None,
+                 type=None, ssid=None, origin=None):
+        self.src = src
+        self.dst = dst
+        self.timestamp = timestamp
+        self.geo = geo
+        self.type = type
+        self.ssid = ssid
+        self.origin = origin
+
+
+def legacy_items(n_frames, n_events):
+    from datetime import datetime
+    frames = [LegacyGeoFrame(FRAME, {'longitude': 1.0, 'latitude': 2.0},
+                             datetime.now()) for _ in range(n_frames)]
+    events = []
+    for i in range(n_events):
+        src = (0x0a0000000000 + i).to_bytes(6, 'big').hex(':')
+        events.append(LegacyDot11Event(src=src, timestamp=datetime.now(),
+                                       type=Dot11Event.MAC,
+                                       origin='from_mgmt'))
+    return frames, events
+
+
+def slotted_items(n_frames, n_events):
+    frames = [GeoFrame(FRAME, time.time()) for _ in range(n_frames)]
+    events = [Dot11Event(src=0x0a0000000000 + i, timestamp=time.time(),
+                         type=Dot11Event.MAC, origin='from_mgmt')
+              for i in range(n_events)]
+    return frames, events
+
+
+def measure(build, n_frames, n_events):
+    tracemalloc.start()
+    start = time.perf_counter()
+    frames, events = build(n_frames, n_events)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del frames, events
+    return size, elapsed
+
+
+def legacy_parse(events):
+    # What event.py did with every string MAC
+    for event in events:
+        int(event.src.replace(':', ''), 16)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='memory of queued frames and events')
+    parser.parse_args()
+    cfg = settings.get()
+    n_frames = cfg.default.frm_queue_max_size * len(cfg.dot11.frame_types)
+    n_events = cfg.default.event_queue_max_size
+    print('{} queued frames, {} queued events'.format(n_frames, n_events))
+    results = {}
+    for name, build in (('legacy', legacy_items), ('slotted', slotted_items)):
+        size, elapsed = measure(build, n_frames, n_events)
+        results[name] = size
+        print('  {:8} {:8.1f} KB, {:6.1f} bytes/item, build {:.2f} us/item'
+              ''.format(name, size / 1024, size / (n_frames + n_events),
+                        elapsed * 1e6 / (n_frames + n_events)))
+    _, events = legacy_items(0, n_events)
+    start = time.perf_counter()
+    legacy_parse(events)
+    print('  legacy MAC string parsing: {:.2f} us/event'.format(
+        (time.perf_counter() - start) * 1e6 / n_events))
+    print('  slotted saves {:.1%}'.format(
+        1 - results['slotted'] / results['legacy']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import settings
+from benchmark.frames import FrameGenerator, DEFAULT_MIX
+
+# End-to-end throughput of Dot11Hunter.dispatch -> frame handlers ->
+# EventHandler in thread mode, on synthetic frames and a scratch SQLite
+# database. Reports frames/s, events/s, drops, queue high-water marks and
+# per-stage latency percentiles, and writes them as JSON to compare runs.
+# Run from the repository root:
+#   python3 -m benchmark.throughput -n 200000 -o before.json
+
+
+def percentiles(samples):
+    # Latencies in ms
+    if not samples:
+        return None
+    samples = sorted(samples)
+    result = dict()
+    for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        result[name] = samples[min(len(samples) - 1,
+                                   int(q * len(samples)))] * 1000
+    result['max'] = samples[-1] * 1000
+    result['samples'] = len(samples)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Probe:
+    # Latency samples and queue high-water marks of a running pipeline.
+    # Stages: dispatch (capture callback), frame_queue (waiting for a
+    # handler), parse (handler), event_age (capture to batch write, the
+    # coalesce window included), flush (one batch transaction).
+    def __init__(self, hunter, handlers, event_handler, sample_every):
+        self.hunter = hunter
+        self.sample_every = sample_every
+        self.latencies = {'dispatch': [], 'frame_queue': [], 'parse': [],
+                          'event_age': [], 'flush': []}
+        self.high_water = dict.fromkeys(hunter.frm_queues, 0)
+        self.high_water['event'] = 0
+        self.running = True
+        for handler in handlers:
+            self.wrap_parse(handler)
+        self.wrap_flush(event_handler)
+
+    def wrap_parse(self, handler):
+        parse_frame = handler.parse_frame
+        latencies = self.latencies
+
+        def timed(geo_frame):
+            start = time.time()
+            latencies['frame_queue'].append(start - geo_frame.timestamp)
+            parse_frame(geo_frame)
+            latencies['parse'].append(time.time() - start)
+        handler.parse_frame = timed
+
+    def wrap_flush(self, event_handler):
+        flush = event_handler.flush
+        latencies = self.latencies
+
+        def timed(batch):
+            start = time.time()
+            latencies['event_age'].extend(start - e.last_seen for e in batch)
+            flush(batch)
+            latencies['flush'].append(time.time() - start)
+        event_handler.flush = timed
+
+    def dispatch(self, frames, rate, geo):
+        # Feed the frames at rate frames/s, 0 for as fast as possible
+        dispatch = self.hunter.dispatch
+        start = time.time()
+        for i, frame in enumerate(frames):
+            if geo and not i % 1000:
+                # a fix every 1000 frames, as the phone would send them
+                self.hunter.update_location(
+                    {'longitude': 116.3 + i * 1e-7, 'latitude': 39.9,
+                     'timestamp': time.time() * 1000})
+            if rate:
+                delay = start + i / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if i % self.sample_every:
+                dispatch(frame, time.time())
+            else:
+                t = time.perf_counter()
+                dispatch(frame, time.time())
+                self.latencies['dispatch'].append(time.perf_counter() - t)
+        return time.time() - start
+
+    def watch(self, interval=0.01):
+        while self.running:
+            for t, q in self.hunter.frm_queues.items():
+                self.high_water[t] = max(self.high_water[t], q.qsize())
+            self.high_water['event'] = max(self.high_water['event'],
+                                           self.hunter.event_queue.qsize())
+            time.sleep(interval)
+
+
+def run(args):
+    # Scratch database and quiet periodic logs, dump_log resets counters
+    scratch = tempfile.mkdtemp(prefix='dot11hunter-bench-')
+    db = os.path.join(scratch, 'bench.db')
+    default = {'log_interval': 86400, 'mode': 'thread'}
+    for key in ('frm_queue_max_size', 'event_queue_max_size'):
+        if getattr(args, key) is not None:
+            default[key] = getattr(args, key)
+    cfg = settings.override(
+        storage={'backend': 'sqlite', 'sqlite_path': db}, default=default,
+        journal={'path': os.path.join(scratch, 'spill')})
+    from dot11hunter import Dot11Hunter
+    from handler import create_handlers
+
+    generator = FrameGenerator(args.mix, args.devices, args.aps, args.ssids,
+                               args.seed)
+    frames = generator.frames(args.frames)
+    hunter = Dot11Hunter(['-i', 'bench'])
+    handlers = create_handlers(hunter.frm_queues, hunter.event_queue)
+    event_handler = handlers[-1]
+    probe = Probe(hunter, handlers[:-1], event_handler, args.sample_every)
+    watcher = threading.Thread(target=probe.watch, daemon=True)
+    watcher.start()
+    for handler in handlers:
+        handler.daemon = True
+        handler.start()
+    if args.adaptive:
+        hunter.sampler.start()
+
+    start = time.time()
+    feed_time = probe.dispatch(frames, args.rate, args.geo)
+    # Drain: every queue empty, nothing left to coalesce or to replay, last
+    # batch written
+    journal = event_handler.journal
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline:
+        idle = all(q.empty() for q in hunter.frm_queues.values()) and \
+            hunter.event_queue.empty() and \
+            not any(h.coalescer.pending for h in handlers[:-1]) and \
+            (journal is None or len(journal) == 0)
+        if idle:
+            break
+        time.sleep(0.05)
+    time.sleep(cfg.mysql.batch_latency + 0.1)
+    total_time = time.time() - start
+    probe.running = False
+
+    coalesced = {'in': 0, 'out': 0, 'dropped': 0}
+    for handler in handlers[:-1]:
+        for k in coalesced:
+            coalesced[k] += handler.coalescer.counters[k]
+    handled = len(probe.latencies['parse'])
+    frame_drops = sum(hunter.drop_counters.values())
+    written = event_handler.batch_counters['events']
+    return {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': {
+            'frames': args.frames,
+            'rate': args.rate,
+            'mix': args.mix,
+            'devices': args.devices,
+            'aps': args.aps,
+            'ssids': args.ssids,
+            'geo': args.geo,
+            'adaptive': args.adaptive,
+            'seed': args.seed,
+            'frm_queue_max_size': cfg.default.frm_queue_max_size,
+            'event_queue_max_size': cfg.default.event_queue_max_size,
+            'coalesce_window': cfg.dot11.coalesce_window,
+            'batch_size': cfg.mysql.batch_size,
+        },
+        'frames': {
+            'offered': len(frames),
+            'handled': handled,
+            'dropped': frame_drops,
+            # sampling and frame types no handler takes
+            'skipped': len(frames) - handled - frame_drops,
+            'dropped_by_type': dict(hunter.drop_counters),
+            'drop_rate': frame_drops / len(frames) if frames else 0,
+            'per_second': len(frames) / feed_time if feed_time else 0,
+        },
+        'events': {
+            'parsed': coalesced['in'],
+            'coalesced': coalesced['out'],
+            'dropped': coalesced['dropped'],
+            'drop_rate': coalesced['dropped'] / coalesced['in']
+            if coalesced['in'] else 0,
+            'written': written,
+            'batches': event_handler.batch_counters['batches'],
+            'failed_batches': event_handler.batch_counters['failed'],
+            # an empty journal is falsy
+            'spilled': journal.counters['spilled']
+            if journal is not None else 0,
+            'per_second': written / total_time if total_time else 0,
+        },
+        'seconds': {'feed': feed_time, 'total': total_time},
+        'queue_high_water': probe.high_water,
+        'latency_ms': {k: percentiles(v)
+                       for k, v in probe.latencies.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='end-to-end throughput of the capture pipeline')
+    parser.add_argument('-n', dest='frames', type=int, default=200000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help='frames per second, 0 for as fast as possible')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='frame type weights, default ' + DEFAULT_MIX)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--aps', type=int, default=100)
+    parser.add_argument('--ssids', type=int, default=50)
+    parser.add_argument('--geo', action='store_true',
+                        help='send location fixes (GEO rows)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='run the adaptive sampling controller')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--frm-queue-max-size', type=int)
+    parser.add_argument('--event-queue-max-size', type=int)
+    parser.add_argument('--sample-every', type=int, default=100,
+                        help='time one dispatch call out of this many')
+    parser.add_argument('--drain-timeout', type=float, default=30)
+    parser.add_argument('-o', dest='output', help='write the JSON here')
+    args = parser.parse_args()
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+    # handler threads never return
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import codecs
+import json
+import struct
+from base import logger
+
+# Framing of the phone link. A binary frame is a (magic, type, length)
+# header and length bytes of payload. The app opens with a HELLO frame
+# listing the protocol versions it speaks, the reply carries the chosen
+# one, 0 if there is none in common. A connection whose first byte is '{'
+# is the original JSON protocol: location documents from the phone, now
+# split and joined across reads, and a full status document every time.
+#
+# Version 1 payloads:
+#   HELLO         versions (client) or the chosen version (server), bytes
+#   LOCATIONS     count B, then count fixes of timestamp ms q, longitude
+#                 and latitude in 1e-7 degrees i
+#   STATUS        present H, null H field masks, then the values of the
+#                 present, non-null fields in STATUS_FIELDS order: str as
+#                 length B + UTF-8, count I, float f
+#   STATUS_DELTA  the same with only the fields changed since the last one
+
+MAGIC = 0xD1
+FRAME_HEADER = struct.Struct('>BBH')
+HELLO = 0x01
+LOCATIONS = 0x02
+STATUS = 0x03
+STATUS_DELTA = 0x04
+VERSIONS = (1,)
+JSON_VERSION = 0
+FIX = struct.Struct('>qii')
+DEGREE_SCALE = 10 ** 7
+STATUS_FIELDS = (
+    ('mac', 'str'),
+    ('ssid', 'str'),
+    ('association', 'str'),
+    ('mac_count', 'count'),
+    ('ap_count', 'count'),
+    ('geo_count', 'count'),
+    ('association_count', 'count'),
+    ('cpu_usage', 'float'),
+    ('mem_usage', 'float'),
+    ('temperature', 'float'),
+)
+MASKS = struct.Struct('>HH')
+COUNT = struct.Struct('>I')
+FLOAT = struct.Struct('>f')
+FULL_STATUS_EVERY = 12  # status updates, a full one resyncs the app
+MAX_BUFFER = 1 << 16
+LOG_EXTRA = {'thread_name': 'BtServer'}
+
+
+def encode_frame(frame_type, payload=b''):
+    return FRAME_HEADER.pack(MAGIC, frame_type, len(payload)) + payload
+
+
+def encode_locations(fixes):
+    # fixes: dicts of timestamp (ms), longitude and latitude
+    payload = [bytes([len(fixes)])]
+    for fix in fixes:
+        payload.append(FIX.pack(int(fix['timestamp']),
+                                round(fix['longitude'] * DEGREE_SCALE),
+                                round(fix['latitude'] * DEGREE_SCALE)))
+    return encode_frame(LOCATIONS, b''.join(payload))
+
+
+def decode_locations(payload):
+    fixes = []
+    for i in range(payload[0] if payload else 0):
+        ts, longitude, latitude = FIX.unpack_from(payload, 1 + i * FIX.size)
+        fixes.append({'timestamp': ts,
+                      'longitude': longitude / DEGREE_SCALE,
+                      'latitude': latitude / DEGREE_SCALE})
+    return fixes
+
+
+def encode_status(status, previous=None):
+    # STATUS frame, or STATUS_DELTA of the fields changed since previous
+    present = 0
+    nulls = 0
+    values = []
+    for i, (name, kind) in enumerate(STATUS_FIELDS):
+        value = status.get(name)
+        if previous is not None and previous.get(name) == value:
+            continue
+        present |= 1 << i
+        if value is None:
+            nulls |= 1 << i
+        elif kind == 'str':
+            data = str(value).encode('utf-8')[:255]
+            values.append(bytes([len(data)]) + data)
+        elif kind == 'count':
+            values.append(COUNT.pack(min(int(value), 0xffffffff)))
+        else:
+            values.append(FLOAT.pack(value))
+    return encode_frame(STATUS if previous is None else STATUS_DELTA,
+                        MASKS.pack(present, nulls) + b''.join(values))
+
+
+def decode_status(payload, previous=None):
+    # The status after a STATUS (previous None) or STATUS_DELTA payload
+    status = dict(previous or dict.fromkeys(n for n, _ in STATUS_FIELDS))
+    present, nulls = MASKS.unpack_from(payload)
+    offset = MASKS.size
+    for i, (name, kind) in enumerate(STATUS_FIELDS):
+        if not present & 1 << i:
+            continue
+        if nulls & 1 << i:
+            status[name] = None
+        elif kind == 'str':
+            n = payload[offset]
+            status[name] = payload[offset + 1:offset + 1 + n].decode('utf-8')
+            offset += 1 + n
+        elif kind == 'count':
+            status[name] = COUNT.unpack_from(payload, offset)[0]
+            offset += COUNT.size
+        else:
+            status[name] = round(FLOAT.unpack_from(payload, offset)[0], 1)
+            offset += FLOAT.size
+    return status
+
+
+class Session:
+    # Protocol state of one phone connection: the input mode, None until
+    # the first byte tells, the negotiated version, the bytes of an
+    # incomplete frame or document, and the last status sent for deltas
+    def __init__(self):
+        self.mode = None    # 'json' or 'frames'
+        self.version = JSON_VERSION
+        self.buffer = bytearray()
+        self.text = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self.last_status = None
+        self.status_updates = 0
+
+    def feed(self, data):
+        # Returns the location fixes received and the bytes to send back
+        fixes = []
+        replies = []
+        if self.mode is None:
+            data = bytes(data).lstrip()
+            if not data:
+                return fixes, replies
+            self.mode = 'frames' if data[0] == MAGIC else 'json'
+        if self.mode == 'json':
+            self.feed_json(data, fixes)
+        else:
+            self.feed_frames(data, fixes, replies)
+        return fixes, replies
+
+    def feed_json(self, data, fixes):
+        # Documents as they come, several per read or split across reads
+        text = self.text + self.decoder.decode(bytes(data))
+        decoder = json.JSONDecoder()
+        while True:
+            text = text.lstrip()
+            if not text:
+                break
+            try:
+                fix, end = decoder.raw_decode(text)
+            except ValueError:
+                close = text.find('}')
+                if close < 0:
+                    break   # incomplete
+                logger.warning('bad location document {!r}'.format(
+                    text[:close + 1]), extra=LOG_EXTRA)
+                text = text[close + 1:]
+                continue
+            if isinstance(fix, dict):
+                fixes.append(fix)
+            text = text[end:]
+        if len(text) > MAX_BUFFER:
+            logger.warning('dropped {} bytes without a location document'
+                           ''.format(len(text)), extra=LOG_EXTRA)
+            text = ''
+        self.text = text
+
+    def feed_frames(self, data, fixes, replies):
+        buf = self.buffer
+        buf += data
+        while True:
+            start = buf.find(MAGIC)
+            if start < 0:
+                buf.clear()
+                return
+            if start:
+                logger.warning('skipped {} bytes between frames'.format(
+                    start), extra=LOG_EXTRA)
+                del buf[:start]
+            if len(buf) < FRAME_HEADER.size:
+                return
+            _, frame_type, length = FRAME_HEADER.unpack_from(buf)
+            if len(buf) < FRAME_HEADER.size + length:
+                return
+            payload = bytes(buf[FRAME_HEADER.size:FRAME_HEADER.size + length])
+            del buf[:FRAME_HEADER.size + length]
+            try:
+                self.handle_frame(frame_type, payload, fixes, replies)
+            except (struct.error, IndexError) as e:
+                logger.warning('bad frame of type {}: {}'.format(
+                    frame_type, e), extra=LOG_EXTRA)
+            if self.mode == 'json':
+                if buf:
+                    self.feed_json(bytes(buf), fixes)
+                    buf.clear()
+                return
+
+    def handle_frame(self, frame_type, payload, fixes, replies):
+        if frame_type == HELLO:
+            common = set(payload) & set(VERSIONS)
+            version = max(common) if common else JSON_VERSION
+            replies.append(encode_frame(HELLO, bytes([version])))
+            self.version = version
+            self.last_status = None
+            self.status_updates = 0
+            if version == JSON_VERSION:
+                # the app goes on in JSON
+                self.mode = 'json'
+            logger.info('phone speaks protocol version {}'.format(
+                version or 'JSON'), extra=LOG_EXTRA)
+        elif frame_type == LOCATIONS:
+            fixes.extend(decode_locations(payload))
+        else:
+            logger.warning('unknown frame type {}'.format(frame_type),
+                           extra=LOG_EXTRA)
+
+    def encode_status(self, status):
+        # Bytes of a status update in the session's protocol: the JSON
+        # document unless a binary version is negotiated, None while a
+        # HELLO is awaited
+        if not self.version:
+            if self.mode == 'frames':
+                return None
+            return json.dumps(status).encode('utf-8')
+        previous = self.last_status
+        if self.status_updates % FULL_STATUS_EVERY == 0:
+            previous = None
+        self.status_updates += 1
+        self.last_status = dict(status)
+        return encode_status(status, previous)
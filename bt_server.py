@@ -1,53 +1,194 @@
-import bluetooth
+import asyncio
+import collections
+import os
+import socket
 import threading
-from base import logger, Dot11HunterBase, CFG
+import settings
+from base import logger, Dot11HunterBase
+from bt_protocol import Session
+from metrics import REGISTRY
+
+# Phone link server on an asyncio loop in its own thread. Each phone gets a
+# bounded queue of status updates, the oldest is dropped when it falls
+# behind, and reads and writes time out, so a stalled phone holds up
+# nobody. The transport is RFCOMM, or TCP on [BLUETOOTH] listen to run
+# without the hardware; add_client() serves any connected stream socket,
+# such as one end of a socketpair.
+
+READ_SIZE = 4096
+# bytes buffered by a client transport before writes wait, small so the
+# status queue is what absorbs a slow phone
+WRITE_BUFFER = 4096
+
+
+def create_listener():
+    # (listening socket, description, owner). pybluez only for RFCOMM: it
+    # binds a free channel and advertises the service, the loop uses a
+    # plain socket on the same descriptor; owner, the pybluez socket, is
+    # kept open for the advertisement.
+    cfg = settings.get().bluetooth
+    if cfg.transport == 'tcp':
+        host, port = cfg.listen.rsplit(':', 1)
+        sock = socket.create_server((host, int(port)))
+        return sock, 'TCP {}:{}'.format(host, sock.getsockname()[1]), None
+    import bluetooth
+    bt_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    bt_sock.bind(('', bluetooth.PORT_ANY))
+    bt_sock.listen(1)
+    bluetooth.advertise_service(bt_sock, "sampleserver",
+                                service_id=cfg.uuid,
+                                service_classes=[cfg.uuid,
+                                                 bluetooth.SERIAL_PORT_CLASS],
+                                profiles=[bluetooth.SERIAL_PORT_PROFILE])
+    sock = socket.socket(fileno=os.dup(bt_sock.fileno()))
+    return sock, 'RFCOMM channel {}'.format(bt_sock.getsockname()[1]), \
+        bt_sock
+
+
+class Client:
+    def __init__(self, name, reader, writer, queue_size):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.session = Session()
+        # statuses are encoded when sent, so a dropped one never breaks
+        # the deltas; protocol replies are never dropped
+        self.statuses = collections.deque(maxlen=queue_size)
+        self.replies = collections.deque()
+        self.wakeup = asyncio.Event()
 
 
 class BtServer(Dot11HunterBase):
     def __init__(self, recv_callback):
         super().__init__()
-        # recv_callback is called when receiving geo data from phone
+        # recv_callback is called with each location fix received from the
+        # phone, a dict of longitude, latitude and timestamp (ms), in a
+        # worker thread of the loop
         self.recv_callback = recv_callback
         self.setName('BtServer')
         self.log_extra = {'thread_name': self.getName()}
-        self.server_socket = None
-        self.socks = list()
-
-    def init_socket(self):
-        self.server_socket = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        self.server_socket.bind(('', bluetooth.PORT_ANY))
-        self.server_socket.listen(1)
-        port = self.server_socket.getsockname()[1]
-        uuid = CFG['BLUETOOTH']['UUID']
-        bluetooth.advertise_service(self.server_socket, "sampleserver",
-                                    service_id=uuid,
-                                    service_classes=[uuid,
-                                                     bluetooth.SERIAL_PORT_CLASS],
-                                    profiles=[bluetooth.SERIAL_PORT_PROFILE])
-        logger.info('BtServer is listening on port {}.'.format(port),
-                    extra=self.log_extra)
-
-    def send(self, data):
-        for sock in self.socks:
-            sock.send(data.encode('utf-8'))
+        self.daemon = True
+        self.loop = None
+        self.listener_owner = None
+        self.ready = threading.Event()
+        self.clients = dict()   # name -> Client, loop thread only
+        self.client_seq = 0
+        REGISTRY.gauge('dot11hunter_bt_clients', 'Connected phones',
+                       func=lambda: len(self.clients))
+        self.fixes_metric = REGISTRY.counter(
+            'dot11hunter_bt_fixes', 'Location fixes received')
+        self.dropped_metric = REGISTRY.counter(
+            'dot11hunter_bt_status_dropped',
+            'Status updates dropped for a phone behind')
 
     def run(self):
-        self.init_socket()
-        while True:
-            logger.info('waiting for connecting...', extra=self.log_extra)
-            sock, info = self.server_socket.accept()
-            logger.info('{}  connected!'.format(str(info[0])),
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            sock, description, self.listener_owner = create_listener()
+            self.loop.run_until_complete(asyncio.start_server(
+                self.handle_client, sock=sock))
+            logger.info('BtServer is listening on {}.'.format(description),
                         extra=self.log_extra)
-            self.socks.append(sock)
-            t = threading.Thread(target=self.serve_socket,
-                                 args=(sock, info[0]))
-            t.start()
+        except Exception as e:
+            # status and fixes stay off, capture goes on
+            logger.critical('cannot listen: {}'.format(e),
+                            extra=self.log_extra)
+        self.ready.set()
+        self.loop.run_forever()
+
+    def send_status(self, status):
+        # From any thread
+        if self.ready.is_set():
+            self.loop.call_soon_threadsafe(self.queue_status, status)
 
-    def serve_socket(self, sock, info):
+    def add_client(self, sock):
+        # Serve a connected socket, from any thread
+        self.ready.wait()
+        asyncio.run_coroutine_threadsafe(self.open_client(sock), self.loop)
+
+    async def open_client(self, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handle_client(reader, writer)
+
+    def queue_status(self, status):
+        for client in self.clients.values():
+            if len(client.statuses) == client.statuses.maxlen:
+                self.dropped_metric.inc()
+            client.statuses.append(status)
+            client.wakeup.set()
+
+    async def handle_client(self, reader, writer):
+        self.client_seq += 1
+        peer = writer.get_extra_info('peername')
+        name = '{}#{}'.format(peer[0] if isinstance(peer, tuple) else
+                              peer or 'phone', self.client_seq)
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER)
+        client = Client(name, reader, writer,
+                        settings.get().bluetooth.send_queue)
+        self.clients[name] = client
+        logger.info('{} connected!'.format(name), extra=self.log_extra)
+        tasks = [asyncio.ensure_future(self.read_loop(client)),
+                 asyncio.ensure_future(self.write_loop(client))]
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    logger.warning('{}: {}'.format(name, task.exception()),
+                                   extra=self.log_extra)
+        finally:
+            del self.clients[name]
+            writer.close()
+            logger.info('{} disconnected'.format(name), extra=self.log_extra)
+
+    async def read_loop(self, client):
+        loop = asyncio.get_event_loop()
         while True:
+            timeout = settings.get().bluetooth.read_timeout or None
             try:
-                rcv = sock.recv(1024).decode('utf-8')
-                self.recv_callback(rcv)
+                data = await asyncio.wait_for(client.reader.read(READ_SIZE),
+                                              timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError('nothing received for {} s'.format(
+                    timeout))
+            if not data:
+                return
+            fixes, replies = client.session.feed(data)
+            if replies:
+                client.replies.extend(replies)
+                client.wakeup.set()
+            if fixes:
+                self.fixes_metric.inc(len(fixes))
+                # update_location may block on the event queue
+                await loop.run_in_executor(None, self.deliver, fixes)
+
+    def deliver(self, fixes):
+        for fix in fixes:
+            try:
+                self.recv_callback(fix)
             except Exception as e:
-                self.socks.remove(sock)
-                logger.critical(str(e), extra=self.log_extra)
+                logger.critical('bad location {}: {}'.format(fix, e),
+                                extra=self.log_extra)
+
+    async def write_loop(self, client):
+        while True:
+            await client.wakeup.wait()
+            client.wakeup.clear()
+            while client.replies or client.statuses:
+                if client.replies:
+                    data = client.replies.popleft()
+                else:
+                    data = client.session.encode_status(
+                        client.statuses.popleft())
+                    if data is None:
+                        continue
+                client.writer.write(data)
+                timeout = settings.get().bluetooth.write_timeout
+                try:
+                    await asyncio.wait_for(client.writer.drain(), timeout)
+                except asyncio.TimeoutError:
+                    raise ConnectionError('sending stalled for {} s'.format(
+                        timeout))
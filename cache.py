@@ -0,0 +1,154 @@
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+
+# Rough size of one cached entry (small int key and value plus the
+# OrderedDict node), used to turn a memory budget into an entry cap
+LRU_ENTRY_SIZE = 160
+
+
+class LRUCache:
+    # Bounded key -> value map evicting the least recently used entry.
+    # Not thread safe, it is meant to be owned by a single thread.
+    def __init__(self, max_size=None, memory_budget=None):
+        if max_size is None:
+            max_size = max(1, memory_budget // LRU_ENTRY_SIZE)
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+class FreshnessCache:
+    # Remembers when each key (mac int, tuple...) was last written, so that
+    # events within threshold seconds of the last write are suppressed.
+    # Suppressed hits are carried and handed back on the next write. Entries
+    # are kept for one more threshold after they could be written again, so
+    # a device still around hands its carried hits over, then expire through
+    # a heap ordered by expiry: there is never a full scan. Thread safe.
+    def __init__(self, threshold, max_size):
+        self.threshold = threshold
+        self.retention = 2 * threshold
+        self.max_size = max_size
+        self.data = dict()  # key -> [last write time, carried hits, expiry]
+        # (expiry, seq, key), seq keeps keys of different types from being
+        # compared. Stale items are skipped on pop.
+        self.heap = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def set_threshold(self, threshold):
+        # Entries keep the expiry they were written with
+        with self.lock:
+            self.threshold = threshold
+            self.retention = 2 * threshold
+
+    def touch(self, key, ts, count=1):
+        # Returns None if the event is not fresh enough to be written,
+        # otherwise the number of hits to write, carried ones included
+        with self.lock:
+            self.expire(ts)
+            entry = self.data.get(key)
+            if entry is not None:
+                delta = ts - entry[0]
+                if delta < 0 or delta <= self.threshold:
+                    entry[1] += count
+                    self.hits += 1
+                    return None
+                count += entry[1]
+            self.misses += 1
+            expiry = ts + self.retention
+            self.data[key] = [ts, 0, expiry]
+            heapq.heappush(self.heap, (expiry, next(self.seq), key))
+            if len(self.data) > self.max_size:
+                self.evict()
+            return count
+
+    def expire(self, now):
+        heap = self.heap
+        while heap and heap[0][0] < now:
+            expiry, _, key = heapq.heappop(heap)
+            entry = self.data.get(key)
+            if entry is not None and entry[2] == expiry:
+                del self.data[key]
+
+    def evict(self):
+        # Drop the entry closest to expiry
+        while self.heap:
+            expiry, _, key = heapq.heappop(self.heap)
+            entry = self.data.get(key)
+            if entry is not None and entry[2] == expiry:
+                del self.data[key]
+                self.evictions += 1
+                return
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.heap.clear()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+
+class PassThroughCache(FreshnessCache):
+    # FreshnessCache that lets every event through, for bulk loads whose
+    # events are already folded and may come out of time order
+    def __init__(self):
+        super().__init__(0, 0)
+
+    def touch(self, key, ts, count=1):
+        self.misses += 1
+        return count
@@ -0,0 +1,324 @@
+import functools
+import mmap
+import select
+import socket
+import struct
+import threading
+import time
+import settings
+from base import logger
+from channel import MacNovelty
+
+# linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+ETH_P_ALL = 0x0003
+
+# pcap link types
+DLT_IEEE802_11 = 105
+DLT_IEEE802_11_RADIO = 127
+
+# pcapng block types and the interface timestamp resolution option
+PCAPNG_SHB = b'\x0a\x0d\x0d\x0a'
+PCAPNG_IDB = 0x01
+PCAPNG_EPB = 0x06
+PCAPNG_IF_TSRESOL = 9
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct('=7I')
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1:
+# block_status, num_pkts, offset_to_first_pkt
+BLOCK_DESC = struct.Struct('=5I')
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len,
+# tp_status, tp_mac
+TPACKET3_HDR = struct.Struct('=6IH')
+# Minimal radiotap header (version 0, no fields) for frames without one
+EMPTY_RADIOTAP = b'\x00\x00\x08\x00\x00\x00\x00\x00'
+# -i pcap:<path> replays a capture file in real time, looping, in place of
+# an interface
+PCAP_SOURCE = 'pcap:'
+
+
+def create_capture(interface):
+    # Build the capture backend selected in config
+    if interface.startswith(PCAP_SOURCE):
+        return PcapCapture(interface[len(PCAP_SOURCE):], realtime=True,
+                           loop=0)
+    backend = settings.get().capture.backend
+    if backend == 'ring':
+        return RingCapture(interface)
+    if backend == 'scapy':
+        return ScapyCapture(interface)
+    raise ValueError('unknown capture backend: {}'.format(backend))
+
+
+class CaptureSource(threading.Thread):
+    # One capture interface in its own thread, calling
+    # callback(buf, ts, macs=macs) with the MacNovelty of the interface, so
+    # the channel switch of each interface sees its own frames and MACs
+    def __init__(self, interface, callback):
+        super().__init__()
+        self.setName('Capture-{}'.format(interface))
+        self.log_extra = {'thread_name': self.getName()}
+        self.interface = interface
+        self.replay = interface.startswith(PCAP_SOURCE)
+        self.callback = callback
+        self.capture = create_capture(interface)
+        self.capture.log_extra = self.log_extra
+        self.macs = MacNovelty()
+
+    def frames(self):
+        return self.capture.frames
+
+    def run(self):
+        try:
+            self.capture.run(functools.partial(self.callback, macs=self.macs))
+        except Exception as e:
+            logger.critical(str(e), extra=self.log_extra)
+
+    def stop(self):
+        self.capture.stop()
+
+
+class CaptureBase:
+    # A capture backend calls callback(buf, ts) for every frame, buf being
+    # the raw radiotap+802.11 bytes and ts the capture time in epoch seconds.
+    # buf may be a memoryview that is only valid during the callback.
+    def __init__(self):
+        self.log_extra = {'thread_name': 'Capture'}
+        self.running = False
+        self.frames = 0
+
+    def run(self, callback):
+        pass
+
+    def stop(self):
+        self.running = False
+
+
+class ScapyCapture(CaptureBase):
+    # Original scapy.all.sniff path, kept for drivers without mmap support
+    def __init__(self, interface):
+        super().__init__()
+        self.interface = interface
+
+    def run(self, callback):
+        from scapy.all import conf, raw, sniff
+        conf.iface = self.interface
+        self.running = True
+
+        def prn(frame):
+            self.frames += 1
+            callback(raw(frame), float(frame.time))
+        sniff(prn=prn, store=False, stop_filter=lambda _: not self.running)
+
+
+class RingCapture(CaptureBase):
+    # Read frames from a TPACKET_V3 memory-mapped ring of an AF_PACKET socket
+    def __init__(self, interface):
+        super().__init__()
+        self.interface = interface
+        cfg = settings.get().capture
+        self.block_size = cfg.ring_block_size
+        self.block_nr = cfg.ring_block_nr
+        self.frame_size = cfg.ring_frame_size
+        self.retire_tov = cfg.ring_retire_tov
+        self.sock = None
+        self.ring = None
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                  socket.htons(ETH_P_ALL))
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        frame_nr = self.block_size // self.frame_size * self.block_nr
+        req = TPACKET_REQ3.pack(self.block_size, self.block_nr,
+                                self.frame_size, frame_nr,
+                                self.retire_tov, 0, 0)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.ring = mmap.mmap(self.sock.fileno(),
+                              self.block_size * self.block_nr,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self.sock.bind((self.interface, ETH_P_ALL))
+        logger.info('ring capture on {}: {} blocks x {} bytes'.format(
+            self.interface, self.block_nr, self.block_size),
+            extra=self.log_extra)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def run(self, callback):
+        self.open()
+        self.running = True
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        view = memoryview(self.ring)
+        block = 0
+        try:
+            while self.running:
+                offset = block * self.block_size
+                _, _, status, num_pkts, first = BLOCK_DESC.unpack_from(
+                    self.ring, offset)
+                if not status & TP_STATUS_USER:
+                    poller.poll(1000)
+                    continue
+                self.walk_block(view, offset, first, num_pkts, callback)
+                # Hand the block back to the kernel
+                struct.pack_into('=I', self.ring, offset + 8,
+                                 TP_STATUS_KERNEL)
+                block = (block + 1) % self.block_nr
+        finally:
+            view.release()
+            self.close()
+
+    def walk_block(self, view, offset, first, num_pkts, callback):
+        pkt = offset + first
+        for _ in range(num_pkts):
+            next_offset, sec, nsec, snaplen, _, _, mac = \
+                TPACKET3_HDR.unpack_from(self.ring, pkt)
+            start = pkt + mac
+            with view[start:start + snaplen] as buf:
+                callback(buf, sec + nsec / 1e9)
+            self.frames += 1
+            pkt += next_offset
+
+
+class PcapCapture(CaptureBase):
+    # Replay a pcap or pcapng file as if it were a live interface, so the
+    # pipeline can be exercised and benchmarked without a radio, and archived
+    # captures can be ingested. realtime=True keeps the original inter-frame
+    # gaps, otherwise frames are replayed at full speed.
+    def __init__(self, path, realtime=False, loop=1):
+        super().__init__()
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+
+    def run(self, callback):
+        self.running = True
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(data)
+        try:
+            n = 0
+            while self.running and (self.loop <= 0 or n < self.loop):
+                self.replay(view, callback)
+                n += 1
+        finally:
+            view.release()
+            data.close()
+
+    def replay(self, view, callback):
+        if bytes(view[:4]) == PCAPNG_SHB:
+            records = self.iter_pcapng(view)
+        else:
+            records = self.iter_pcap(view)
+        first_ts = None
+        start = time.time()
+        for ts, linktype, begin, end in records:
+            if not self.running:
+                break
+            if self.realtime:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            with view[begin:end] as buf:
+                if linktype == DLT_IEEE802_11:
+                    callback(EMPTY_RADIOTAP + bytes(buf), ts)
+                else:
+                    callback(buf, ts)
+            self.frames += 1
+
+    def iter_pcap(self, view):
+        # Yields (ts, link type, start, end) of every record
+        endian, nsec, linktype = self.parse_global_header(view)
+        rec = struct.Struct(endian + '4I')
+        scale = 1e9 if nsec else 1e6
+        offset = 24
+        while offset + rec.size <= len(view):
+            sec, frac, caplen, _ = rec.unpack_from(view, offset)
+            offset += rec.size
+            if offset + caplen > len(view):
+                return    # truncated by a capture still being written
+            yield sec + frac / scale, linktype, offset, offset + caplen
+            offset += caplen
+
+    @staticmethod
+    def iter_pcapng(view):
+        # Same as iter_pcap for pcapng: enhanced packet blocks of 802.11
+        # interfaces, other blocks and interfaces are skipped. A file may
+        # hold several sections, each with its own byte order and interfaces.
+        endian = '<'
+        interfaces = []     # (link type, timestamp resolution) by id
+        offset = 0
+        while offset + 12 <= len(view):
+            if bytes(view[offset:offset + 4]) == PCAPNG_SHB:
+                magic = bytes(view[offset + 8:offset + 12])
+                if magic == b'\x4d\x3c\x2b\x1a':
+                    endian = '<'
+                elif magic == b'\x1a\x2b\x3c\x4d':
+                    endian = '>'
+                else:
+                    raise ValueError('not a pcapng file')
+                interfaces = []
+            block_type, block_len = struct.unpack_from(endian + '2I', view,
+                                                       offset)
+            if block_len < 12 or offset + block_len > len(view):
+                return
+            body = offset + 8
+            if block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + 'H', view, body)[0]
+                interfaces.append(
+                    (linktype, PcapCapture.pcapng_tsresol(
+                        view, endian, body + 8, offset + block_len - 4)))
+            elif block_type == PCAPNG_EPB:
+                if_id, ts_high, ts_low, caplen = struct.unpack_from(
+                    endian + '4I', view, body)
+                linktype, scale = interfaces[if_id]
+                if linktype in (DLT_IEEE802_11, DLT_IEEE802_11_RADIO):
+                    start = body + 20
+                    yield ((ts_high << 32 | ts_low) / scale, linktype,
+                           start, start + caplen)
+            offset += block_len
+
+    @staticmethod
+    def pcapng_tsresol(view, endian, offset, end):
+        # Ticks per second from the if_tsresol option, microseconds if absent
+        opt = struct.Struct(endian + '2H')
+        while offset + opt.size <= end:
+            code, length = opt.unpack_from(view, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL and length >= 1:
+                value = view[offset + opt.size]
+                if value & 0x80:
+                    return 2 ** (value & 0x7f)
+                return 10 ** value
+            offset += opt.size + (length + 3) // 4 * 4
+        return 1e6
+
+    @staticmethod
+    def parse_global_header(view):
+        magic = bytes(view[:4])
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian = '>'
+        else:
+            raise ValueError('not a pcap file')
+        nsec = magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+        linktype = struct.unpack_from(endian + 'I', view, 20)[0] & 0x0fffffff
+        if linktype not in (DLT_IEEE802_11, DLT_IEEE802_11_RADIO):
+            raise ValueError('unsupported pcap link type: {}'.format(linktype))
+        return endian, nsec, linktype
@@ -1,54 +1,282 @@
-import re
 import time
 import threading
-from base import CFG, Dot11HunterUtils, logger
+import settings
+from base import logger
+from channel_control import create_channel_control, FakeChannelControl
+from metrics import REGISTRY
+
+
+class MacNovelty:
+    # Counts source addresses not seen for window to 2 * window seconds,
+    # rotate() is called every window. Two generations of sets keep the
+    # frame path to set lookups.
+    def __init__(self):
+        self.current = set()
+        self.previous = set()
+        self.new = 0    # cumulative
+
+    def see(self, addr):
+        if addr in self.current:
+            return
+        self.current.add(addr)
+        if addr not in self.previous:
+            self.new += 1
+
+    def rotate(self):
+        self.previous, self.current = self.current, set()
+
+
+def scheduler_params(cfg):
+    # ChannelScheduler keyword arguments from a settings snapshot
+    return {'policy': cfg.channel.scheduler,
+            'interval': cfg.default.channel_interval,
+            'min_dwell': cfg.channel.min_dwell,
+            'max_dwell': cfg.channel.max_dwell,
+            'smoothing': cfg.channel.smoothing,
+            'frame_weight': cfg.channel.frame_weight}
+
+
+class ChannelScheduler:
+    # Dwell time of each channel from its activity. Channels are visited
+    # round robin, so every channel is revisited at least every
+    # (channels - 1) * max_dwell seconds. A visit lasts min_dwell to
+    # max_dwell seconds in proportion to the channel's score, new MACs/s +
+    # frame_weight * frames/s smoothed over its visits, against the best
+    # score. Channels without statistics yet get max_dwell.
+    # policy 'fixed' stays interval seconds on every channel.
+    def __init__(self, channels, policy='adaptive', interval=10,
+                 min_dwell=1, max_dwell=10, smoothing=0.3, frame_weight=0):
+        self.channels = list(channels)
+        self.policy = policy
+        self.interval = interval
+        self.min_dwell = min_dwell
+        self.max_dwell = max_dwell
+        self.smoothing = smoothing
+        self.frame_weight = frame_weight
+        # channel -> [new MACs/s, frames/s], None until visited
+        self.stats = {ch: [None, None] for ch in self.channels}
+        self.index = -1
+
+    def score(self, channel):
+        new_rate, frame_rate = self.stats[channel]
+        if new_rate is None:
+            return None
+        return new_rate + self.frame_weight * frame_rate
+
+    def dwell(self, channel):
+        if self.policy == 'fixed':
+            return self.interval
+        score = self.score(channel)
+        if score is None:
+            return self.max_dwell
+        top = max(s for s in map(self.score, self.channels) if s is not None)
+        if top <= 0:
+            return self.min_dwell
+        return self.min_dwell + (self.max_dwell - self.min_dwell) * \
+            score / top
+
+    def next(self):
+        # (channel, dwell seconds) of the next visit
+        self.index = (self.index + 1) % len(self.channels)
+        channel = self.channels[self.index]
+        return channel, self.dwell(channel)
+
+    def update(self, channel, seconds, frames, new_macs):
+        # Statistics of a visit of seconds
+        if seconds <= 0:
+            return
+        stats = self.stats[channel]
+        rates = (new_macs / seconds, frames / seconds)
+        if stats[0] is None:
+            stats[:] = rates
+            return
+        for i, rate in enumerate(rates):
+            stats[i] += self.smoothing * (rate - stats[i])
 
 
 class ChannelSwitch(threading.Thread):
-    def __init__(self, interface):
+    # frame_count() is the number of frames captured so far and macs the
+    # MacNovelty fed by Dot11Hunter.dispatch, both read around each visit.
+    # control defaults to the [CHANNEL] control backend, channels to all
+    # the interface offers.
+    def __init__(self, interface, frame_count, macs, control=None,
+                 channels=None):
         super().__init__()
-        self.setName('ChannelSwitch')
+        self.setName('ChannelSwitch-{}'.format(interface))
         self.log_extra = {'thread_name': self.getName()}
-        self.channels = list()
+        self.channels = list(channels or ())
         self.interface = interface
+        self.frame_count = frame_count
+        self.macs = macs
+        self.control = control
+        self.scheduler = None
         self.current_channel = None
+        self.labels = {'interface': interface}
+        REGISTRY.gauge('dot11hunter_channel', 'Current channel', self.labels,
+                       func=lambda: self.current_channel)
+        self.switch_metric = REGISTRY.histogram(
+            'dot11hunter_channel_switch_seconds', 'Time to switch channel',
+            self.labels)
+        settings.subscribe(self.apply_settings)
+
+    def apply_settings(self, new, old):
+        if self.scheduler is None:
+            return
+        for key, value in scheduler_params(new).items():
+            setattr(self.scheduler, key, value)
 
     def run(self):
         try:
-            self.get_available_channels()
+            if self.control is None:
+                self.control = create_channel_control(self.interface)
+            if not self.channels:
+                self.get_available_channels()
+            if not self.channels:
+                logger.critical('no channel available on {}'.format(
+                    self.interface), extra=self.log_extra)
+                return
             self.switch_channel()
         except Exception as e:
             logger.critical(str(e), extra=self.log_extra)
 
     def switch_channel(self):
+        self.scheduler = ChannelScheduler(self.channels,
+                                          **scheduler_params(settings.get()))
+        dwell_metrics = {
+            ch: REGISTRY.counter('dot11hunter_channel_dwell_seconds',
+                                 'Time spent on a channel',
+                                 dict(self.labels, channel=ch))
+            for ch in self.channels}
+        rotated = time.time()
         while True:
-            for ch in self.channels:
-                self.set_channel(ch)
-                self.current_channel = self.get_current_channel()
-                time.sleep(CFG['DEFAULT'].getfloat('channel_interval'))
+            ch, dwell = self.scheduler.next()
+            start = time.time()
+            # an interface parked on one channel sets it once
+            switch = ch != self.control.current
+            try:
+                if switch:
+                    self.control.set_channel(ch)
+            except OSError as e:
+                logger.error('setting channel {}: {}'.format(ch, str(e)),
+                             extra=self.log_extra)
+                time.sleep(dwell)
+                continue
+            self.current_channel = self.control.current
+            visit = time.time()
+            if switch:
+                self.switch_metric.observe(visit - start)
+            frames = self.frame_count()
+            new_macs = self.macs.new
+            time.sleep(dwell)
+            now = time.time()
+            self.scheduler.update(ch, now - visit, self.frame_count() - frames,
+                                  self.macs.new - new_macs)
+            dwell_metrics[ch].inc(now - start)
+            if now - rotated >= settings.get().channel.novelty_window:
+                self.macs.rotate()
+                rotated = now
+            if self.scheduler.index == len(self.channels) - 1 and \
+                    len(self.channels) > 1 and \
+                    self.scheduler.policy != 'fixed':
+                logger.info('dwell seconds: {}'.format(', '.join(
+                    '{}: {:.1f}'.format(c, self.scheduler.dwell(c))
+                    for c in self.channels)), extra=self.log_extra)
 
     def get_available_channels(self):
-        cmd = 'iwlist {} channel'.format(self.interface)
-        outs, errs = Dot11HunterUtils.run_cmd(cmd)
-        if 'channels' in outs:
-            m = re.findall(r'Channel (\d+) :', outs, re.MULTILINE)
-            if m:
-                for i in m:
-                    ch = int(i)
-                    if ch <= CFG['DOT11'].getint('max_channel'):
-                        self.channels.append(ch)
-
-    def get_current_channel(self):
-        result = None
-        cmd = 'iwlist {} channel'.format(self.interface)
-        outs, errs = Dot11HunterUtils.run_cmd(cmd)
-        if 'channels' in outs:
-            m = re.findall(r'\(Channel (\d+)\)', outs, re.MULTILINE)
-            if m:
-                result = int(m[0])
-        return result
-
-    def set_channel(self, channel):
-        cmd = 'iwconfig {} channel {}'.format(self.interface, channel)
-        Dot11HunterUtils.run_cmd(cmd)
+        max_channel = settings.get().dot11.max_channel
+        self.channels = [ch for ch in self.control.channels()
+                         if ch <= max_channel]
+
+
+def partition_channels(available, anchors):
+    # Channels of each interface, given the channels each one offers. With
+    # several interfaces, each anchor channel gets an interface parked on
+    # it, as long as one is left to hop; the hopping interfaces share the
+    # other channels, anchors left over included, spread so that each one
+    # spans the band. The interfaces offering the fewest channels are
+    # parked first; channels only a parked interface offers are not
+    # visited.
+    shares = [[] for _ in available]
+    if len(available) == 1:
+        return [list(available[0])]
+    hoppers = list(range(len(available)))
+    parked = set()
+    for anchor in anchors:
+        if len(hoppers) == 1:
+            break
+        candidates = [i for i in hoppers if anchor in available[i]]
+        if not candidates:
+            continue
+        i = min(candidates, key=lambda i: len(available[i]))
+        shares[i].append(anchor)
+        hoppers.remove(i)
+        parked.add(anchor)
+    channels = sorted(set(ch for i in hoppers for ch in available[i]) -
+                      parked)
+    for ch in channels:
+        i = min((i for i in hoppers if ch in available[i]),
+                key=lambda i: len(shares[i]))
+        shares[i].append(ch)
+    for i in hoppers:
+        if not shares[i]:
+            # more hopping interfaces than channels, double one up
+            shares[i].append(available[i][0])
+    return shares
+
+
+class ChannelCoordinator:
+    # A ChannelSwitch per capture source over its share of the channels,
+    # see partition_channels. Sources replaying a pcap file get a fake
+    # radio, so the coordination runs without hardware.
+    def __init__(self, sources):
+        self.sources = sources
+        self.switches = []
+        self.log_extra = {'thread_name': 'ChannelCoordinator'}
+
+    def start(self):
+        max_channel = settings.get().dot11.max_channel
+        usable = []     # (source, control, channels it offers)
+        for source in self.sources:
+            try:
+                if source.replay:
+                    control = FakeChannelControl()
+                else:
+                    control = create_channel_control(source.interface)
+                channels = [ch for ch in control.channels()
+                            if ch <= max_channel]
+            except Exception as e:
+                logger.critical('{}: {}'.format(source.interface, str(e)),
+                                extra=self.log_extra)
+                continue
+            if not channels:
+                logger.critical('no channel available on {}'.format(
+                    source.interface), extra=self.log_extra)
+                continue
+            usable.append((source, control, channels))
+        if not usable:
+            return
+        shares = partition_channels([u[2] for u in usable],
+                                    settings.get().channel.anchors)
+        dropped = set().union(*(u[2] for u in usable)) - \
+            set().union(*shares)
+        if dropped:
+            logger.warning('channels {} are offered only by parked '
+                           'interfaces and will not be visited'.format(
+                               ', '.join(map(str, sorted(dropped)))),
+                           extra=self.log_extra)
+        for (source, control, _), share in zip(usable, shares):
+            logger.info('{} on channels {}'.format(
+                source.interface, ', '.join(map(str, share))),
+                extra=self.log_extra)
+            switch = ChannelSwitch(source.interface, source.frames,
+                                   source.macs, control=control,
+                                   channels=share)
+            self.switches.append(switch)
+            switch.start()
+
+    def current_channels(self):
+        return [(s.interface, s.current_channel) for s in self.switches]
 
+    def join(self):
+        for switch in self.switches:
+            switch.join()
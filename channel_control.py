@@ -0,0 +1,253 @@
+import errno
+import os
+import re
+import socket
+import struct
+import time
+import settings
+from base import Dot11HunterUtils
+
+# Channel control of the monitor interface. The nl80211 backend talks to
+# the kernel over a generic netlink socket, so a hop is one sendmsg/recv
+# instead of forking iwconfig and iwlist. The current channel is the one
+# last set successfully, not re-queried. iwconfig keeps the wireless tools
+# for drivers without nl80211, fake is an in-memory radio for tests and
+# benchmarks.
+
+NETLINK_GENERIC = 16
+NLMSG_HEADER = struct.Struct('=IHHII')     # len, type, flags, seq, pid
+GENL_HEADER = struct.Struct('=BBH')        # cmd, version, reserved
+NLA_HEADER = struct.Struct('=HH')          # len, type
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 0x02
+NLMSG_DONE = 0x03
+NLA_TYPE_MASK = 0x3fff  # without the nested and byte order flags
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+NL80211_CMD_GET_WIPHY = 1
+NL80211_CMD_SET_WIPHY = 2
+NL80211_CMD_GET_INTERFACE = 5
+NL80211_ATTR_WIPHY = 1
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_WIPHY_BANDS = 22
+NL80211_ATTR_WIPHY_FREQ = 38
+NL80211_ATTR_WIPHY_CHANNEL_TYPE = 39
+NL80211_ATTR_SPLIT_WIPHY_DUMP = 174
+NL80211_BAND_ATTR_FREQS = 1
+NL80211_FREQUENCY_ATTR_FREQ = 1
+NL80211_FREQUENCY_ATTR_DISABLED = 2
+NL80211_CHAN_NO_HT = 0
+
+
+def create_channel_control(interface):
+    backend = settings.get().channel.control
+    if backend == 'fake':
+        return FakeChannelControl()
+    if backend == 'iwconfig':
+        return WirelessToolsChannelControl(interface)
+    return Nl80211ChannelControl(interface)
+
+
+def channel_to_freq(channel):
+    # MHz of a 2.4 or 5 GHz channel
+    if channel == 14:
+        return 2484
+    if channel < 14:
+        return 2407 + channel * 5
+    return 5000 + channel * 5
+
+
+def freq_to_channel(freq):
+    if freq == 2484:
+        return 14
+    if freq < 2484:
+        return (freq - 2407) // 5
+    return (freq - 5000) // 5
+
+
+def nla(attr_type, payload):
+    # One netlink attribute, padded to 4 bytes
+    data = NLA_HEADER.pack(NLA_HEADER.size + len(payload), attr_type) + \
+        payload
+    return data + bytes(-len(data) % 4)
+
+
+def iter_attrs(data):
+    # (type, payload) of the attributes in data
+    offset = 0
+    while offset + NLA_HEADER.size <= len(data):
+        length, attr_type = NLA_HEADER.unpack_from(data, offset)
+        if length < NLA_HEADER.size:
+            break
+        yield attr_type & NLA_TYPE_MASK, \
+            data[offset + NLA_HEADER.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def attrs(data):
+    return dict(iter_attrs(data))
+
+
+def u32(value):
+    return struct.pack('=I', value)
+
+
+class GenericNetlink:
+    # Requests on a generic netlink socket, one at a time
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                  NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.seq = 0
+
+    def family_id(self, name):
+        reply = self.request(GENL_ID_CTRL, CTRL_CMD_GETFAMILY,
+                             nla(CTRL_ATTR_FAMILY_NAME,
+                                 name.encode() + b'\0'))
+        return struct.unpack('=H', reply[0][CTRL_ATTR_FAMILY_ID][:2])[0]
+
+    def request(self, family, cmd, payload=b'', dump=False):
+        # Returns the attributes of the replies, raises OSError on a
+        # netlink error
+        self.seq += 1
+        flags = NLM_F_REQUEST | NLM_F_ACK | (NLM_F_DUMP if dump else 0)
+        body = GENL_HEADER.pack(cmd, 1, 0) + payload
+        self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(body),
+                                         family, flags, self.seq, 0) + body)
+        replies = []
+        while True:
+            data = self.sock.recv(1 << 16)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, msg_type, _, seq, _ = NLMSG_HEADER.unpack_from(
+                    data, offset)
+                if length < NLMSG_HEADER.size:
+                    raise OSError(errno.EIO, 'truncated netlink message')
+                msg = data[offset + NLMSG_HEADER.size:offset + length]
+                offset += (length + 3) & ~3
+                if seq != self.seq:
+                    continue
+                if msg_type == NLMSG_DONE:
+                    return replies
+                if msg_type == NLMSG_ERROR:
+                    error = struct.unpack_from('=i', msg)[0]
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return replies  # ack
+                replies.append(attrs(msg[GENL_HEADER.size:]))
+
+    def close(self):
+        self.sock.close()
+
+
+class Nl80211ChannelControl:
+    def __init__(self, interface):
+        self.interface = interface
+        self.ifindex = socket.if_nametoindex(interface)
+        self.netlink = GenericNetlink()
+        try:
+            self.family = self.netlink.family_id('nl80211')
+        except OSError as e:
+            self.netlink.close()
+            raise OSError(e.errno, 'nl80211 is not available ({}), try '
+                          '[CHANNEL] control = iwconfig'.format(e.strerror))
+        reply = self.netlink.request(
+            self.family, NL80211_CMD_GET_INTERFACE,
+            nla(NL80211_ATTR_IFINDEX, u32(self.ifindex)))[0]
+        self.wiphy = struct.unpack('=I', reply[NL80211_ATTR_WIPHY])[0]
+        self.current = None
+        if NL80211_ATTR_WIPHY_FREQ in reply:
+            self.current = freq_to_channel(
+                struct.unpack('=I', reply[NL80211_ATTR_WIPHY_FREQ])[0])
+
+    def channels(self):
+        # Enabled channels of the interface's wiphy. A split dump, the
+        # bands may come over several messages.
+        replies = self.netlink.request(
+            self.family, NL80211_CMD_GET_WIPHY,
+            nla(NL80211_ATTR_WIPHY, u32(self.wiphy)) +
+            nla(NL80211_ATTR_SPLIT_WIPHY_DUMP, b''), dump=True)
+        result = set()
+        for reply in replies:
+            if NL80211_ATTR_WIPHY_BANDS not in reply:
+                continue
+            for _, band in iter_attrs(reply[NL80211_ATTR_WIPHY_BANDS]):
+                freqs = attrs(band).get(NL80211_BAND_ATTR_FREQS)
+                if freqs is None:
+                    continue
+                for _, freq in iter_attrs(freqs):
+                    freq = attrs(freq)
+                    if NL80211_FREQUENCY_ATTR_FREQ not in freq or \
+                            NL80211_FREQUENCY_ATTR_DISABLED in freq:
+                        continue
+                    result.add(freq_to_channel(struct.unpack(
+                        '=I', freq[NL80211_FREQUENCY_ATTR_FREQ])[0]))
+        return sorted(result)
+
+    def set_channel(self, channel):
+        self.netlink.request(
+            self.family, NL80211_CMD_SET_WIPHY,
+            nla(NL80211_ATTR_IFINDEX, u32(self.ifindex)) +
+            nla(NL80211_ATTR_WIPHY_FREQ, u32(channel_to_freq(channel))) +
+            nla(NL80211_ATTR_WIPHY_CHANNEL_TYPE, u32(NL80211_CHAN_NO_HT)))
+        self.current = channel
+
+    def close(self):
+        self.netlink.close()
+
+
+class WirelessToolsChannelControl:
+    # iwlist and iwconfig, only setting a channel forks
+    def __init__(self, interface):
+        self.interface = interface
+        self.current = None
+
+    def channels(self):
+        cmd = 'iwlist {} channel'.format(self.interface)
+        outs, errs = Dot11HunterUtils.run_cmd(cmd)
+        if 'channels' not in outs:
+            return []
+        m = re.search(r'\(Channel (\d+)\)', outs)
+        if m:
+            self.current = int(m.group(1))
+        return sorted(set(int(ch) for ch in
+                          re.findall(r'Channel (\d+) :', outs)))
+
+    def set_channel(self, channel):
+        cmd = 'iwconfig {} channel {}'.format(self.interface, channel)
+        outs, errs = Dot11HunterUtils.run_cmd(cmd)
+        if errs:
+            raise OSError(errno.EIO, errs.strip())
+        self.current = channel
+
+    def close(self):
+        pass
+
+
+class FakeChannelControl:
+    # Radio without hardware: the channels it offers, what was set and
+    # when, and an optional delay per switch
+    def __init__(self, channels=tuple(range(1, 14)), switch_time=0):
+        self.available = list(channels)
+        self.switch_time = switch_time
+        self.current = None
+        self.history = []   # (time, channel)
+
+    def channels(self):
+        return list(self.available)
+
+    def set_channel(self, channel):
+        if channel not in self.available:
+            raise OSError(errno.EINVAL, 'channel {} not available'.format(
+                channel))
+        if self.switch_time:
+            time.sleep(self.switch_time)
+        self.current = channel
+        self.history.append((time.time(), channel))
+
+    def close(self):
+        pass
@@ -0,0 +1,76 @@
+-- SQLite schema for the sqlite storage backend, same tables and columns as
+-- dot11hunter.sql with the migrations up to schema_version 2. It is applied
+-- on every start, so additions must be IF NOT EXISTS / OR IGNORE.
+
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER PRIMARY KEY,
+  applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS mac (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  addr INTEGER NOT NULL,
+  first_seen TIMESTAMP DEFAULT NULL,
+  last_seen TIMESTAMP DEFAULT NULL,
+  count INTEGER NOT NULL,
+  oui_id INTEGER DEFAULT NULL,
+  from_mgmt INTEGER DEFAULT NULL,
+  from_data INTEGER DEFAULT NULL,
+  from_ctrl INTEGER DEFAULT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS mac_addr_UNIQUE ON mac (addr);
+
+CREATE TABLE IF NOT EXISTS ap (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  ssid TEXT DEFAULT NULL,
+  mac_id INTEGER DEFAULT NULL,
+  first_seen TIMESTAMP DEFAULT NULL,
+  last_seen TIMESTAMP DEFAULT NULL,
+  count INTEGER NOT NULL,
+  from_probe_req INTEGER DEFAULT NULL,
+  from_probe_resp INTEGER DEFAULT NULL,
+  from_beacon INTEGER DEFAULT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ap_mac_id_ssid_UNIQUE ON ap (mac_id, ssid);
+CREATE INDEX IF NOT EXISTS ap_ssid_idx ON ap (ssid);
+
+CREATE TABLE IF NOT EXISTS association (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  mac_id INTEGER NOT NULL,
+  ap_id INTEGER NOT NULL,
+  first_seen TIMESTAMP DEFAULT NULL,
+  last_seen TIMESTAMP DEFAULT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS association_mac_id_ap_id_UNIQUE
+  ON association (mac_id, ap_id);
+
+CREATE TABLE IF NOT EXISTS geo (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  mac_id INTEGER NOT NULL,
+  latitude REAL DEFAULT NULL,
+  longitude REAL DEFAULT NULL,
+  seen TIMESTAMP DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS geo_bin (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  mac_id INTEGER NOT NULL,
+  geohash TEXT NOT NULL,
+  bucket TIMESTAMP DEFAULT NULL,
+  latitude REAL DEFAULT NULL,
+  longitude REAL DEFAULT NULL,
+  first_seen TIMESTAMP DEFAULT NULL,
+  last_seen TIMESTAMP DEFAULT NULL,
+  count INTEGER NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS geo_bin_mac_id_geohash_bucket_UNIQUE
+  ON geo_bin (mac_id, geohash, bucket);
+
+CREATE TABLE IF NOT EXISTS oui (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  ouicol INTEGER NOT NULL UNIQUE,
+  name TEXT DEFAULT NULL
+);
+
+INSERT OR IGNORE INTO schema_version (version) VALUES (1);
+INSERT OR IGNORE INTO schema_version (version) VALUES (2);
@@ -0,0 +1,82 @@
+-- Migration 1: unique lookup keys on mac, ap and association
+--
+-- event.py looks rows up by mac.addr, ap(mac_id, ssid), ap.ssid and
+-- association(mac_id, ap_id), and writes them with
+-- INSERT ... ON DUPLICATE KEY UPDATE, which needs these keys.
+-- Duplicated rows are merged into the one with the lowest id first.
+
+CREATE TABLE IF NOT EXISTS `schema_version` (
+  `version` smallint(5) unsigned NOT NULL,
+  `applied` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+-- mac: merge rows with the same addr
+CREATE TEMPORARY TABLE `mac_keep` AS
+  SELECT addr, MIN(id) AS keep_id, MIN(first_seen) AS first_seen,
+         MAX(last_seen) AS last_seen, SUM(count) AS count,
+         MAX(from_mgmt) AS from_mgmt, MAX(from_data) AS from_data,
+         MAX(from_ctrl) AS from_ctrl
+  FROM mac GROUP BY addr HAVING COUNT(*) > 1;
+CREATE TEMPORARY TABLE `mac_dup` AS
+  SELECT mac.id, mac_keep.keep_id FROM mac
+  JOIN mac_keep ON mac.addr=mac_keep.addr AND mac.id<>mac_keep.keep_id;
+UPDATE ap JOIN mac_dup ON ap.mac_id=mac_dup.id SET ap.mac_id=mac_dup.keep_id;
+UPDATE geo JOIN mac_dup ON geo.mac_id=mac_dup.id
+  SET geo.mac_id=mac_dup.keep_id;
+UPDATE association JOIN mac_dup ON association.mac_id=mac_dup.id
+  SET association.mac_id=mac_dup.keep_id;
+UPDATE mac JOIN mac_keep ON mac.id=mac_keep.keep_id
+  SET mac.first_seen=mac_keep.first_seen, mac.last_seen=mac_keep.last_seen,
+      mac.count=LEAST(mac_keep.count, 16777215),
+      mac.from_mgmt=mac_keep.from_mgmt, mac.from_data=mac_keep.from_data,
+      mac.from_ctrl=mac_keep.from_ctrl;
+DELETE mac FROM mac JOIN mac_dup ON mac.id=mac_dup.id;
+
+-- ap: merge rows with the same (mac_id, ssid)
+CREATE TEMPORARY TABLE `ap_keep` AS
+  SELECT mac_id, ssid, MIN(id) AS keep_id, MIN(first_seen) AS first_seen,
+         MAX(last_seen) AS last_seen, SUM(count) AS count,
+         MAX(from_probe_req) AS from_probe_req,
+         MAX(from_probe_resp) AS from_probe_resp,
+         MAX(from_beacon) AS from_beacon
+  FROM ap WHERE mac_id IS NOT NULL
+  GROUP BY mac_id, ssid HAVING COUNT(*) > 1;
+CREATE TEMPORARY TABLE `ap_dup` AS
+  SELECT ap.id, ap_keep.keep_id FROM ap
+  JOIN ap_keep ON ap.mac_id=ap_keep.mac_id AND ap.ssid=ap_keep.ssid
+  AND ap.id<>ap_keep.keep_id;
+UPDATE association JOIN ap_dup ON association.ap_id=ap_dup.id
+  SET association.ap_id=ap_dup.keep_id;
+UPDATE ap JOIN ap_keep ON ap.id=ap_keep.keep_id
+  SET ap.first_seen=ap_keep.first_seen, ap.last_seen=ap_keep.last_seen,
+      ap.count=LEAST(ap_keep.count, 16777215),
+      ap.from_probe_req=ap_keep.from_probe_req,
+      ap.from_probe_resp=ap_keep.from_probe_resp,
+      ap.from_beacon=ap_keep.from_beacon;
+DELETE ap FROM ap JOIN ap_dup ON ap.id=ap_dup.id;
+
+-- association: merge rows with the same (mac_id, ap_id)
+CREATE TEMPORARY TABLE `association_keep` AS
+  SELECT mac_id, ap_id, MIN(id) AS keep_id, MIN(first_seen) AS first_seen,
+         MAX(last_seen) AS last_seen
+  FROM association GROUP BY mac_id, ap_id HAVING COUNT(*) > 1;
+UPDATE association JOIN association_keep
+  ON association.id=association_keep.keep_id
+  SET association.first_seen=association_keep.first_seen,
+      association.last_seen=association_keep.last_seen;
+DELETE association FROM association JOIN association_keep
+  ON association.mac_id=association_keep.mac_id
+  AND association.ap_id=association_keep.ap_id
+  AND association.id<>association_keep.keep_id;
+
+ALTER TABLE `mac` ADD UNIQUE KEY `addr_UNIQUE` (`addr`);
+ALTER TABLE `ap` ADD UNIQUE KEY `mac_id_ssid_UNIQUE` (`mac_id`, `ssid`),
+  ADD KEY `ssid_idx` (`ssid`);
+ALTER TABLE `association`
+  ADD UNIQUE KEY `mac_id_ap_id_UNIQUE` (`mac_id`, `ap_id`);
+
+DROP TEMPORARY TABLE `mac_keep`, `mac_dup`, `ap_keep`, `ap_dup`,
+  `association_keep`;
+
+INSERT INTO `schema_version` (`version`) VALUES (1);
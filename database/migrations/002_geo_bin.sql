@@ -0,0 +1,22 @@
+-- Migration 2: geo_bin, geo rows aggregated by geohash cell and time bucket
+--
+-- With [LOCATION] geo_rows = binned, event.py folds the sightings of a mac
+-- address into one row per geohash cell and time bucket instead of a geo
+-- row every geo_update_interval, and writes it with
+-- INSERT ... ON DUPLICATE KEY UPDATE on (mac_id, geohash, bucket).
+
+CREATE TABLE IF NOT EXISTS `geo_bin` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+  `mac_id` mediumint(8) unsigned NOT NULL,
+  `geohash` varchar(12) NOT NULL COMMENT 'geohash of the cell',
+  `bucket` timestamp NULL DEFAULT NULL COMMENT 'start of the time bucket',
+  `latitude` decimal(9,6) DEFAULT NULL COMMENT 'mean latitude',
+  `longitude` decimal(9,6) DEFAULT NULL COMMENT 'mean longitude',
+  `first_seen` timestamp NULL DEFAULT NULL,
+  `last_seen` timestamp NULL DEFAULT NULL,
+  `count` int(10) unsigned NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `mac_id_geohash_bucket_UNIQUE` (`mac_id`, `geohash`, `bucket`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+INSERT INTO `schema_version` (`version`) VALUES (2);
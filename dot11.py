@@ -0,0 +1,171 @@
+import struct
+
+# Decode the fields Dot11Hunter needs straight from radiotap+802.11 bytes,
+# without building scapy packets on the handler hot path.
+
+RT_PRESENT_TSFT = 0x01
+RT_PRESENT_FLAGS = 0x02
+RT_PRESENT_EXT = 0x80000000
+RT_FLAGS_FCS = 0x10
+
+FC_TO_DS = 0x01
+FC_FROM_DS = 0x02
+
+MGMT = 0
+CTRL = 1
+DATA = 2
+
+ELT_SSID = 0
+MAX_SSID_LEN = 32
+
+BROADCAST = 0xffffffffffff
+
+# Offset of the first information element in the management frame body,
+# fixed fields (timestamp, beacon interval, capabilities...) are skipped
+MGMT_ELT_OFFSET = {
+    0x00: 4,    # association request
+    0x01: 6,    # association response
+    0x02: 10,   # reassociation request
+    0x03: 6,    # reassociation response
+    0x04: 0,    # probe request
+    0x05: 12,   # probe response
+    0x08: 12,   # beacon
+}
+# Control frames carrying a transmitter address
+CTRL_WITH_ADDR2 = (0x18, 0x19, 0x1A, 0x1B, 0x1E, 0x1F)
+
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+
+
+class Dot11Frame:
+    __slots__ = ('buf', 'type_subtype', 'flags', 'addr1', 'addr2', 'addr3',
+                 'addr4', 'seq', 'body', 'end')
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.type_subtype = None
+        self.flags = 0
+        self.addr1 = None
+        self.addr2 = None
+        self.addr3 = None
+        self.addr4 = None
+        self.seq = None
+        self.body = None    # offset of the frame body in buf
+        self.end = len(buf)    # end of the frame body, FCS excluded
+
+    @property
+    def frame_type(self):
+        return self.type_subtype >> 4
+
+    def elements(self):
+        # Information elements of a management frame as (id, bytes)
+        if self.frame_type != MGMT or self.body is None:
+            return
+        offset = MGMT_ELT_OFFSET.get(self.type_subtype)
+        if offset is None:
+            return
+        yield from iter_elements(self.buf, self.body + offset, self.end)
+
+    def element(self, elt_id):
+        for i, info in self.elements():
+            if i == elt_id:
+                return info
+        return None
+
+    @property
+    def ssid(self):
+        info = self.element(ELT_SSID)
+        if info is None or len(info) > MAX_SSID_LEN:
+            return None
+        # SSIDs are raw bytes, often not UTF-8 in the wild
+        return info.decode('utf8', 'replace')
+
+
+def read_mac(buf, offset):
+    # MAC addresses are handled as 48-bit ints from decoding to database
+    return int.from_bytes(buf[offset:offset + 6], 'big')
+
+
+def mac_str(addr):
+    # 48-bit int to the usual aa:bb:cc:dd:ee:ff form, for logs
+    if addr is None:
+        return None
+    return addr.to_bytes(6, 'big').hex(':')
+
+
+def radiotap_header(buf):
+    # Returns (length of radiotap header, radiotap flags)
+    if len(buf) < 8 or buf[0] != 0:
+        raise ValueError('bad radiotap header')
+    rt_len = U16.unpack_from(buf, 2)[0]
+    present = U32.unpack_from(buf, 4)[0]
+    offset = 8
+    # Skip extended presence bitmaps
+    ext = present
+    while ext & RT_PRESENT_EXT:
+        ext = U32.unpack_from(buf, offset)[0]
+        offset += 4
+    flags = 0
+    if present & RT_PRESENT_FLAGS:
+        if present & RT_PRESENT_TSFT:
+            offset = (offset + 7) & ~7
+            offset += 8
+        if offset < rt_len:
+            flags = buf[offset]
+    return rt_len, flags
+
+
+def decode(buf):
+    # Decode radiotap+802.11 bytes, returns None for a truncated frame,
+    # including a control frame cut before the transmitter address
+    buf = bytes(buf)
+    try:
+        rt_len, rt_flags = radiotap_header(buf)
+    except (ValueError, struct.error):
+        return None
+    frame = Dot11Frame(buf)
+    if rt_flags & RT_FLAGS_FCS:
+        frame.end -= 4
+    size = frame.end - rt_len
+    if size < 10:
+        return None
+    fc = buf[rt_len]
+    frame_type = fc >> 2 & 0x03
+    frame.type_subtype = frame_type * 16 + (fc >> 4)
+    frame.flags = buf[rt_len + 1]
+    frame.addr1 = read_mac(buf, rt_len + 4)
+    if frame_type == CTRL:
+        if frame.type_subtype in CTRL_WITH_ADDR2:
+            if size < 16:
+                return None
+            frame.addr2 = read_mac(buf, rt_len + 10)
+        return frame
+    if size < 24:
+        return None
+    frame.addr2 = read_mac(buf, rt_len + 10)
+    frame.addr3 = read_mac(buf, rt_len + 16)
+    frame.seq = U16.unpack_from(buf, rt_len + 22)[0] >> 4
+    header = 24
+    if frame_type == DATA:
+        if frame.flags & FC_TO_DS and frame.flags & FC_FROM_DS:
+            if size < 30:
+                return None
+            frame.addr4 = read_mac(buf, rt_len + 24)
+            header += 6
+        if frame.type_subtype & 0x08:
+            header += 2    # QoS control
+    frame.body = rt_len + header
+    return frame
+
+
+def iter_elements(buf, offset, end):
+    # Walk the TLV list of information elements, stops at a truncated one
+    while offset + 2 <= end:
+        elt_id = buf[offset]
+        length = buf[offset + 1]
+        offset += 2
+        if offset + length > end:
+            return
+        yield elt_id, buf[offset:offset + length]
+        offset += length
@@ -1,34 +1,44 @@
 import argparse
-import json
 import socket
 import sys
 import queue
 import time
-import scapy
-from datetime import datetime
-from scapy.all import Dot11, Dot11FCS
 from handler import create_handlers
 from base import Dot11HunterBase, GeoFrame, FrameSubType, RepeatedTimer
-from base import CFG, logger, Dot11HunterUtils
-from channel import ChannelSwitch
+from base import logger, Dot11HunterUtils
+from channel import ChannelCoordinator
 from bt_server import BtServer
+from capture import CaptureSource
+from event import Dot11Event
+from ingest import ingest
+from metrics import REGISTRY, start_server
+from migrate import check_schema
+from pipeline import ProcessPipeline
+from profiler import Profiler
+from sampling import SamplingController
+import settings
+from status import LiveStats, RemoteStats, status_payload
 
 
 class Dot11Hunter(Dot11HunterBase):
     # Sniff 802.11 frames and dispatch to handlers by queue
-    def __init__(self):
+    def __init__(self, args=None):
         super().__init__()
         self.setName('Dot11Hunter')
         self.log_extra = {'thread_name': self.getName()}
-        self.interface = None
-        self.channel_switch = None
+        self.interfaces = None
+        self.read_paths = None  # offline ingestion
+        self.coordinator = None     # channel switch of every interface
         self.handlers = []
         self.bt_server = None
+        self.sources = []   # capture thread of every interface
         self.time_synchronized = False
-        self.crnt_location = {'longitude': None, 'latitude': None,
-                              'timestamp': None}
         self.frame_counters = dict()  # for sampling
         self.frm_queues = dict()  # frame queues
+        self.pipeline = None    # parser and persistence processes
+        self.sampler = None     # sampling intervals, adaptive or not
+        self.profiler = None
+        self.live_stats = None  # status totals kept by EventHandler
         self.log_frame_counters = {
             'data': 0,
             'beacon': 0,
@@ -36,37 +46,141 @@ class Dot11Hunter(Dot11HunterBase):
             'ctrl': 0,
             'mgmt': 0
         }
-        self.parse_arg()
-        self.event_queue = queue.Queue(
-            maxsize=CFG['DEFAULT'].getint('event_queue_max_size'))
-        self.init_attributes()
+        # frames dropped because their queue (ring) was full
+        self.drop_counters = dict.fromkeys(self.log_frame_counters, 0)
+        # cumulative, for metrics: frames by type/sub_type (a plain list
+        # keeps dispatch cheap) and drops by frame type
+        self.subtype_frames = [0] * 64
+        # frames and new MACs by interface at the last log
+        self.logged_sources = dict()
+        self.drop_metrics = {
+            t: REGISTRY.counter('dot11hunter_frames_dropped',
+                                'Frames dropped on a full queue',
+                                {'type': t})
+            for t in self.log_frame_counters}
+        REGISTRY.collector('dot11hunter_frames', 'counter',
+                           'Frames captured by 802.11 type/sub_type',
+                           self.collect_subtype_frames)
+        self.parse_arg(args)
+        try:
+            check_schema()
+        except RuntimeError as e:
+            logger.critical(str(e), extra=self.log_extra)
+            sys.exit(1)
+        if self.read_paths is None:
+            self.init_attributes()
 
-    def parse_arg(self):
+    def parse_arg(self, args=None):
         parser = argparse.ArgumentParser(
             description='Dot11Hunter: hunt devices by sniffing 802.11')
-        # Mandatory parameter: interface
-        parser.add_argument('-i', dest='interface', help='monitor interface')
-        args = parser.parse_args()
-        self.interface = args.interface
-        if self.interface is None:
+        # Mandatory parameter: interface, or capture files to ingest
+        parser.add_argument('-i', dest='interfaces', nargs='+',
+                            metavar='INTERFACE',
+                            help='monitor interfaces, pcap:<file> replays a '
+                                 'capture file in place of one')
+        parser.add_argument('-r', dest='read_paths', nargs='+',
+                            metavar='PATH',
+                            help='ingest pcap/pcapng files or directories '
+                                 'of them instead of sniffing')
+        args = parser.parse_args(args)
+        self.interfaces = args.interfaces
+        self.read_paths = args.read_paths
+        if self.interfaces is None and self.read_paths is None:
             parser.print_help()
             sys.exit(0)
 
     def init_attributes(self):
         frame_types = Dot11HunterUtils.get_frame_types()
+        cfg = settings.get().default
+        if cfg.mode == 'process':
+            self.pipeline = ProcessPipeline()
+            self.event_queue = self.pipeline.event_queue
+            self.live_stats = RemoteStats(self.pipeline.status_queue)
+        else:
+            self.event_queue = queue.Queue(maxsize=cfg.event_queue_max_size)
+            self.live_stats = LiveStats()
+            for t in frame_types:
+                self.frm_queues[t] = queue.Queue(
+                    maxsize=cfg.frm_queue_max_size)
+        settings.subscribe(self.apply_settings)
         for t in frame_types:
-            self.frm_queues[t] = queue.Queue(
-                maxsize=CFG['DEFAULT'].getint('frm_queue_max_size'))
             self.frame_counters[t] = 0
+        self.sampler = SamplingController(
+            self.frm_queues, self.event_queue,
+            self.pipeline.rings if self.pipeline is not None else None)
+        help_text = 'Frames or events waiting in a queue'
+        for t, q in self.frm_queues.items():
+            REGISTRY.gauge('dot11hunter_queue_depth', help_text,
+                           {'queue': t}, func=q.qsize)
+        if self.pipeline is not None:
+            for i, ring in enumerate(self.pipeline.rings):
+                REGISTRY.gauge('dot11hunter_queue_depth', help_text,
+                               {'queue': 'ring{}'.format(i)},
+                               func=ring.qsize)
+        REGISTRY.gauge('dot11hunter_queue_depth', help_text,
+                       {'queue': 'event'}, func=self.event_queue.qsize)
+        self.sources = [CaptureSource(interface, self.dispatch)
+                        for interface in dict.fromkeys(self.interfaces)]
+        REGISTRY.collector('dot11hunter_interface_frames', 'counter',
+                           'Frames captured by interface',
+                           lambda: [({'interface': s.interface}, s.frames())
+                                    for s in self.sources])
+        REGISTRY.collector('dot11hunter_interface_new_macs', 'counter',
+                           'New source MACs seen by interface',
+                           lambda: [({'interface': s.interface}, s.macs.new)
+                                    for s in self.sources])
+        self.profiler = Profiler(self.queue_sizes, self.child_pids)
+        self.profiler.install_signals()
+
+    def queue_sizes(self):
+        sizes = {t: q.qsize() for t, q in self.frm_queues.items()}
+        if self.pipeline is not None:
+            for i, ring in enumerate(self.pipeline.rings):
+                sizes['ring{}'.format(i)] = ring.qsize()
+        sizes['event'] = self.event_queue.qsize()
+        return sizes
+
+    def child_pids(self):
+        if self.pipeline is None:
+            return dict()
+        return {p.name: p.pid for p in self.pipeline.processes
+                if p.pid is not None}
+
+    def apply_settings(self, new, old):
+        # Thread mode queues are resized in place, the process mode event
+        # queue and rings keep their size until restart
+        if self.pipeline is not None:
+            return
+        sizes = [(q, new.default.frm_queue_max_size)
+                 for q in self.frm_queues.values()]
+        sizes.append((self.event_queue, new.default.event_queue_max_size))
+        for q, maxsize in sizes:
+            with q.mutex:
+                q.maxsize = maxsize
+                q.not_full.notify_all()
+
+    def collect_subtype_frames(self):
+        return [({'subtype': '0x{:02x}'.format(sts)}, n)
+                for sts, n in enumerate(self.subtype_frames) if n]
 
     def dump_log(self):
         if not self.time_synchronized:
             return
-        logger.info(
-            'is using {}% memory, current channel is {}'.format(
-                Dot11HunterUtils.get_mem_used_by_dot11hunter(),
-                self.channel_switch.current_channel),
+        logger.info('{}, channels: {}'.format(
+            self.profiler.summary(), ', '.join(
+                '{} on {}'.format(interface, ch) for interface, ch in
+                self.coordinator.current_channels())),
             extra=self.log_extra)
+        if len(self.sources) > 1:
+            counts = []
+            for source in self.sources:
+                frames, new_macs = source.frames(), source.macs.new
+                last = self.logged_sources.get(source.interface, (0, 0))
+                counts.append('{} {} frames, {} new MACs'.format(
+                    source.interface, frames - last[0], new_macs - last[1]))
+                self.logged_sources[source.interface] = (frames, new_macs)
+            logger.info('by interface: {}'.format('; '.join(counts)),
+                        extra=self.log_extra)
         logger.info(
             'captured {} beacon, {} probe_req, {} management, {} control, '
             '{} data frames'.format(
@@ -76,75 +190,86 @@ class Dot11Hunter(Dot11HunterBase):
                 self.log_frame_counters['ctrl'],
                 self.log_frame_counters['data']),
             extra=self.log_extra)
+        if any(self.drop_counters.values()):
+            logger.info(
+                'dropped {} beacon, {} probe_req, {} management, {} control, '
+                '{} data frames on full queues'.format(
+                    self.drop_counters['beacon'],
+                    self.drop_counters['probe_req'],
+                    self.drop_counters['mgmt'],
+                    self.drop_counters['ctrl'],
+                    self.drop_counters['data']),
+                extra=self.log_extra)
+        if self.pipeline is not None:
+            logger.info('parser rings hold {} frames, {} events queued'.format(
+                self.pipeline.qsizes(), self.event_queue.qsize()),
+                extra=self.log_extra)
         self.log_frame_counters['beacon'] = 0
         self.log_frame_counters['probe_req'] = 0
         self.log_frame_counters['mgmt'] = 0
         self.log_frame_counters['ctrl'] = 0
         self.log_frame_counters['data'] = 0
+        for k in self.drop_counters.keys():
+            self.drop_counters[k] = 0
 
-    def dispatch(self, frame):
-        beacon_sample_itvl = 1 / CFG['DOT11'].getfloat('beacon_sample_rate')
-        data_sample_itvl = 1 / CFG['DOT11'].getfloat('data_sample_rate')
-        mgmt_sample_itvl = 1 / CFG['DOT11'].getfloat('mgmt_sample_rate')
-        ctrl_sample_itvl = 1 / CFG['DOT11'].getfloat('ctrl_sample_rate')
+    def dispatch(self, frame, ts=None, macs=None):
+        # frame is the raw radiotap+802.11 buffer handed over by the capture
+        # backend. It may be a view into the capture ring, so it is copied
+        # only once it has passed sampling. macs is the MacNovelty of the
+        # capturing interface, the first one's by default. With several
+        # interfaces this runs in each capture thread; a count lost to a
+        # race on the shared counters only shifts sampling or metrics.
+        sts = FrameSubType.get_type_subtype(frame)  # type/sub_type
         # Only parse 802.11 frames
-        if Dot11 not in frame.layers() and Dot11FCS not in frame.layers():
+        if sts is None:
             return
-        sts = FrameSubType.get_type_subtype(frame)  # type/sub_type
-
-        # only location within 10 seconds is valid
-        geo = None
-        if self.crnt_location['timestamp'] is not None:
-            interval = time.time() - self.crnt_location['timestamp']
-            if 0 <= interval <= 10:
-                geo = {'longitude': self.crnt_location['longitude'],
-                       'latitude': self.crnt_location['latitude']}
-        geo_frame = GeoFrame(frame, geo, datetime.now())
+        self.subtype_frames[sts] += 1
+        frm_type = FrameSubType.get_frame_type(sts)
+        if frm_type is None:
+            return
+        self.log_frame_counters[frm_type] += 1
+        # keep one of every intervals[frm_type] frames, see sampling.py
+        if frm_type != 'probe_req':
+            self.frame_counters[frm_type] += 1
+            if self.frame_counters[frm_type] < \
+                    self.sampler.intervals[frm_type]:
+                return
+            self.frame_counters[frm_type] = 0
+        if frm_type != 'ctrl':
+            # addr2, most control frames have none
+            offset = (frame[2] | frame[3] << 8) + 10
+            if macs is None:
+                macs = self.sources[0].macs
+            macs.see(bytes(frame[offset:offset + 6]))
+        # the position is looked up by ts when a GEO row is written
+        if ts is None:
+            ts = time.time()
         try:
-            # Beacon frames are handled independently because it is too
-            # frequent
-            if sts == FrameSubType.BEACON:
-                if self.frame_counters['beacon'] >= beacon_sample_itvl:
-                    self.frm_queues['beacon'].put_nowait(geo_frame)
-                    self.frame_counters['beacon'] = 0
-                else:
-                    self.frame_counters['beacon'] += 1
-                    self.log_frame_counters['beacon'] += 1
-            elif sts == FrameSubType.PROBE_REQ:
-                self.frm_queues['probe_req'].put_nowait(geo_frame)
-                self.log_frame_counters['probe_req'] += 1
-            elif sts in FrameSubType.MGMT:
-                if self.frame_counters['mgmt'] >= mgmt_sample_itvl:
-                    self.frm_queues['mgmt'].put_nowait(geo_frame)
-                    self.frame_counters['mgmt'] = 0
-                else:
-                    self.frame_counters['mgmt'] += 1
-                    self.log_frame_counters['mgmt'] += 1
-            elif sts in FrameSubType.CTRL:
-                if self.frame_counters['ctrl'] >= ctrl_sample_itvl:
-                    self.frm_queues['ctrl'].put_nowait(geo_frame)
-                    self.frame_counters['ctrl'] = 0
-                else:
-                    self.frame_counters['ctrl'] += 1
-                    self.log_frame_counters['ctrl'] += 1
-            elif sts in FrameSubType.DATA:
-                if self.frame_counters['data'] >= data_sample_itvl:
-                    self.frm_queues['data'].put_nowait(geo_frame)
-                    self.frame_counters['data'] = 0
-                else:
-                    self.frame_counters['data'] += 1
-                    self.log_frame_counters['data'] += 1
+            if self.pipeline is None:
+                self.frm_queues[frm_type].put_nowait(
+                    GeoFrame(bytes(frame), ts))
+            else:
+                # copied straight into the shared memory ring
+                self.pipeline.put(frm_type, frame, ts)
         except queue.Full:
-            pass
+            self.drop_counters[frm_type] += 1
+            self.drop_metrics[frm_type].inc()
         except Exception as e:
             logger.critical('{}'.format(str(e)), extra=self.log_extra)
 
     def update_location(self, data):
-        data = json.loads(data)
-        self.crnt_location['longitude'] = data['longitude']
-        self.crnt_location['latitude'] = data['latitude']
-        self.crnt_location['timestamp'] = data['timestamp']/1000
+        # data: a fix from BtServer, longitude, latitude and timestamp (ms)
         ts_phone = data['timestamp'] / 1000
+        # The fix goes to the location timeline of EventHandler, which may
+        # run in the persistence process
+        try:
+            self.event_queue.put(Dot11Event(
+                timestamp=ts_phone, type=Dot11Event.LOCATION,
+                geo={'longitude': data['longitude'],
+                     'latitude': data['latitude']}), timeout=1)
+        except queue.Full:
+            logger.warning('event queue full, location dropped',
+                           extra=self.log_extra)
         if abs(ts_phone - time.time()) > 10 and self.time_synchronized is False:
             str_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts_phone))
             cmd = 'date -s "{}"'.format(str_time)
@@ -160,62 +285,17 @@ class Dot11Hunter(Dot11HunterBase):
                 logger.info('time is correct, no need to synchronize.', extra=self.log_extra)
 
     def send_latest_captures_sys_status(self):
-        data = dict()
-        sql_mac = 'SELECT HEX(addr), last_seen FROM mac order by last_seen desc LIMIT 1'
-        sql_ssid = 'SELECT ssid, last_seen FROM ap order by last_seen desc LIMIT 1'
-        sql_association = 'SELECT HEX(mac.addr), ap.ssid, ' \
-                          'association.last_seen FROM association JOIN mac ' \
-                          'JOIN ap WHERE mac.id=association.mac_id AND ' \
-                          'ap.id=association.ap_id ORDER BY ' \
-                          'association.last_seen DESC LIMIT 1'
-        sql_mac_count = 'SELECT COUNT(id) FROM mac'
-        sql_ap_count = 'SELECT COUNT(id) FROM ap'
-        sql_association_count = 'SELECT COUNT(id) FROM association'
-        sql_geo_count = 'SELECT COUNT(id) FROM geo'
+        # From the totals EventHandler keeps and the last profiler sample,
+        # no database queries
         try:
-            db_conn, db_cursor = Dot11HunterUtils.connect_db()
-            data['mac'] = self.fetch_data_with_lastseen(db_cursor, sql_mac)
-            data['ssid'] = self.fetch_data_with_lastseen(db_cursor, sql_ssid)
-            db_cursor.execute(sql_association)
-            row = db_cursor.fetchall()
-            if row:
-                mac, ssid, date = row[0]
-                if time.time() - date.timestamp() < 60:
-                    data['association'] = '{} <-> {}'.format(mac, ssid)
-                else:
-                    data['association'] = None
-            data['mac_count'] = self.fetch_data(db_cursor, sql_mac_count)
-            data['ap_count'] = self.fetch_data(db_cursor, sql_ap_count)
-            data['geo_count'] = self.fetch_data(db_cursor, sql_geo_count)
-            data['association_count'] = self.fetch_data(db_cursor,
-                                                        sql_association_count)
-            db_conn.close()
-            data['cpu_usage'], data['mem_usage'], data['temperature'] = \
-                Dot11HunterUtils.get_sys_status()
-            self.bt_server.send(json.dumps(data))
+            sample = self.profiler.latest()
+            data = status_payload(
+                self.live_stats.snapshot(),
+                sample.system if sample is not None else None)
+            self.bt_server.send_status(data)
         except Exception as e:
             logger.critical(str(e), extra=self.log_extra)
 
-    @staticmethod
-    def fetch_data_with_lastseen(db_cursor, sql):
-        result = None
-        db_cursor.execute(sql)
-        row = db_cursor.fetchall()
-        if row:
-            temp_result, date = row[0]
-            if time.time() - date.timestamp() < 60:
-                result = temp_result
-        return result
-
-    @staticmethod
-    def fetch_data(db_cursor, sql):
-        result = None
-        db_cursor.execute(sql)
-        row = db_cursor.fetchall()
-        if row:
-            result = row[0][0]
-        return result
-
     def is_internet_connected(self):
         s = socket.socket()
         s.settimeout(8)
@@ -244,6 +324,11 @@ class Dot11Hunter(Dot11HunterBase):
         return result
 
     def run(self):
+        if self.read_paths is not None:
+            ingest(self.read_paths)
+            return
+        start_server()
+        self.profiler.start()
         # start bluetooth server
         self.bt_server = BtServer(recv_callback=self.update_location)
         self.bt_server.start()
@@ -257,20 +342,32 @@ class Dot11Hunter(Dot11HunterBase):
                         extra=self.log_extra)
         while not is_ntpped and not self.time_synchronized:
             time.sleep(1)
-        # start channel switch
-        self.channel_switch = ChannelSwitch(self.interface)
-        self.channel_switch.start()
-        # start handlers
-        self.handlers = create_handlers(self.frm_queues, self.event_queue)
-        for handler in self.handlers:
-            handler.start()
-        # start sniffer
-        logger.info('start sniffing', extra=self.log_extra)
-        scapy.all.conf.iface = self.interface
-        scapy.all.sniff(prn=self.dispatch, store=False)
+        # start a channel switch per interface over its share of channels
+        self.coordinator = ChannelCoordinator(self.sources)
+        self.coordinator.start()
+        # start handlers, as threads or as parser and persistence processes
+        if self.pipeline is None:
+            self.handlers = create_handlers(self.frm_queues, self.event_queue,
+                                            self.live_stats)
+            for handler in self.handlers:
+                handler.start()
+        else:
+            self.pipeline.start()
+        if settings.get().sampling.adaptive:
+            self.sampler.start()
+        # start sniffers
+        logger.info('start sniffing on {}'.format(
+            ', '.join(s.interface for s in self.sources)),
+            extra=self.log_extra)
+        for source in self.sources:
+            source.start()
+        for source in self.sources:
+            source.join()
         for handler in self.handlers:
             handler.join()
-        self.channel_switch.join()
+        if self.pipeline is not None:
+            self.pipeline.join()
+        self.coordinator.join()
 
 
 if __name__ == '__main__':
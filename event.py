@@ -1,19 +1,57 @@
+import queue
+import time
 from datetime import datetime
-from base import Dot11HunterBase, CFG, logger, RepeatedTimer, Dot11HunterUtils
+import settings
+from base import Dot11HunterBase, logger
+from cache import LRUCache, FreshnessCache
+from dot11 import mac_str
+from journal import SpillJournal
+from location import LocationTimeline, GeoBins
+from metrics import REGISTRY
+from status import LiveStats
+from storage import create_storage
+
+MAX_MAC = 1 << 48
+MAX_SSID = 32   # characters of ap.ssid
 
 
 class EventHandler(Dot11HunterBase):
     # Handle event queues to save them in database
-    def __init__(self, event_queue):
+    MAC_ORIGINS = ('from_mgmt', 'from_data', 'from_ctrl')
+    AP_ORIGINS = ('from_probe_req', 'from_probe_resp', 'from_beacon')
+    # An update only widens first_seen..last_seen, so an older capture
+    # ingested into a live database moves neither back
+    FIRST_SEEN = '{least}(COALESCE(first_seen, {new}), {new})'
+    LAST_SEEN = '{greatest}(COALESCE(last_seen, {new}), {new})'
+    # Mean of the stored and inserted positions weighted by their counts,
+    # set before count is updated
+    GEO_MEAN = '({c}*count+{{new}}*{{values[count]}})/' \
+        '(count+{{values[count]}})'
+
+    def __init__(self, event_queue, stats=None):
         super().__init__()
         self.setName('EventHandler')
         self.log_extra = {'thread_name': self.getName()}
         self.event_queue = event_queue
+        cfg = settings.get().mysql
         # Cache current records to lower database burden
-        self.mac_cache = dict()
-        self.ssid_cache = dict()
-        self.asocit_cache = dict()
-        self.geo_cache = dict()
+        max_size = cfg.freshness_cache_max_size
+        self.mac_cache = FreshnessCache(cfg.mac_update_interval, max_size)
+        self.ssid_cache = FreshnessCache(cfg.ap_update_interval, max_size)
+        self.asocit_cache = FreshnessCache(cfg.association_update_interval,
+                                           max_size)
+        self.geo_cache = FreshnessCache(cfg.geo_update_interval, max_size)
+        # mac.addr -> mac.id, rows of mac are never deleted so entries never
+        # go stale
+        self.mac_ids = LRUCache(memory_budget=cfg.mac_id_cache_kb * 1024)
+        # GPS fixes, sent through the event queue as LOCATION events
+        loc = settings.get().location
+        self.timeline = LocationTimeline(loc.timeline_size, loc.max_gap,
+                                         loc.validity)
+        # geo_rows = binned: sightings folded by geohash cell and time bucket
+        self.geo_rows = loc.geo_rows
+        self.geo_bins = GeoBins(loc.geohash_precision, loc.time_bucket,
+                                loc.max_bins)
         self.event_counters = {
             'MAC_new': 0,
             'MAC': 0,
@@ -24,10 +62,137 @@ class EventHandler(Dot11HunterBase):
             'ASSOCIATION_new': 0,
             'ASSOCIATION': 0
         }
-        self.db_conn, self.db_cursor = Dot11HunterUtils.connect_db()
-        self.clear_cache_timer = RepeatedTimer(func=self.clear_cache,
-                                               interval=120)
-        self.clear_cache_timer.start()
+        # Events are written behind in batches, each in one transaction
+        self.batch_size = cfg.batch_size
+        self.batch_latency = cfg.batch_latency
+        self.batch_counters = {
+            'batches': 0,
+            'events': 0,
+            'failed': 0,
+            'flush_time': 0,
+            'max_flush_time': 0
+        }
+        self.storage = create_storage()
+        # Totals and latest rows for the phone status feed, shared with the
+        # main thread or published to the main process
+        self.stats = stats if stats is not None else LiveStats()
+        if not self.stats.seeded:
+            try:
+                self.stats.seed(self.storage)
+                self.storage.commit()
+            except Exception as e:
+                logger.critical('cannot seed status totals: {}'.format(e),
+                                extra=self.log_extra)
+        # Batches the database cannot take now are spilled to disk and
+        # replayed in order, see journal.py
+        self.journal = None
+        self.db_failed = False
+        self.retry_at = 0
+        jnl = settings.get().journal
+        if event_queue is not None and jnl.enabled:
+            self.journal = SpillJournal(jnl.path, jnl.segment_mb << 20,
+                                        jnl.max_mb << 20, jnl.fsync_interval)
+        self.prepare_sql()
+        self.init_metrics()
+        settings.subscribe(self.apply_settings)
+
+    def apply_settings(self, new, old):
+        cfg = new.mysql
+        self.mac_cache.set_threshold(cfg.mac_update_interval)
+        self.ssid_cache.set_threshold(cfg.ap_update_interval)
+        self.asocit_cache.set_threshold(cfg.association_update_interval)
+        self.geo_cache.set_threshold(cfg.geo_update_interval)
+        self.batch_size = cfg.batch_size
+        self.batch_latency = cfg.batch_latency
+        self.timeline.size = new.location.timeline_size
+        self.timeline.max_gap = new.location.max_gap
+        self.timeline.validity = new.location.validity
+        self.geo_bins.precision = new.location.geohash_precision
+        self.geo_bins.bucket = new.location.time_bucket
+        self.geo_bins.max_bins = new.location.max_bins
+        if self.journal is not None:
+            self.journal.segment_bytes = new.journal.segment_mb << 20
+            self.journal.max_bytes = new.journal.max_mb << 20
+            self.journal.fsync_interval = new.journal.fsync_interval
+
+    def init_metrics(self):
+        self.received_metrics = dict()
+        self.written_metrics = dict()
+        for name in ('MAC', 'SSID', 'ASSOCIATION', 'LOCATION'):
+            self.received_metrics[getattr(Dot11Event, name)] = \
+                REGISTRY.counter('dot11hunter_events_received',
+                                 'Events taken from the event queue',
+                                 {'type': name})
+        for name in ('MAC', 'SSID', 'GEO', 'ASSOCIATION'):
+            self.written_metrics[name] = REGISTRY.counter(
+                'dot11hunter_events_written',
+                'Fresh events written to the database', {'type': name})
+        self.db_metrics = dict()
+        for stage in ('mac', 'ssid', 'geo', 'association', 'commit'):
+            self.db_metrics[stage] = REGISTRY.histogram(
+                'dot11hunter_db_seconds',
+                'Database statements of a batch, by event type, and its '
+                'commit', {'stage': stage})
+        self.failed_metric = REGISTRY.counter(
+            'dot11hunter_db_failed_batches', 'Batches rolled back')
+        self.rejected_metric = REGISTRY.counter(
+            'dot11hunter_events_rejected',
+            'Events dropped as unwritable, malformed or refused by the '
+            'database')
+        self.replay_metric = REGISTRY.histogram(
+            'dot11hunter_journal_replay_seconds',
+            'Spilled batches written back to the database')
+        REGISTRY.gauge('dot11hunter_geo_bins', 'Geo bins held in memory',
+                       func=self.geo_bins.__len__)
+        for name, cache in (('mac', self.mac_cache),
+                            ('ssid', self.ssid_cache),
+                            ('association', self.asocit_cache),
+                            ('geo', self.geo_cache),
+                            ('mac_id', self.mac_ids)):
+            labels = {'cache': name}
+            REGISTRY.gauge('dot11hunter_cache_entries', 'Cached entries',
+                           labels, func=cache.__len__)
+            REGISTRY.gauge('dot11hunter_cache_hit_ratio',
+                           'Cache hit ratio since the last log dump',
+                           labels, func=cache.hit_rate)
+
+    def prepare_sql(self):
+        # Upserts are dialect specific, build them once for the backend
+        seen = [('first_seen', self.FIRST_SEEN),
+                ('last_seen', self.LAST_SEEN)]
+        self.sql_upsert_mac = self.storage.upsert_sql(
+            'mac', ('addr', 'first_seen', 'last_seen', 'count') +
+            self.MAC_ORIGINS, ('addr',),
+            dict(seen + [('count', 'count+{new}')] +
+                 [(c, 'COALESCE({new}, ' + c + ')')
+                  for c in self.MAC_ORIGINS]),
+            returning_id=True)
+        self.sql_upsert_ap = self.storage.upsert_sql(
+            'ap', ('ssid', 'mac_id', 'first_seen', 'last_seen', 'count') +
+            self.AP_ORIGINS, ('mac_id', 'ssid'),
+            dict(seen + [('count', 'count+{new}')] +
+                 [(c, 'COALESCE({new}, ' + c + ')')
+                  for c in self.AP_ORIGINS]))
+        # SSID rows without mac_id, by id; each seen value is passed twice
+        dialect = {'new': '%s', 'greatest': self.storage.greatest,
+                   'least': self.storage.least}
+        self.sql_update_ap = \
+            'UPDATE ap SET first_seen={}, last_seen={}, count=count+%s, ' \
+            'from_probe_req=COALESCE(%s, from_probe_req), ' \
+            'from_probe_resp=COALESCE(%s, from_probe_resp), ' \
+            'from_beacon=COALESCE(%s, from_beacon) WHERE id=%s'.format(
+                self.FIRST_SEEN.format(**dialect),
+                self.LAST_SEEN.format(**dialect))
+        self.sql_upsert_association = self.storage.upsert_sql(
+            'association', ('mac_id', 'ap_id', 'first_seen', 'last_seen'),
+            ('mac_id', 'ap_id'), dict(seen))
+        self.sql_upsert_geo_bin = self.storage.upsert_sql(
+            'geo_bin', ('mac_id', 'geohash', 'bucket', 'latitude',
+                        'longitude', 'first_seen', 'last_seen', 'count'),
+            ('mac_id', 'geohash', 'bucket'),
+            dict(seen + [(c, self.GEO_MEAN.format(c=c))
+                         for c in ('latitude', 'longitude')] +
+                 [('count', 'count+{new}')]))
 
     def dump_log(self):
         crnt_size = self.event_queue.qsize()
@@ -44,250 +209,561 @@ class EventHandler(Dot11HunterBase):
                                        self.event_counters['ASSOCIATION_new'],
                                        self.event_counters['ASSOCIATION']),
                     extra=self.log_extra)
+        batches = self.batch_counters['batches']
+        if batches:
+            logger.info('flushed {} batches, {:.1f} events/batch, '
+                        '{:.1f} ms/batch avg, {:.1f} ms max, {} failed'.format(
+                            batches,
+                            self.batch_counters['events'] / batches,
+                            self.batch_counters['flush_time'] * 1000 / batches,
+                            self.batch_counters['max_flush_time'] * 1000,
+                            self.batch_counters['failed']),
+                        extra=self.log_extra)
+        logger.info('mac id cache: {}/{} entries, {} hits, {} misses, '
+                    '{:.1%} hit rate, {} evicted'.format(
+                        len(self.mac_ids), self.mac_ids.max_size,
+                        self.mac_ids.hits, self.mac_ids.misses,
+                        self.mac_ids.hit_rate(), self.mac_ids.evictions),
+                    extra=self.log_extra)
+        for name, cache in (('mac', self.mac_cache),
+                            ('ssid', self.ssid_cache),
+                            ('association', self.asocit_cache),
+                            ('geo', self.geo_cache)):
+            logger.info('{} freshness cache: {} entries, {:.1%} hit rate, '
+                        '{} evicted'.format(name, len(cache), cache.hit_rate(),
+                                            cache.evictions),
+                        extra=self.log_extra)
+            cache.reset_counters()
+        if self.journal is not None:
+            logger.info('spill journal: {} events in {} segments, {} '
+                        'spilled, {} replayed, {} dropped{}'.format(
+                            len(self.journal), len(self.journal.segments),
+                            self.journal.counters['spilled'],
+                            self.journal.counters['replayed'],
+                            self.journal.counters['dropped'],
+                            ', database down' if self.db_failed else ''),
+                        extra=self.log_extra)
+            for k in self.journal.counters:
+                self.journal.counters[k] = 0
         # clear counts
+        self.mac_ids.reset_counters()
         for k in self.event_counters.keys():
             self.event_counters[k] = 0
+        for k in self.batch_counters.keys():
+            self.batch_counters[k] = 0
 
     def run(self):
         while True:
+            batch = self.next_batch()
+            if self.journal is None:
+                self.write(batch)
+                continue
+            # Spilled batches go first, so rows are written in event order
+            if batch:
+                if len(self.journal) or self.db_failed or \
+                        self.behind(len(batch)):
+                    self.journal.append(batch)
+                else:
+                    left = self.write(batch)
+                    if left:
+                        self.set_db_failed()
+                        self.journal.append(left)
+            self.replay()
+            self.journal.sync()
+
+    def write(self, batch):
+        # Write a batch, returns the events left unwritten because the
+        # database failed, [] once all are written
+        start = time.time()
+        left = self.write_apart(batch)
+        elapsed = time.time() - start
+        self.batch_counters['batches'] += 1
+        self.batch_counters['events'] += len(batch)
+        self.batch_counters['flush_time'] += elapsed
+        if elapsed > self.batch_counters['max_flush_time']:
+            self.batch_counters['max_flush_time'] = elapsed
+        return left
+
+    def write_apart(self, batch, halved=False):
+        # A batch rolled back while the database still answers holds an
+        # event the database refuses: it is written again in halves down
+        # to that event, which alone is dropped. Never spilled, it would
+        # fail the same way on every replay.
+        error = self.transact(batch)
+        if error is None:
+            return []
+        try:
+            self.storage.ping()
+        except Exception:
+            logger.critical('{}'.format(str(error)), extra=self.log_extra)
+            return batch
+        if not halved:
+            logger.critical('batch of {} events rolled back: {}, writing it '
+                            'in halves'.format(len(batch), error),
+                            extra=self.log_extra)
+        if len(batch) == 1:
+            self.rejected_metric.inc()
+            logger.error('dropped {!r}: {}'.format(batch[0], error),
+                         extra=self.log_extra)
+            return []
+        half = len(batch) // 2
+        left = self.write_apart(batch[:half], True)
+        if left:
+            return left + batch[half:]
+        return self.write_apart(batch[half:], True)
+
+    def transact(self, batch):
+        # One batch in one transaction, returns the error it was rolled
+        # back on, None once committed
+        try:
+            self.flush(batch)
+            commit_start = time.perf_counter()
+            self.storage.commit()
+            self.db_metrics['commit'].observe(
+                time.perf_counter() - commit_start)
+            self.stats.commit()
+            return None
+        except Exception as e:
+            self.batch_counters['failed'] += 1
+            self.failed_metric.inc()
+            # Ids learnt inside the failed transaction may not exist, and
+            # freshness entries of its rows would keep a retry or a replay
+            # from writing them
+            self.mac_ids.clear()
+            for cache in (self.mac_cache, self.ssid_cache,
+                          self.asocit_cache, self.geo_cache):
+                cache.clear()
+            self.stats.rollback()
             try:
-                while True:
-                    event = self.event_queue.get()
-                    # continue
-                    if event.type == Dot11Event.MAC:
-                        self.event_counters['MAC'] += 1
-                        if self.handle_mac(event):
-                            self.event_counters['MAC_new'] += 1
-                    elif event.type == Dot11Event.SSID:
-                        self.event_counters['SSID'] += 1
-                        if self.handle_ssid(event):
-                            self.event_counters['SSID_new'] += 1
-                    elif event.type == Dot11Event.GEO:
-                        self.event_counters['GEO'] += 1
-                        if self.handle_geo(event):
-                            self.event_counters['GEO_new'] += 1
-                    elif event.type == Dot11Event.ASSOCIATION:
-                        self.event_counters['ASSOCIATION'] += 1
-                        if self.handle_association(event):
-                            self.event_counters['ASSOCIATION_new'] += 1
+                self.storage.rollback()
             except Exception as e:
-                logger.critical('{}'.format(str(e)), extra=self.log_extra)
-
-    def clear_cache(self):
-        # Clear cached records
-        # count = 0
-        for cache in zip([self.mac_cache, self.ssid_cache, self.asocit_cache],
-                         ['mac_update_interval', 'ap_update_interval',
-                          'association_update_interval']):
-            for k in list(cache[0].keys()):
-                delta = datetime.now() - cache[0][k]
-                if delta.seconds >= CFG['MYSQL'].getfloat(cache[1]):
-                    del cache[0][k]
+                logger.critical('{}'.format(str(e)),
+                                extra=self.log_extra)
+            return e
+
+    def behind(self, taken):
+        # The writer falls behind: the event queue, with the batch just
+        # taken from it, is filling up
+        cfg = settings.get()
+        return self.event_queue.qsize() + taken >= \
+            cfg.journal.high_water * cfg.default.event_queue_max_size
+
+    def set_db_failed(self):
+        self.db_failed = True
+        self.retry_at = time.time() + settings.get().journal.retry_interval
+
+    def replay(self):
+        # Write spilled batches back, oldest first, while the database
+        # answers and the event queue has room
+        if not len(self.journal):
+            return
+        if self.db_failed:
+            if time.time() < self.retry_at:
+                return
+            try:
+                self.storage.ping()
+            except Exception as e:
+                logger.warning('database still down: {}'.format(e),
+                               extra=self.log_extra)
+                self.set_db_failed()
+                return
+            self.db_failed = False
+            logger.info('database is back, replaying {} spilled events'
+                        ''.format(len(self.journal)), extra=self.log_extra)
+        cfg = settings.get()
+        low_water = cfg.journal.low_water * cfg.default.event_queue_max_size
+        while len(self.journal) and self.event_queue.qsize() <= low_water:
+            batch = self.journal.peek()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            left = self.write(batch)
+            if not left:
+                self.replay_metric.observe(time.perf_counter() - start)
+                self.journal.ack()
+                continue
+            # The database failed again. Only the events left go back to
+            # the journal, behind newer batches: the upserts do not depend
+            # on the order.
+            if len(left) < len(batch):
+                self.journal.ack()
+                self.journal.append(left)
+            self.set_db_failed()
+            return
+
+    def next_batch(self):
+        # Block for the first event, then keep draining until the batch is
+        # full or batch_latency has passed since the first event. With the
+        # journal, waits at most a second and may return an empty batch.
+        if self.journal is None:
+            batch = [self.event_queue.get()]
+        else:
+            try:
+                batch = [self.event_queue.get(timeout=1)]
+            except queue.Empty:
+                return []
+        deadline = time.time() + self.batch_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.event_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return [event for event in batch if self.accept(event)]
+
+    def accept(self, event):
+        # Events the tables cannot take are dropped before they join a
+        # batch, rather than failing its transaction
+        problem = self.check_event(event)
+        if problem is None:
+            return True
+        self.rejected_metric.inc()
+        logger.warning('dropped {!r}: {}'.format(event, problem),
+                       extra=self.log_extra)
+        return False
+
+    @staticmethod
+    def check_event(event):
+        # What makes an event unwritable, None if nothing
+        if not isinstance(event.timestamp, (int, float)):
+            return 'no timestamp'
+        if event.type == Dot11Event.LOCATION:
+            geo = event.geo
+            if not isinstance(geo, dict) or not all(
+                    isinstance(geo.get(k), (int, float))
+                    for k in ('longitude', 'latitude')):
+                return 'no position'
+            return None
+        if event.type not in (Dot11Event.MAC, Dot11Event.SSID,
+                              Dot11Event.ASSOCIATION):
+            return 'unknown event type'
+        for addr in (event.src, event.dst):
+            if addr is not None and not (
+                    isinstance(addr, int) and 0 <= addr < MAX_MAC):
+                return 'bad address'
+        if event.src is None and event.type != Dot11Event.SSID:
+            return 'no source address'
+        if event.ssid is not None and (
+                not isinstance(event.ssid, str) or len(event.ssid) > MAX_SSID):
+            return 'bad SSID'
+        return None
+
+    def flush(self, batch):
+        # Write a batch of events in one transaction. MACs go first since
+        # SSID, GEO and ASSOCIATION rows refer to them. GEO rows are made
+        # from MAC events, located once the batch's fixes are known.
+        events = {Dot11Event.MAC: [], Dot11Event.SSID: [],
+                  Dot11Event.ASSOCIATION: [], Dot11Event.LOCATION: []}
+        for event in batch:
+            if event.type in events:
+                events[event.type].append(event)
+        for event_type, typed in events.items():
+            self.received_metrics[event_type].inc(len(typed))
+        for event in events[Dot11Event.LOCATION]:
+            self.timeline.add(event.timestamp, event.geo['longitude'],
+                              event.geo['latitude'])
+        for name, event_type, handle in (
+                ('MAC', Dot11Event.MAC, self.handle_mac),
+                ('SSID', Dot11Event.SSID, self.handle_ssid),
+                ('GEO', Dot11Event.MAC, self.handle_geo),
+                ('ASSOCIATION', Dot11Event.ASSOCIATION,
+                 self.handle_association)):
+            typed = events[event_type]
+            start = time.perf_counter()
+            fresh = handle(typed)
+            self.db_metrics[name.lower()].observe(time.perf_counter() - start)
+            self.event_counters[name] += len(typed)
+            self.event_counters[name + '_new'] += fresh
+            self.written_metrics[name].inc(fresh)
+
+    @staticmethod
+    def merge(records, key, event, count, origin=None):
+        # Fold events with the same key: [first_seen, last_seen, count,
+        # origins]
+        record = records.get(key)
+        if record is None:
+            record = [event.timestamp, event.last_seen, 0, set()]
+            records[key] = record
+        record[0] = min(record[0], event.timestamp)
+        record[1] = max(record[1], event.last_seen)
+        record[2] += count
+        if origin is not None:
+            record[3].add(origin)
+
+    @staticmethod
+    def db_time(ts):
+        # Events carry epoch seconds, TIMESTAMP columns take a datetime
+        return datetime.fromtimestamp(ts)
+
+    @staticmethod
+    def origin_flags(origins, columns):
+        # One value per origin column, None keeps the current column value
+        return tuple(True if c in origins else None for c in columns)
 
     @staticmethod
-    def is_fresh(key, timestamp, cache, threshold):
-        result = False
-        if key in cache.keys():
-            delta = timestamp - cache[key]
-            # Ignore the event not fresher enough
-            if delta.days < 0 or \
-                    (delta.days >= 0 and delta.seconds <= threshold):
-                return result
-        result = True
-        cache[key] = timestamp
+    def placeholders(n):
+        return ', '.join(['%s'] * n)
+
+    def fetch_mac_ids(self, mac_addrs):
+        # Resolve mac ids from the identity map, only misses hit the database
+        result = dict()
+        missing = []
+        for addr in set(a for a in mac_addrs if a is not None):
+            id_ = self.mac_ids.get(addr)
+            if id_ is None:
+                missing.append(addr)
+            else:
+                result[addr] = id_
+        if not missing:
+            return result
+        sql = 'SELECT addr, id FROM mac WHERE addr IN ({})'.format(
+            self.placeholders(len(missing)))
+        self.storage.execute(sql, missing)
+        for addr, id_ in self.storage.fetchall():
+            result[addr] = id_
+            self.mac_ids.put(addr, id_)
         return result
 
-    def handle_mac(self, event):
-        # Save and update the mac address
-        result = False
-        mac_addr = int(event.src.replace(':', ''), 16)   # mac is an int
-        thold = CFG['MYSQL'].getfloat('mac_update_interval')
-        if not self.is_fresh(mac_addr, event.timestamp, self.mac_cache, thold):
+    def fetch_ap_ids(self, column, values):
+        # First ap row for each value of column (mac_id or ssid)
+        result = dict()
+        values = list(set(v for v in values if v is not None))
+        if not values:
             return result
-        self.db_cursor = self.db_conn.cursor()
-        sql = 'SELECT id, count FROM mac WHERE addr=%s'
-        self.db_cursor.execute(sql, (mac_addr,))
-        row = self.db_cursor.fetchall()
-        if not row:
-            sql = 'INSERT INTO mac (addr, first_seen, last_seen, count, {}) ' \
-                  'values (%s, %s, %s, %s, %s)'.format(event.origin)
-            data = (mac_addr, event.timestamp, event.timestamp, 1, True)
-            self.db_cursor.execute(sql, data)
-            self.db_conn.commit()
-            result = True
-        else:
-            id_ = row[0][0]
-            last_count = row[0][1]
-            sql = 'UPDATE mac SET last_seen=%s, count=%s, {}=%s WHERE ' \
-                  'id=%s'.format(event.origin)
-            data = (event.timestamp, last_count + 1, True, id_)
-            self.db_cursor.execute(sql, data)
-            self.db_conn.commit()
-            result = True
+        sql = 'SELECT {0}, id FROM ap WHERE {0} IN ({1}) ORDER BY id'.format(
+            column, self.placeholders(len(values)))
+        self.storage.execute(sql, values)
+        for value, id_ in self.storage.fetchall():
+            result.setdefault(value, id_)
         return result
 
-    def fetch_mac_id(self, mac_addr):
-        result = None
-        sql = 'SELECT id FROM mac WHERE addr=%s'
-        self.db_cursor.execute(sql, (mac_addr,))
-        rows = self.db_cursor.fetchall()
-        if rows:
-            result = rows[0][0]
+    def fetch_keys(self, table, column, mac_ids):
+        # (mac_id, column) of the rows of table with these mac ids, to tell
+        # the rows an upsert inserts from the ones it updates
+        mac_ids = list(set(i for i in mac_ids if i is not None))
+        if not mac_ids:
+            return set()
+        sql = 'SELECT mac_id, {} FROM {} WHERE mac_id IN ({})'.format(
+            column, table, self.placeholders(len(mac_ids)))
+        self.storage.execute(sql, mac_ids)
+        return set(tuple(row) for row in self.storage.fetchall())
+
+    def handle_mac(self, events):
+        # Save and update the mac addresses, returns the number of fresh
+        # events written
+        result = 0
+        records = dict()
+        for event in events:
+            mac_addr = event.src
+            count = self.mac_cache.touch(mac_addr, event.timestamp,
+                                         event.count)
+            if count is None:
+                continue
+            self.merge(records, mac_addr, event, count, event.origin)
+            result += 1
+        if not records:
+            return result
+        # Addresses without a row are new, only those missing from the id
+        # cache are looked up
+        known = self.fetch_mac_ids(records.keys())
+        self.stats.add('mac', len(records) - len(known))
+        # addr is a unique key
+        rows = []
+        latest = None
+        for mac_addr, (first, last, count, origins) in records.items():
+            rows.append((mac_addr, self.db_time(first), self.db_time(last),
+                         count) +
+                        self.origin_flags(origins, self.MAC_ORIGINS))
+            if latest is None or last > latest[1]:
+                latest = (mac_addr, last)
+        self.stats.seen('mac', *latest)
+        if len(rows) == 1 and self.storage.upsert_sets_lastrowid:
+            self.storage.execute(self.sql_upsert_mac, rows[0])
+            if rows[0][0] not in self.mac_ids and self.storage.lastrowid:
+                self.mac_ids.put(rows[0][0], self.storage.lastrowid)
+        else:
+            # lastrowid of a multi-row insert only covers one row, ids of
+            # the others are learnt on their first lookup
+            self.storage.executemany(self.sql_upsert_mac, rows)
         return result
 
-    def handle_ssid(self, event):
+    def handle_ssid(self, events):
         # Use ssid as key may result in error when two different APs have same
         # SSID. Thus, MAC address is preferred.
-        result = False
-        mac_addr = event.src
-        if mac_addr is not None:
-            mac_addr = int(event.src.replace(':', ''), 16)
-            cache_key = mac_addr
-        else:
-            mac_addr = None
-            cache_key = event.ssid
-        cache_key = (cache_key, event.origin)
-        thold = CFG['MYSQL'].getfloat('ap_update_interval')
-        if not self.is_fresh(cache_key, event.timestamp, self.ssid_cache, thold):
-            return
-        if mac_addr is not None:
-            insert_flag = True
-            sql = 'SELECT ap.id, ap.ssid, mac.id, ap.count FROM ap JOIN mac ' \
-                  'ON ap.mac_id=mac.id AND mac.addr=%s'
-            self.db_cursor.execute(sql, (mac_addr,))
-            rows = self.db_cursor.fetchall()
-            if not rows:
-                pass
+        result = 0
+        by_mac = dict()     # (mac_addr, ssid) -> record
+        by_ssid = dict()    # ssid -> record, the ssid is from probe_req
+        for event in events:
+            if event.src is not None:
+                mac_addr = event.src
+                cache_key = mac_addr
             else:
-                for row in rows:
-                    id_, ssid, mac_id, count = row
-                    if event.ssid == ssid:
-                        insert_flag = False
-                        sql = 'UPDATE ap SET last_seen=%s, count=%s, {}=%s ' \
-                              'WHERE id=%s'.format(event.origin)
-                        data = (event.timestamp, count+1, True, id_)
-                        self.db_cursor.execute(sql, data)
-                        self.db_conn.commit()
-                        result = True
-                        break
-            if insert_flag:
-                mac_id = self.fetch_mac_id(mac_addr)
-                if mac_id is None and event.origin == 'from_beacon':
-                    raise RuntimeError('Beacon SSID is inserted before MAC')
-                sql = 'INSERT INTO ap (ssid, mac_id, first_seen, last_seen, ' \
-                      'count, {}) ' \
-                      'VALUES (%s, %s, %s, %s, %s, %s)'.format(event.origin)
-                data = (event.ssid, mac_id, event.timestamp, event.timestamp,
-                        1, True)
-                self.db_cursor.execute(sql, data)
-                self.db_conn.commit()
-                result = True
-        else:
-            # The ssid is from probe_req
+                mac_addr = None
+                cache_key = event.ssid
+            cache_key = (cache_key, event.origin)
+            if mac_addr is not None:
+                key = (mac_addr, event.ssid)
+            else:
+                key = event.ssid
+            count = self.ssid_cache.touch(
+                cache_key, event.timestamp, event.count)
+            if count is None:
+                continue
+            if mac_addr is not None:
+                self.merge(by_mac, key, event, count, event.origin)
+            elif event.ssid:
+                # Sometimes the ssid is an empty string
+                self.merge(by_ssid, key, event, count, event.origin)
+            else:
+                continue
+            result += 1
+        upserts = []
+        updates = []
+        inserts = []
+        latest = None
+        for key, record in list(by_mac.items()) + list(by_ssid.items()):
+            if latest is None or record[1] > latest[1]:
+                latest = (key[1] if isinstance(key, tuple) else key,
+                          record[1])
+        if latest is not None:
+            self.stats.seen('ssid', *latest)
+        if by_mac:
+            mac_ids = self.fetch_mac_ids(a for a, _ in by_mac.keys())
+            for (mac_addr, ssid), record in by_mac.items():
+                first, last, count, origins = record
+                flags = self.origin_flags(origins, self.AP_ORIGINS)
+                mac_id = mac_ids.get(mac_addr)
+                if mac_id is None and 'from_beacon' in origins:
+                    logger.warn('Beacon SSID {} is inserted before MAC'
+                                ''.format(ssid), extra=self.log_extra)
+                    continue
+                upserts.append((ssid, mac_id, self.db_time(first),
+                                self.db_time(last), count) + flags)
+        if by_ssid:
             # There may be such error: AP_A has SSID, and STA probes AP_B
             # whose ssid is also SSID, then it is difficult to know which AP
             # SSID belongs to. Here SSID is considered to belong to the
             # first record in database whose ssid=SSID.
-            if not event.ssid:
-                # Sometimes the ssid is an empty string
-                return
-            sql = 'SELECT id, count FROM ap WHERE ssid=%s'
-            self.db_cursor.execute(sql, (event.ssid,))
-            row = self.db_cursor.fetchall()
-            if not row:
-                sql = 'INSERT INTO ap (ssid, first_seen, last_seen, count, '\
-                      '{}) VALUES (%s, %s, %s, %s, %s)'.format(event.origin)
-                data = (event.ssid, event.timestamp, event.timestamp, 1, True)
-                self.db_cursor.execute(sql, data)
-                self.db_conn.commit()
-                result = True
-            else:
-                id_, count = row[0]
-                sql = 'UPDATE ap SET last_seen=%s, count=%s, {}=%s ' \
-                      'WHERE id=%s'.format(event.origin)
-                data = (event.timestamp, count + 1, True, id_)
-                self.db_cursor.execute(sql, data)
-                self.db_conn.commit()
-                result = True
+            # mac_id is NULL for these rows, so the (mac_id, ssid) unique key
+            # does not apply and they are looked up by ssid instead.
+            ap_ids = self.fetch_ap_ids('ssid', by_ssid.keys())
+            for ssid, (first, last, count, origins) in by_ssid.items():
+                flags = self.origin_flags(origins, self.AP_ORIGINS)
+                if ssid in ap_ids:
+                    updates.append((self.db_time(first), self.db_time(first),
+                                    self.db_time(last), self.db_time(last),
+                                    count) + flags + (ap_ids[ssid],))
+                else:
+                    inserts.append((ssid, None, self.db_time(first),
+                                    self.db_time(last), count) + flags)
+            self.stats.add('ap', len(inserts))
+        if upserts:
+            # (mac_id, ssid) is a unique key
+            existing = self.fetch_keys('ap', 'ssid',
+                                       [row[1] for row in upserts])
+            self.stats.add('ap', sum(1 for row in upserts
+                                     if (row[1], row[0]) not in existing))
+            self.storage.executemany(self.sql_upsert_ap, upserts)
+        if updates:
+            self.storage.executemany(self.sql_update_ap, updates)
+        if inserts:
+            sql = 'INSERT INTO ap (ssid, mac_id, first_seen, last_seen, ' \
+                  'count, from_probe_req, from_probe_resp, from_beacon) ' \
+                  'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)'
+            self.storage.executemany(sql, inserts)
         return result
 
-    def handle_geo(self, event):
-        # Save the latitude and longitude of mac address
-        result = False
-        # geo is not available
-        if not event.geo:
-            return result
-        mac_addr = int(event.src.replace(':', ''), 16)  # mac is an int
-        thold = CFG['MYSQL'].getfloat('geo_update_interval')
-        if not self.is_fresh(mac_addr, event.timestamp, self.geo_cache, thold):
-            return result
-        sql = 'SELECT id FROM mac WHERE addr=%s'
-        self.db_cursor = self.db_conn.cursor()
-        self.db_cursor.execute(sql, (mac_addr,))
-        row = self.db_cursor.fetchall()
-        if not row:
-            logger.warn('MAC address {} not found in database'
-                        ''.format(event.src), extra=self.log_extra)
-            result = False
-        else:
-            mac_id = row[0][0]
+    def handle_geo(self, events):
+        # Save the latitude and longitude of mac addresses where their MAC
+        # events were last seen
+        if self.geo_rows == 'binned':
+            return self.handle_geo_bins(events)
+        rows = []
+        fresh = []
+        # no fix received yet
+        if not self.timeline:
+            return 0
+        for event in events:
+            position = self.timeline.position(event.last_seen)
+            if position is None:
+                continue
+            mac_addr = event.src
+            if self.geo_cache.touch(mac_addr, event.last_seen) is None:
+                continue
+            fresh.append((mac_addr, event, position))
+        if not fresh:
+            return 0
+        mac_ids = self.fetch_mac_ids(a for a, _, _ in fresh)
+        for mac_addr, event, (longitude, latitude) in fresh:
+            if mac_addr not in mac_ids:
+                logger.warn('MAC address {} not found in database'
+                            ''.format(mac_str(event.src)),
+                            extra=self.log_extra)
+                continue
+            rows.append((mac_ids[mac_addr], latitude, longitude,
+                         self.db_time(event.last_seen)))
+        if rows:
             sql = 'INSERT INTO geo (mac_id, latitude, longitude, seen) ' \
                   'VALUES (%s, %s, %s, %s)'
-            data = (mac_id, event.geo['latitude'], event.geo['longitude'],
-                    event.timestamp)
-            self.db_cursor.execute(sql, data)
-            self.db_conn.commit()
-            result = True
-        return result
+            self.storage.executemany(sql, rows)
+            self.stats.add('geo', len(rows))
+        return len(rows)
 
-    def get_sta_ap_id(self, src, dst, ssid):
+    def handle_geo_bins(self, events):
+        # Fold the located sightings into bins and write the closed ones,
+        # returns the number of bins written
+        if self.timeline:
+            for event in events:
+                position = self.timeline.position(event.last_seen)
+                if position is None:
+                    continue
+                self.geo_bins.add(event.src, event.last_seen, position[0],
+                                  position[1], event.count)
+        closed = self.geo_bins.pop_closed(time.time())
+        if not closed:
+            return 0
+        mac_ids = self.fetch_mac_ids(key[0] for key, _ in closed)
+        rows = []
+        for (mac_addr, cell, start), record in closed:
+            first, last, count, longitude_sum, latitude_sum = record
+            if mac_addr not in mac_ids:
+                logger.warn('MAC address {} not found in database'
+                            ''.format(mac_str(mac_addr)),
+                            extra=self.log_extra)
+                continue
+            rows.append((mac_ids[mac_addr], cell, self.db_time(start),
+                         latitude_sum / count, longitude_sum / count,
+                         self.db_time(first), self.db_time(last), count))
+        if rows:
+            # Counted as new: a bin is only written again when it was
+            # flushed early past max_bins
+            self.storage.executemany(self.sql_upsert_geo_bin, rows)
+            self.stats.add('geo', len(rows))
+        return len(rows)
+
+    @staticmethod
+    def get_sta_ap_id(src, dst, ssid, mac_ids, ap_ids_by_mac, ap_ids_by_ssid):
+        # Resolve (station, ap) ids of an event from the prefetched ids
         sta_id = None
         ap_id = None
-        src_mac_id = None
-        dst_mac_id = None
         ap_is = None    # 'src' or 'dst'
-        sql_mac_id = 'SELECT id FROM mac WHERE addr=%s'
-        if src:
-            self.db_cursor.execute(sql_mac_id, (src, ))
-            row = self.db_cursor.fetchall()
-            if row:
-                src_mac_id = row[0][0]
-            else:
-                logger.warn('source mac: {} not found'.format(src),
-                            extra=self.log_extra)
-        if dst:
-            self.db_cursor.execute(sql_mac_id, (dst,))
-            row = self.db_cursor.fetchall()
-            if row:
-                dst_mac_id = row[0][0]
-            else:
-                logger.warn('dst mac: {} not found'.format(dst),
-                            extra=self.log_extra)
+        src_mac_id = mac_ids.get(src)
+        dst_mac_id = mac_ids.get(dst)
         if src_mac_id and not ap_id:
-            sql_q = 'SELECT id FROM ap WHERE mac_id=%s'
-            self.db_cursor.execute(sql_q, (src_mac_id, ))
-            row = self.db_cursor.fetchall()
-            if row:
-                ap_id = row[0][0]
+            ap_id = ap_ids_by_mac.get(src_mac_id)
+            if ap_id:
                 ap_is = 'src'
         if ssid and not ap_id:
             # for probe_req only
-            sql_ssid = 'SELECT id FROM ap WHERE ssid=%s'
-            self.db_cursor.execute(sql_ssid, (ssid,))
-            row = self.db_cursor.fetchall()
-            if row:
-                ap_id = row[0][0]
+            ap_id = ap_ids_by_ssid.get(ssid)
+            if ap_id:
                 sta_id = src_mac_id
                 return sta_id, ap_id
-            else:
-                logger.warn('ssid: {} not found in ap'.format(ssid),
-                            extra=self.log_extra)
         if dst and not ap_id:
-            sql_q = 'SELECT id FROM ap WHERE mac_id=%s'
-            self.db_cursor.execute(sql_q, (dst_mac_id,))
-            row = self.db_cursor.fetchall()
-            if row:
-                ap_id = row[0][0]
+            ap_id = ap_ids_by_mac.get(dst_mac_id)
+            if ap_id:
                 ap_is = 'dst'
         if ap_id:
             if ap_is == 'src':
@@ -296,62 +772,163 @@ class EventHandler(Dot11HunterBase):
                 sta_id = src_mac_id
         return sta_id, ap_id
 
-    def handle_association(self, event):
+    def handle_association(self, events):
         # Note: if mac or ssid of AP is not seen before, this association will
         # be discard
         # src->dst: sta_mac -> ap_ssid, sta_mac -> ap_mac, ap_mac -> sta_mac,
-        result = False
-        src = int(event.src.replace(':', ''), 16)
-        if event.dst:
-            dst = int(event.dst.replace(':', ''), 16)
-        else:
-            dst = None
-        ts = event.timestamp
-        ssid = event.ssid
-        sta_id, ap_id = self.get_sta_ap_id(src, dst, ssid)
-        thold = CFG['MYSQL'].getfloat('association_update_interval')
-        if not self.is_fresh((sta_id, ap_id), ts, self.asocit_cache, thold):
-            return
-        if not sta_id or not ap_id:
-            # logger.warn('STA or AP not in db. src: {}, dst: {}, ssid: {}'
-            #             .format(event.src, event.dst, event.ssid),
-            #             extra=self.log_extra)
+        result = 0
+        if not events:
             return result
-        sql_q = 'SELECT id FROM association WHERE mac_id=%s and ap_id=%s'
-        self.db_cursor.execute(sql_q, (sta_id, ap_id))
-        row = self.db_cursor.fetchall()
-        if row:
-            sql_u = 'UPDATE association SET last_seen=%s WHERE id=%s'
-            self.db_cursor.execute(sql_u, (ts, row[0][0]))
-            self.db_conn.commit()
-            result = True
-        else:
-            sql_i = 'INSERT INTO association (mac_id, ap_id, first_seen, ' \
-                    'last_seen) VALUES (%s, %s, %s, %s)'
-            data = (sta_id, ap_id, ts, ts)
-            self.db_cursor.execute(sql_i, data)
-            self.db_conn.commit()
-            result = True
+        parsed = []
+        for event in events:
+            parsed.append((event.src, event.dst, event.ssid, event))
+        mac_ids = self.fetch_mac_ids(
+            [p[0] for p in parsed] + [p[1] for p in parsed])
+        ap_ids_by_mac = self.fetch_ap_ids('mac_id', mac_ids.values())
+        ap_ids_by_ssid = self.fetch_ap_ids('ssid', [p[2] for p in parsed])
+        records = dict()
+        for src, dst, ssid, event in parsed:
+            sta_id, ap_id = self.get_sta_ap_id(src, dst, ssid, mac_ids,
+                                               ap_ids_by_mac, ap_ids_by_ssid)
+            # unresolved pairs must not take room in the freshness cache
+            if not sta_id or not ap_id:
+                continue
+            count = self.asocit_cache.touch((sta_id, ap_id), event.timestamp,
+                                            event.count)
+            if count is None:
+                continue
+            self.merge(records, (sta_id, ap_id), event, count)
+            result += 1
+        if not records:
+            return result
+        # (mac_id, ap_id) is a unique key
+        existing = self.fetch_keys('association', 'ap_id',
+                                   [k[0] for k in records])
+        self.stats.add('association', len(records.keys() - existing))
+        rows = []
+        latest = None
+        for (sta_id, ap_id), (first, last, _, _) in records.items():
+            rows.append((sta_id, ap_id, self.db_time(first),
+                         self.db_time(last)))
+            if latest is None or last > latest[2]:
+                latest = (sta_id, ap_id, last)
+        self.storage.executemany(self.sql_upsert_association, rows)
+        self.seen_association(*latest, mac_ids)
         return result
 
+    def seen_association(self, sta_id, ap_id, last_seen, mac_ids):
+        # Latest association as (station addr, ssid), one lookup by id for
+        # the ssid
+        sta_addr = next(a for a, i in mac_ids.items() if i == sta_id)
+        self.storage.execute('SELECT ssid FROM ap WHERE id=%s', (ap_id,))
+        rows = self.storage.fetchall()
+        if rows:
+            self.stats.seen('association', (sta_addr, rows[0][0]), last_seen)
+
 
 class Dot11Event:
     SSID = 0x01
     MAC = 0x02
     ASSOCIATION = 0x03
-    GEO = 0x04
+    # a GPS fix: timestamp and geo only
+    LOCATION = 0x05
+
+    __slots__ = ('src', 'dst', 'timestamp', 'geo', 'type', 'ssid', 'origin',
+                 'count', 'last_seen')
 
     def __init__(self, src=None, dst=None, timestamp=None, geo=None,
                  type=None, ssid=None, origin=None):
-        # mac address
+        # mac addresses as 48-bit ints, timestamps in epoch seconds
         self.src = src
         self.dst = dst
-        self.timestamp = timestamp
+        self.timestamp = timestamp  # first seen
         self.geo = geo
         self.type = type    # event type:
         self.ssid = ssid
         self.origin = origin    # frame type
+        # number of identical events folded into this one, see EventCoalescer
+        self.count = 1
+        self.last_seen = timestamp
+
+    def key(self):
+        return self.type, self.src, self.dst, self.ssid, self.origin
+
+    def __repr__(self):
+        src, dst = (mac_str(a) if isinstance(a, int) and 0 <= a < MAX_MAC
+                    else a for a in (self.src, self.dst))
+        return 'Dot11Event(type={}, src={}, dst={}, ssid={!r})'.format(
+            self.type, src, dst, self.ssid)
 
     def dump(self):
         print('src: %s, dst: %s, ssid: %s, time: %s'
-              % (self.src, self.dst, self.ssid, self.geo))
+              % (mac_str(self.src), mac_str(self.dst), self.ssid, self.geo))
+
+
+class EventCoalescer:
+    # Fold identical events (same type, src, dst, ssid and origin) seen within
+    # window seconds into one event carrying a hit count and the last time it
+    # was seen, before they go through the shared event queue
+    def __init__(self, event_queue, window, max_pending, name='coalescer'):
+        self.event_queue = event_queue
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = dict()   # key -> (event, monotonic time of first hit)
+        self.oldest = float('-inf')   # first hit of the oldest pending event
+        self.counters = {'in': 0, 'out': 0, 'dropped': 0}
+        labels = {'handler': name}
+        self.in_metric = REGISTRY.counter(
+            'dot11hunter_events_parsed', 'Events parsed from frames', labels)
+        self.out_metric = REGISTRY.counter(
+            'dot11hunter_events_queued',
+            'Events queued after coalescing', labels)
+        self.dropped_metric = REGISTRY.counter(
+            'dot11hunter_events_dropped',
+            'Events dropped on a full event queue', labels)
+        REGISTRY.gauge('dot11hunter_events_pending',
+                       'Events held for coalescing', labels,
+                       func=self.pending.__len__)
+
+    def put(self, event):
+        self.counters['in'] += 1
+        self.in_metric.inc()
+        if self.window <= 0:
+            self.emit(event)
+            return
+        key = event.key()
+        pending = self.pending.get(key)
+        if pending is None:
+            self.pending[key] = (event, time.monotonic())
+            if len(self.pending) > self.max_pending:
+                # Make room by emitting the oldest event only
+                oldest = next(iter(self.pending))
+                self.emit(self.pending.pop(oldest)[0])
+            return
+        folded = pending[0]
+        folded.count += event.count
+        folded.last_seen = event.last_seen
+
+    def flush(self, expired_only=False):
+        # pending is in first hit order, so expired events come first and
+        # nothing can expire before the oldest one seen on the last call
+        now = time.monotonic()
+        if expired_only and now - self.oldest < self.window:
+            return
+        pending = self.pending
+        while pending:
+            key = next(iter(pending))
+            event, first = pending[key]
+            if expired_only and now - first < self.window:
+                self.oldest = first
+                return
+            del pending[key]
+            self.emit(event)
+        self.oldest = float('-inf')
+
+    def emit(self, event):
+        try:
+            self.event_queue.put_nowait(event)
+            self.counters['out'] += 1
+            self.out_metric.inc()
+        except queue.Full:
+            self.counters['dropped'] += 1
+            self.dropped_metric.inc()
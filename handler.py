@@ -1,18 +1,31 @@
 import queue
+import settings
 from base import Dot11HunterBase, FrameSubType, logger
-from scapy.all import *
-from event import EventHandler, Dot11Event
+import dot11
+from event import EventHandler, Dot11Event, EventCoalescer
 
 
 # Create handler threads to process frames
-def create_handlers(frm_queues, event_queue):
+def create_handlers(frm_queues, event_queue, stats=None):
     result = list()
     result.append(BeaconHandler(frm_queues['beacon'], event_queue))
     result.append(ProbeReqHandler(frm_queues['probe_req'], event_queue))
     result.append(MgmtHandler(frm_queues['mgmt'], event_queue))
     result.append(CtrlHandler(frm_queues['ctrl'], event_queue))
     result.append(DataHandler(frm_queues['data'], event_queue))
-    result.append(EventHandler(event_queue=event_queue))
+    result.append(EventHandler(event_queue=event_queue, stats=stats))
+    return result
+
+
+# Create frame handlers, by frame type, whose parse_frame is called directly
+# by a parser process instead of running as threads
+def create_parsers(event_queue):
+    result = dict()
+    result['beacon'] = BeaconHandler(None, event_queue)
+    result['probe_req'] = ProbeReqHandler(None, event_queue)
+    result['mgmt'] = MgmtHandler(None, event_queue)
+    result['ctrl'] = CtrlHandler(None, event_queue)
+    result['data'] = DataHandler(None, event_queue)
     return result
 
 
@@ -21,71 +34,86 @@ class HandlerBase(Dot11HunterBase):
         super().__init__()
         self.frm_queue = frm_queue
         self.event_queue = event_queue  # info extracted from frames
+        # Repeated events are folded here before reaching the event queue
+        cfg = settings.get().dot11
+        self.coalescer = EventCoalescer(
+            event_queue, cfg.coalesce_window, cfg.coalesce_max_pending,
+            type(self).__name__)
+        settings.subscribe(self.apply_settings)
+
+    def apply_settings(self, new, old):
+        self.coalescer.window = new.dot11.coalesce_window
+        self.coalescer.max_pending = new.dot11.coalesce_max_pending
+
+    def dump_log(self):
+        counters = self.coalescer.counters
+        if not counters['in']:
+            return
+        logger.info('coalesced {} events into {}, {} dropped, {} pending'
+                    ''.format(counters['in'], counters['out'],
+                              counters['dropped'],
+                              len(self.coalescer.pending)),
+                    extra=self.log_extra)
+        for k in counters.keys():
+            counters[k] = 0
 
     def run(self):
         while True:
+            # Wake up at least once per window to flush folded events
+            window = self.coalescer.window
+            timeout = window if window > 0 else None
             try:
-                geo_frame = self.frm_queue.get()
+                geo_frame = self.frm_queue.get(timeout=timeout)
                 self.parse_frame(geo_frame)
-            except queue.Full:
+            except queue.Empty:
                 pass
             except Exception as e:
                 logger.critical('{}'.format(str(e)), extra=self.log_extra)
+            try:
+                self.coalescer.flush(expired_only=True)
+            except Exception as e:
+                logger.critical('{}'.format(str(e)), extra=self.log_extra)
 
-    def extract_ssid(self, frame):
-        result = None
-        for l in self.extract_layers(frame):
-            if isinstance(l, Dot11Elt) and l.ID == 0:
-                result = l.info.decode('utf8')
-                break
-        return result
+    @staticmethod
+    def extract_ssid(frame):
+        return frame.ssid
 
     @staticmethod
     def decompose_geo_frame(geo_frame):
-        return geo_frame.frame, geo_frame.geo, geo_frame.timestamp
+        # Frames are queued as raw bytes, decode them here in the handler
+        # thread instead of in the capture path. frame is None for a
+        # truncated frame, which parse_frame skips
+        return dot11.decode(geo_frame.frame), geo_frame.timestamp
 
-    def put_events(self, ts, MAC=False, GEO=False, SSID=False,
-                   ASSOCIATION=False, **kwargs):
+    def put_events(self, ts, MAC=False, SSID=False, ASSOCIATION=False,
+                   **kwargs):
         if 'ssid_origin' in kwargs and kwargs['ssid_origin'] is not None:
             ssid_origin = kwargs['ssid_origin']
         else:
             ssid_origin = None
         if MAC:
-            self.event_queue.put_nowait(Dot11Event(src=kwargs['src'],
-                                                   timestamp=ts,
-                                                   type=Dot11Event.MAC,
-                                                   origin=kwargs[
-                                                       'mac_origin']))
+            self.coalescer.put(Dot11Event(src=kwargs['src'],
+                                          timestamp=ts,
+                                          type=Dot11Event.MAC,
+                                          origin=kwargs['mac_origin']))
             if 'dst' in kwargs and kwargs['dst'] is not None:
-                self.event_queue.put_nowait(
+                self.coalescer.put(
                     # Here dst mac is assigned to src for the convenience of
-                    # event.handle_mac
+                    # event.handle_mac and handle_geo
                     Dot11Event(src=kwargs['dst'],
                                timestamp=ts,
                                type=Dot11Event.MAC,
                                origin=kwargs[
                                    'mac_origin']))
-        if GEO:
-            self.event_queue.put_nowait(
-                Dot11Event(src=kwargs['src'],
-                           timestamp=ts,
-                           geo=kwargs['geo'],
-                           type=Dot11Event.GEO))
-            if 'dst' in kwargs and kwargs['dst'] is not None:
-                self.event_queue.put_nowait(
-                    Dot11Event(src=kwargs['dst'],
-                               timestamp=ts,
-                               geo=kwargs['geo'],
-                               type=Dot11Event.GEO))
         if SSID:
-            self.event_queue.put_nowait(
+            self.coalescer.put(
                 Dot11Event(src=kwargs['src'],
                            ssid=kwargs['ssid'],
                            timestamp=ts,
                            type=Dot11Event.SSID,
                            origin=ssid_origin))
         if ASSOCIATION:
-            self.event_queue.put_nowait(
+            self.coalescer.put(
                 Dot11Event(src=kwargs['src'],
                            dst=kwargs['dst'],
                            ssid=kwargs['ssid'],
@@ -95,12 +123,6 @@ class HandlerBase(Dot11HunterBase):
     def parse_frame(self, frame):
         pass
 
-    @staticmethod
-    def extract_layers(frame):
-        while frame.payload:
-            frame = frame.payload
-            yield frame
-
 
 class BeaconHandler(HandlerBase):
     def __init__(self, frm_queue, event_queue):
@@ -109,13 +131,14 @@ class BeaconHandler(HandlerBase):
         self.log_extra = {'thread_name': self.getName()}
 
     def parse_frame(self, geo_frame):
-        frame, geo, ts = self.decompose_geo_frame(geo_frame)
-        src = frame.payload.addr2
+        frame, ts = self.decompose_geo_frame(geo_frame)
+        if frame is None:
+            return
+        src = frame.addr2
         ssid = self.extract_ssid(frame)
         ssid_origin = 'from_beacon'
         mac_origin = 'from_mgmt'
-        self.put_events(ts, MAC=True, GEO=True, src=src, mac_origin=mac_origin,
-                        geo=geo)
+        self.put_events(ts, MAC=True, src=src, mac_origin=mac_origin)
         if ssid is None:
             return
         self.put_events(ts, SSID=True, src=src, ssid=ssid,
@@ -129,20 +152,21 @@ class ProbeReqHandler(HandlerBase):
         self.log_extra = {'thread_name': self.getName()}
 
     def parse_frame(self, geo_frame):
-        frame, geo, ts = self.decompose_geo_frame(geo_frame)
+        frame, ts = self.decompose_geo_frame(geo_frame)
+        if frame is None:
+            return
         mac_origin = 'from_mgmt'
         ssid_origin = 'from_probe_req'
-        src = frame.payload.addr2
+        src = frame.addr2
         ssid = self.extract_ssid(frame)
         if ssid:
             self.put_events(ts, SSID=True, src=None, ssid=ssid,
                             ssid_origin=ssid_origin)
-            self.put_events(ts, MAC=True, GEO=True, ASSOCIATION=True,
+            self.put_events(ts, MAC=True, ASSOCIATION=True,
                             src=src, dst=None, ssid=ssid,
-                            mac_origin=mac_origin, ssid_origin=ssid_origin,
-                            geo=geo)
+                            mac_origin=mac_origin, ssid_origin=ssid_origin)
         else:
-            self.put_events(ts, MAC=True, GEO=True, src=src, geo=geo,
+            self.put_events(ts, MAC=True, src=src,
                             mac_origin=mac_origin)
 
 
@@ -153,29 +177,30 @@ class MgmtHandler(HandlerBase):
         self.log_extra = {'thread_name': self.getName()}
 
     def parse_frame(self, geo_frame):
-        frame, geo, ts = self.decompose_geo_frame(geo_frame)
-        sts = FrameSubType.get_type_subtype(frame)
+        frame, ts = self.decompose_geo_frame(geo_frame)
+        if frame is None:
+            return
+        sts = frame.type_subtype
         mac_origin = 'from_mgmt'
         if sts == FrameSubType.PROBE_RESP:
             ssid_origin = 'from_probe_resp'
-            src = frame.payload.addr2
-            dst = frame.payload.addr1
+            src = frame.addr2
+            dst = frame.addr1
             ssid = self.extract_ssid(frame)
             if ssid:
-                self.put_events(ts, MAC=True, SSID=True, GEO=True,
+                self.put_events(ts, MAC=True, SSID=True,
                                 ASSOCIATION=True, src=src, dst=dst, ssid=ssid,
-                                mac_origin=mac_origin, ssid_origin=ssid_origin,
-                                geo=geo)
+                                mac_origin=mac_origin, ssid_origin=ssid_origin)
             else:
-                self.put_events(ts, MAC=True, GEO=True,
+                self.put_events(ts, MAC=True,
                                 ASSOCIATION=True, src=src, dst=dst, ssid=ssid,
-                                mac_origin=mac_origin, geo=geo)
+                                mac_origin=mac_origin)
         elif sts == FrameSubType.ACTION:
-            src = frame.payload.addr2
-            dst = frame.payload.addr1
+            src = frame.addr2
+            dst = frame.addr1
             # logger.debug('action: {} -> {}'.format(src, dst))
-            self.put_events(ts, MAC=True, GEO=True, ASSOCIATION=True,
-                            src=src, dst=dst, geo=geo,
+            self.put_events(ts, MAC=True, ASSOCIATION=True,
+                            src=src, dst=dst,
                             ssid=None, mac_origin=mac_origin)
 
 
@@ -186,16 +211,18 @@ class CtrlHandler(HandlerBase):
         self.log_extra = {'thread_name': self.getName()}
 
     def parse_frame(self, geo_frame):
-        frame, geo, ts = self.decompose_geo_frame(geo_frame)
-        sts = FrameSubType.get_type_subtype(frame)
+        frame, ts = self.decompose_geo_frame(geo_frame)
+        if frame is None:
+            return
+        sts = frame.type_subtype
         mac_origin = 'from_ctrl'
         if sts in (FrameSubType.PS_POLL, FrameSubType.RTS,
                    FrameSubType.BLOCK_ACK, FrameSubType.BLOCK_ACK_REQ):
-            src = frame.payload.addr2
-            dst = frame.payload.addr1
+            src = frame.addr2
+            dst = frame.addr1
             self.put_events(
-                ts, MAC=True, GEO=True, ASSOCIATION=True, src=src,
-                dst=dst, geo=geo, ssid=None, mac_origin=mac_origin)
+                ts, MAC=True, ASSOCIATION=True, src=src,
+                dst=dst, ssid=None, mac_origin=mac_origin)
 
 
 class DataHandler(HandlerBase):
@@ -205,17 +232,19 @@ class DataHandler(HandlerBase):
         self.log_extra = {'thread_name': self.getName()}
 
     def parse_frame(self, geo_frame):
-        frame, geo, ts = self.decompose_geo_frame(geo_frame)
-        sts = FrameSubType.get_type_subtype(frame)
+        frame, ts = self.decompose_geo_frame(geo_frame)
+        if frame is None:
+            return
+        sts = frame.type_subtype
         mac_origin = 'from_data'
         if sts in (FrameSubType.NULL_FUNC, FrameSubType.QOS_NULL_FUNC,
                    FrameSubType.QOS_DATA):
-            src = frame.payload.addr2
-            dst = frame.payload.addr1
-            if dst.lower() != 'ff:ff:ff:ff:ff:ff':
-                self.put_events(ts, MAC=True, GEO=True, ASSOCIATION=True,
-                                src=src, dst=dst, geo=geo, ssid=None,
+            src = frame.addr2
+            dst = frame.addr1
+            if dst != dot11.BROADCAST:
+                self.put_events(ts, MAC=True, ASSOCIATION=True,
+                                src=src, dst=dst, ssid=None,
                                 mac_origin=mac_origin)
             else:
-                self.put_events(ts, MAC=True, GEO=True, src=src,
-                                geo=geo, mac_origin=mac_origin)
+                self.put_events(ts, MAC=True, src=src,
+                                mac_origin=mac_origin)
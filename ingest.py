@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import time
+import settings
+from base import GeoFrame, FrameSubType, logger
+from cache import PassThroughCache
+from capture import PcapCapture
+from event import EventHandler, EventCoalescer, Dot11Event
+
+# Offline mode: ingest archived pcap/pcapng captures as fast as they can be
+# read. Files are parsed by a pool of processes with every frame (no
+# sampling) and its capture timestamp, each file's events are folded in the
+# worker, and the results are bulk loaded by a single BulkLoader.
+
+PCAP_SUFFIXES = ('.pcap', '.pcapng', '.cap')
+LOG_EXTRA = {'thread_name': 'Ingest'}
+# Type order of a bulk load, rows must exist before the ones referring them
+EVENT_ORDER = {Dot11Event.MAC: 0, Dot11Event.SSID: 1,
+               Dot11Event.ASSOCIATION: 2}
+
+
+class EventList(list):
+    # Event sink for the coalescers of a parse worker
+    put_nowait = list.append
+
+
+parsers = None
+events = None
+
+
+def expand_paths(paths):
+    # Files as given, directories to their capture files, sorted
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(PCAP_SUFFIXES):
+                    result.append(os.path.join(path, name))
+        else:
+            result.append(path)
+    return result
+
+
+def init_parse_worker():
+    # Frame handlers of a parse worker, their coalescers fold a whole file
+    # (window never expires) into events
+    from handler import create_parsers
+    global parsers, events
+    events = EventList()
+    parsers = create_parsers(events)
+    for parser in parsers.values():
+        parser.coalescer = EventCoalescer(
+            events, float('inf'), settings.get().ingest.fold_max_pending)
+
+
+def parse_file(path):
+    # Returns (path, frames, events) of one capture file
+    frames = [0]
+
+    def callback(buf, ts):
+        frames[0] += 1
+        frm_type = FrameSubType.get_frame_type(
+            FrameSubType.get_type_subtype(buf))
+        if frm_type is None:
+            return
+        try:
+            parsers[frm_type].parse_frame(GeoFrame(bytes(buf), ts))
+        except Exception as e:
+            logger.debug('{}: {}'.format(path, str(e)), extra=LOG_EXTRA)
+
+    try:
+        PcapCapture(path).run(callback)
+    except (OSError, ValueError) as e:
+        logger.critical('{}: {}'.format(path, str(e)), extra=LOG_EXTRA)
+    for parser in parsers.values():
+        parser.coalescer.flush()
+    result = list(events)
+    events.clear()
+    return path, frames[0], result
+
+
+class BulkLoader(EventHandler):
+    # EventHandler writing folded events of whole files in large
+    # transactions, without the live freshness filtering
+    def __init__(self):
+        super().__init__(event_queue=None)
+        self.setName('BulkLoader')
+        self.log_extra = {'thread_name': self.getName()}
+        self.mac_cache = PassThroughCache()
+        self.ssid_cache = PassThroughCache()
+        self.asocit_cache = PassThroughCache()
+        self.geo_cache = PassThroughCache()
+        self.batch_size = settings.get().ingest.batch_size
+
+    def dump_log(self):
+        pass
+
+    def load(self, events):
+        # Batches follow the type order, so that a batch only refers to
+        # rows of the same or an earlier batch
+        events.sort(key=lambda e: EVENT_ORDER.get(e.type, 3))
+        for i in range(0, len(events), self.batch_size):
+            batch = [event for event in events[i:i + self.batch_size]
+                     if self.accept(event)]
+            left = self.write(batch)
+            if left:
+                logger.critical('database failed, {} events not loaded'
+                                ''.format(len(left)), extra=self.log_extra)
+
+
+def ingest(paths):
+    files = expand_paths(paths)
+    workers = settings.get().ingest.workers or os.cpu_count()
+    workers = max(1, min(workers, len(files)))
+    logger.info('ingesting {} files with {} workers'.format(len(files),
+                                                             workers),
+                extra=LOG_EXTRA)
+    loader = BulkLoader()
+    start = time.time()
+    total_frames = 0
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(workers, initializer=init_parse_worker) as pool:
+        # Files are parsed in parallel but loaded in the order given; the
+        # upserts only widen first_seen..last_seen of existing rows, so
+        # older files may come after newer ones. Loading overlaps parsing.
+        for path, frames, events in pool.imap(parse_file, files):
+            loader.load(events)
+            total_frames += frames
+            logger.info('{}: {} frames, {} events'.format(
+                path, frames, len(events)), extra=LOG_EXTRA)
+    elapsed = time.time() - start
+    logger.info('ingested {} frames in {:.1f}s, {:.0f} frames/s, {} batches, '
+                '{} failed'.format(total_frames, elapsed,
+                                   total_frames / elapsed if elapsed else 0,
+                                   loader.batch_counters['batches'],
+                                   loader.batch_counters['failed']),
+                extra=LOG_EXTRA)
+    loader.storage.close()
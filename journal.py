@@ -0,0 +1,272 @@
+import os
+import pickle
+import struct
+import time
+import zlib
+from base import logger
+from metrics import REGISTRY
+
+# Append-only spill journal of event batches on local disk, for when the
+# database is down or behind. A record is one pickled batch behind a
+# (length, crc32, events) header, records go to numbered segment files of
+# about segment_bytes. Appends are flushed to the OS at once and fsynced at
+# most every fsync_interval seconds. Batches are read back in order; the
+# read position is saved to a file with the same interval, so after a crash
+# at most that many seconds of replayed batches are written again. Past
+# max_bytes the oldest segments are dropped.
+
+RECORD_HEADER = struct.Struct('<III')   # payload length, crc32, events
+SEGMENT_PREFIX = 'spill-'
+SEGMENT_SUFFIX = '.log'
+POSITION_FILE = 'position'
+LOG_EXTRA = {'thread_name': 'SpillJournal'}
+
+
+class Segment:
+    __slots__ = ('seq', 'path', 'size', 'events')
+
+    def __init__(self, seq, path, size=0, events=0):
+        self.seq = seq
+        self.path = path
+        self.size = size
+        self.events = events
+
+
+class SpillJournal:
+    # Used by the EventHandler thread only
+    def __init__(self, directory, segment_bytes, max_bytes, fsync_interval):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.segments = []  # oldest first, the last one is written
+        self.writer = None
+        self.reader = None
+        self.read_offset = 0    # in segments[0]
+        self.read_events = 0    # events of segments[0] already read
+        self.next_record = None     # (batch, size, events) of peek()
+        self.dirty = False
+        self.last_sync = time.time()
+        self.counters = {'spilled': 0, 'replayed': 0, 'dropped': 0}
+        self.spilled_metric = REGISTRY.counter(
+            'dot11hunter_journal_events_spilled',
+            'Events written to the spill journal')
+        self.replayed_metric = REGISTRY.counter(
+            'dot11hunter_journal_events_replayed',
+            'Events replayed from the spill journal to the database')
+        self.dropped_metric = REGISTRY.counter(
+            'dot11hunter_journal_events_dropped',
+            'Spilled events dropped, over the size cap or failing replay')
+        REGISTRY.gauge('dot11hunter_journal_events',
+                       'Events waiting in the spill journal',
+                       func=self.__len__)
+        REGISTRY.gauge('dot11hunter_journal_bytes',
+                       'Size of the spill journal segments',
+                       func=lambda: sum(s.size for s in self.segments))
+        REGISTRY.gauge('dot11hunter_journal_segments',
+                       'Segment files of the spill journal',
+                       func=lambda: len(self.segments))
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def __len__(self):
+        return sum(s.events for s in self.segments) - self.read_events
+
+    def segment_path(self, seq):
+        return os.path.join(self.directory, '{}{:010d}{}'.format(
+            SEGMENT_PREFIX, seq, SEGMENT_SUFFIX))
+
+    def load(self):
+        # Segments left by a previous run, a torn record at the end of one
+        # is cut off
+        seqs = sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                      for name in os.listdir(self.directory)
+                      if name.startswith(SEGMENT_PREFIX) and
+                      name.endswith(SEGMENT_SUFFIX))
+        for seq in seqs:
+            segment = Segment(seq, self.segment_path(seq))
+            with open(segment.path, 'r+b') as f:
+                for offset, size, events in self.scan(f):
+                    segment.size = offset + size
+                    segment.events += events
+                if f.seek(0, os.SEEK_END) != segment.size:
+                    logger.warning('{}: torn record cut at {}'.format(
+                        segment.path, segment.size), extra=LOG_EXTRA)
+                    f.truncate(segment.size)
+            self.segments.append(segment)
+        seq, offset = self.load_position()
+        while self.segments and self.segments[0].seq < seq:
+            os.remove(self.segments.pop(0).path)
+        if self.segments and self.segments[0].seq == seq:
+            with open(self.segments[0].path, 'rb') as f:
+                for record_offset, size, events in self.scan(f):
+                    if record_offset >= offset:
+                        break
+                    self.read_offset = record_offset + size
+                    self.read_events += events
+        if self.segments:
+            logger.info('{} events to replay in {} segments'.format(
+                len(self), len(self.segments)), extra=LOG_EXTRA)
+
+    @staticmethod
+    def scan(f):
+        # (offset, size, events) of the whole records of a segment file
+        f.seek(0)
+        offset = 0
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc, events = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield offset, RECORD_HEADER.size + length, events
+            offset += RECORD_HEADER.size + length
+
+    def load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def save_position(self):
+        seq = self.segments[0].seq if self.segments else 0
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write('{} {}\n'.format(seq, self.read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def append(self, batch):
+        payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload),
+                                    len(batch)) + payload
+        if self.writer is None or \
+                self.segments[-1].size + len(record) > self.segment_bytes:
+            self.rotate()
+        self.enforce_cap(len(record))
+        self.writer.write(record)
+        self.writer.flush()
+        segment = self.segments[-1]
+        segment.size += len(record)
+        segment.events += len(batch)
+        self.counters['spilled'] += len(batch)
+        self.spilled_metric.inc(len(batch))
+        self.dirty = True
+        self.sync()
+
+    def rotate(self):
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+            self.writer.close()
+        seq = self.segments[-1].seq + 1 if self.segments else \
+            self.load_position()[0]
+        segment = Segment(seq, self.segment_path(seq))
+        self.writer = open(segment.path, 'ab')
+        self.segments.append(segment)
+
+    def enforce_cap(self, incoming):
+        # Drop the oldest segments, never the one being written
+        while len(self.segments) > 1 and \
+                sum(s.size for s in self.segments) + incoming > self.max_bytes:
+            segment = self.segments.pop(0)
+            lost = segment.events - self.read_events
+            self.close_reader()
+            self.read_offset = 0
+            self.read_events = 0
+            self.next_record = None
+            os.remove(segment.path)
+            self.counters['dropped'] += lost
+            self.dropped_metric.inc(lost)
+            logger.warning('spill journal over {} MB, dropped {} events of '
+                           '{}'.format(self.max_bytes >> 20, lost,
+                                       segment.path), extra=LOG_EXTRA)
+            self.dirty = True
+
+    def peek(self):
+        # The oldest batch not acknowledged yet, None if there is none
+        if self.next_record is not None:
+            return self.next_record[0]
+        while self.segments:
+            segment = self.segments[0]
+            if self.read_offset < segment.size:
+                break
+            if segment is self.segments[-1] and self.writer is not None:
+                return None
+            self.close_reader()
+            os.remove(self.segments.pop(0).path)
+            self.read_offset = 0
+            self.read_events = 0
+            self.dirty = True
+        else:
+            return None
+        if self.reader is None:
+            self.reader = open(self.segments[0].path, 'rb')
+        self.reader.seek(self.read_offset)
+        length, crc, events = RECORD_HEADER.unpack(
+            self.reader.read(RECORD_HEADER.size))
+        batch = pickle.loads(self.reader.read(length))
+        self.next_record = (batch, RECORD_HEADER.size + length, events)
+        return batch
+
+    def ack(self, replayed=True):
+        # Done with the batch of peek(): written, or dropped if not replayed
+        batch, size, events = self.next_record
+        self.next_record = None
+        self.read_offset += size
+        self.read_events += events
+        if replayed:
+            self.counters['replayed'] += events
+            self.replayed_metric.inc(events)
+        else:
+            self.counters['dropped'] += events
+            self.dropped_metric.inc(events)
+        self.dirty = True
+        if not len(self):
+            self.reset()
+        self.sync()
+
+    def reset(self):
+        # Everything replayed, start over with a fresh segment
+        self.close_reader()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        seq = self.segments[-1].seq + 1
+        for segment in self.segments:
+            os.remove(segment.path)
+        self.segments = []
+        self.read_offset = 0
+        self.read_events = 0
+        with open(os.path.join(self.directory, POSITION_FILE), 'w') as f:
+            f.write('{} 0\n'.format(seq))
+        self.dirty = False
+
+    def close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def sync(self, force=False):
+        # fsync the segment written and save the read position, at most
+        # every fsync_interval seconds
+        if not self.dirty or \
+                (not force and time.time() - self.last_sync <
+                 self.fsync_interval):
+            return
+        if self.writer is not None:
+            os.fsync(self.writer.fileno())
+        self.save_position()
+        self.dirty = False
+        self.last_sync = time.time()
+
+    def close(self):
+        self.sync(force=True)
+        self.close_reader()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
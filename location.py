@@ -0,0 +1,133 @@
+import bisect
+import heapq
+
+# GPS fixes from the phone, indexed by time. Frames only carry their capture
+# time; the position of a GEO row is looked up here when the row is written,
+# interpolated between the fixes around that time.
+
+
+class LocationTimeline:
+    # Fixes in time order, the oldest ones are dropped past size. Owned by
+    # the EventHandler thread, which receives fixes as LOCATION events, so
+    # it needs no lock.
+    def __init__(self, size, max_gap, validity):
+        self.size = size
+        self.max_gap = max_gap      # interpolate between fixes this close
+        self.validity = validity    # otherwise the nearest fix this close
+        self.times = []
+        self.fixes = []     # (longitude, latitude)
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, ts, longitude, latitude):
+        fix = (longitude, latitude)
+        if not self.times or ts > self.times[-1]:
+            self.times.append(ts)
+            self.fixes.append(fix)
+        else:
+            # late or repeated fix
+            i = bisect.bisect_left(self.times, ts)
+            if i < len(self.times) and self.times[i] == ts:
+                self.fixes[i] = fix
+            else:
+                self.times.insert(i, ts)
+                self.fixes.insert(i, fix)
+        if len(self.times) > self.size:
+            del self.times[:-self.size]
+            del self.fixes[:-self.size]
+
+    def position(self, ts):
+        # (longitude, latitude) at ts, None without a fix close enough
+        times = self.times
+        i = bisect.bisect_right(times, ts)
+        if 0 < i < len(times):
+            t0 = times[i - 1]
+            t1 = times[i]
+            if t1 - t0 <= self.max_gap:
+                r = (ts - t0) / (t1 - t0)
+                (lon0, lat0), (lon1, lat1) = self.fixes[i - 1], self.fixes[i]
+                return lon0 + (lon1 - lon0) * r, lat0 + (lat1 - lat0) * r
+            nearest = i - 1 if ts - t0 <= t1 - ts else i
+        elif i:
+            nearest = i - 1
+        elif times:
+            nearest = 0
+        else:
+            return None
+        if abs(ts - times[nearest]) > self.validity:
+            return None
+        return self.fixes[nearest]
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(longitude, latitude, precision):
+    # Geohash of precision characters, 7 is a cell of about 150 m
+    lon_range = [-180.0, 180.0]
+    lat_range = [-90.0, 90.0]
+    result = []
+    bits = 0
+    n = 0
+    even = True     # bits alternate between longitude and latitude
+    while len(result) < precision:
+        value, bounds = (longitude, lon_range) if even else \
+            (latitude, lat_range)
+        mid = (bounds[0] + bounds[1]) / 2
+        if value >= mid:
+            bits = bits << 1 | 1
+            bounds[0] = mid
+        else:
+            bits <<= 1
+            bounds[1] = mid
+        even = not even
+        n += 1
+        if n == 5:
+            result.append(GEOHASH_BASE32[bits])
+            bits = 0
+            n = 0
+    return ''.join(result)
+
+
+class GeoBins:
+    # Sightings of a mac address folded by (geohash cell, time bucket):
+    # (mac_addr, cell, bucket start) -> [first_seen, last_seen, count,
+    # longitude sum, latitude sum]. A bin is written once its bucket is
+    # over, or early, oldest bucket first, when there are more than
+    # max_bins of them.
+    def __init__(self, precision, bucket, max_bins):
+        self.precision = precision
+        self.bucket = bucket
+        self.max_bins = max_bins
+        self.bins = dict()
+
+    def __len__(self):
+        return len(self.bins)
+
+    def add(self, mac_addr, ts, longitude, latitude, count=1):
+        start = ts - ts % self.bucket
+        key = (mac_addr, geohash(longitude, latitude, self.precision), start)
+        record = self.bins.get(key)
+        if record is None:
+            self.bins[key] = [ts, ts, count, longitude * count,
+                              latitude * count]
+            return
+        record[0] = min(record[0], ts)
+        record[1] = max(record[1], ts)
+        record[2] += count
+        record[3] += longitude * count
+        record[4] += latitude * count
+
+    def pop_closed(self, now):
+        # Bins whose bucket ended before now, and the oldest open ones past
+        # max_bins
+        result = []
+        for key in [k for k in self.bins if k[2] + self.bucket <= now]:
+            result.append((key, self.bins.pop(key)))
+        excess = len(self.bins) - self.max_bins
+        if excess > 0:
+            for key in heapq.nsmallest(excess, self.bins,
+                                       key=lambda k: k[2]):
+                result.append((key, self.bins.pop(key)))
+        return result
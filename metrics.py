@@ -0,0 +1,201 @@
+import http.server
+import os
+import socketserver
+import threading
+import settings
+from base import logger
+
+# Process wide metrics registry rendered in the Prometheus text format and
+# served on localhost HTTP or a Unix socket (curl --unix-socket). Metrics are
+# cumulative, unlike the counters dump_log resets. Updates are plain
+# attribute increments without locks: a scrape may miss an increment in
+# flight, and the frame path never pays for a lock.
+
+LOG_EXTRA = {'thread_name': 'Metrics'}
+# seconds, suited to database statements and batches
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels.items()) + '}'
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name + '_total' + format_labels(labels), self.value
+
+
+class Gauge:
+    # Set by the owner, or read from func at scrape time
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.func() if self.func is not None else self.value
+        if value is not None:
+            yield name + format_labels(labels), value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            yield name + '_bucket' + format_labels(
+                dict(labels, le=bound)), cumulative
+        yield name + '_bucket' + format_labels(
+            dict(labels, le='+Inf')), self.count
+        yield name + '_sum' + format_labels(labels), self.sum
+        yield name + '_count' + format_labels(labels), self.count
+
+
+class Registry:
+    def __init__(self):
+        self.families = dict()  # name -> [type, help, {labels: metric}]
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def get(self, cls, kind, name, help_text, labels, *args):
+        # Same name and labels return the same metric
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            family = self.families.setdefault(name, [kind, help_text, dict()])
+            metric = family[2].get(key)
+            if metric is None:
+                metric = cls(*args)
+                family[2][key] = metric
+            return metric
+
+    def counter(self, name, help_text, labels=None):
+        return self.get(Counter, 'counter', name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=None, func=None):
+        metric = self.get(Gauge, 'gauge', name, help_text, labels)
+        if func is not None:
+            metric.func = func
+        return metric
+
+    def histogram(self, name, help_text, labels=None,
+                  buckets=LATENCY_BUCKETS):
+        return self.get(Histogram, 'histogram', name, help_text, labels,
+                        buckets)
+
+    def collector(self, name, kind, help_text, func):
+        # func() returns [(labels, value)], for values kept outside the
+        # registry, e.g. a plain list counted on the frame path
+        with self.lock:
+            self.collectors.append((name, kind, help_text, func))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = [(n, f[0], f[1], list(f[2].items()))
+                        for n, f in sorted(self.families.items())]
+            collectors = list(self.collectors)
+        for name, kind, help_text, metrics in families:
+            self.header(lines, name, kind, help_text)
+            for key, metric in metrics:
+                for sample, value in metric.samples(name, dict(key)):
+                    lines.append('{} {}'.format(sample, value))
+        for name, kind, help_text, func in collectors:
+            sample_name = self.header(lines, name, kind, help_text)
+            try:
+                for labels, value in func():
+                    lines.append('{}{} {}'.format(
+                        sample_name, format_labels(labels), value))
+            except Exception as e:
+                logger.critical('{}: {}'.format(name, str(e)),
+                                extra=LOG_EXTRA)
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def header(lines, name, kind, help_text):
+        # A counter family goes by the name of its _total samples, or the
+        # text format parser leaves them untyped. Returns that name.
+        if kind == 'counter':
+            name += '_total'
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        return name
+
+
+REGISTRY = Registry()
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return str(self.client_address or 'unix')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_server():
+    # listen: host:port, or unix:/path/to/socket. Returns the server, None
+    # when metrics are disabled.
+    listen = settings.get().metrics.listen
+    if not listen:
+        return None
+    if listen.startswith('unix:'):
+        path = listen[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixHTTPServer(path, MetricsRequestHandler)
+    else:
+        host, port = listen.rsplit(':', 1)
+        server = http.server.ThreadingHTTPServer((host, int(port)),
+                                                 MetricsRequestHandler)
+        server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='MetricsServer', daemon=True)
+    thread.start()
+    logger.info('serving metrics on {}'.format(listen), extra=LOG_EXTRA)
+    return server
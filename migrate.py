@@ -0,0 +1,95 @@
+import argparse
+import os
+import re
+import sys
+from base import Dot11HunterUtils, logger
+
+# Versioned schema migrations in database/migrations, named
+# <version>_<description>.sql and applied in version order on top of
+# database/dot11hunter.sql. SCHEMA_VERSION is the version the code expects.
+# They are MySQL only, the sqlite backend creates its database from
+# database/dot11hunter.sqlite.sql, kept at SCHEMA_VERSION.
+SCHEMA_VERSION = 2
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'database', 'migrations')
+LOG_EXTRA = {'thread_name': 'Migrate'}
+
+
+def list_migrations():
+    result = []
+    for name in os.listdir(MIGRATIONS_DIR):
+        m = re.match(r'^(\d+)_\w+\.sql$', name)
+        if m:
+            result.append((int(m.group(1)), os.path.join(MIGRATIONS_DIR,
+                                                         name)))
+    return sorted(result)
+
+
+def split_statements(sql):
+    # Statements end with ';' at the end of a line, comments are dropped
+    lines = [l for l in sql.splitlines() if not l.strip().startswith('--')]
+    result = []
+    for stmt in re.split(r';\s*$', '\n'.join(lines), flags=re.MULTILINE):
+        if stmt.strip():
+            result.append(stmt.strip())
+    return result
+
+
+def get_schema_version(db_cursor):
+    db_cursor.execute("SHOW TABLES LIKE 'schema_version'")
+    if not db_cursor.fetchall():
+        return 0
+    db_cursor.execute('SELECT MAX(version) FROM schema_version')
+    row = db_cursor.fetchall()
+    return row[0][0] or 0
+
+
+def check_schema():
+    # Refuse to run against a database the code does not match
+    from storage import create_storage
+    storage = create_storage()
+    try:
+        version = storage.schema_version()
+    finally:
+        storage.close()
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            'database schema is at version {}, expected {}. Run '
+            '"python3 migrate.py" first.'.format(version, SCHEMA_VERSION))
+
+
+def migrate():
+    db_conn, db_cursor = Dot11HunterUtils.connect_db()
+    try:
+        version = get_schema_version(db_cursor)
+        for target, path in list_migrations():
+            if target <= version:
+                continue
+            logger.info('applying migration {}'.format(os.path.basename(path)),
+                        extra=LOG_EXTRA)
+            with open(path) as f:
+                for stmt in split_statements(f.read()):
+                    db_cursor.execute(stmt)
+            db_conn.commit()
+            version = target
+        logger.info('database schema is at version {}'.format(version),
+                    extra=LOG_EXTRA)
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Dot11Hunter: migrate the database schema')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the schema version')
+    args = parser.parse_args()
+    if args.check:
+        try:
+            check_schema()
+        except RuntimeError as e:
+            print(str(e))
+            sys.exit(1)
+        print('database schema is up to date')
+    else:
+        migrate()
@@ -0,0 +1,180 @@
+import ctypes
+import multiprocessing
+import os
+import queue
+import signal
+import struct
+import threading
+from multiprocessing import shared_memory
+import settings
+from base import GeoFrame, logger, Dot11HunterUtils
+
+# Process mode: capture and dispatch stay in the main process, sampled frames
+# go through shared-memory rings to a pool of parser processes, and the
+# parsers feed events to a persistence process running EventHandler.
+
+# Slot header: frame length, capture time, frame type index
+SLOT_HEADER = struct.Struct('<IdB')
+PR_SET_PDEATHSIG = 1
+
+
+def die_with_parent():
+    # Child processes must not outlive Dot11Hunter, which exits by SIGKILL
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+class ShmRing:
+    # Single producer, single consumer ring of fixed size slots in shared
+    # memory. The free/filled semaphores count slots and order the writes
+    # of one process before the reads of the other.
+    def __init__(self, ctx, slots, slot_size):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=slots * slot_size)
+        self.name = self.shm.name
+        self.free = ctx.Semaphore(slots)
+        self.filled = ctx.Semaphore(0)
+        self.head = 0   # next slot to write, producer side only
+        self.tail = 0   # next slot to read, consumer side only
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['shm']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=self.name)
+
+    def put(self, frm_type, frame, ts):
+        # Raises queue.Full instead of blocking the capture, frames larger
+        # than a slot are dropped the same way
+        size = len(frame)
+        if SLOT_HEADER.size + size > self.slot_size:
+            raise queue.Full
+        if not self.free.acquire(block=False):
+            raise queue.Full
+        offset = self.head * self.slot_size
+        SLOT_HEADER.pack_into(self.shm.buf, offset, size, ts, frm_type)
+        start = offset + SLOT_HEADER.size
+        self.shm.buf[start:start + size] = frame
+        self.head = (self.head + 1) % self.slots
+        self.filled.release()
+
+    def get(self, timeout=None):
+        # Returns (frame type index, GeoFrame), raises queue.Empty
+        if not self.filled.acquire(timeout=timeout):
+            raise queue.Empty
+        offset = self.tail * self.slot_size
+        size, ts, frm_type = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        start = offset + SLOT_HEADER.size
+        frame = bytes(self.shm.buf[start:start + size])
+        self.tail = (self.tail + 1) % self.slots
+        self.free.release()
+        return frm_type, GeoFrame(frame, ts)
+
+    def qsize(self):
+        return self.slots - self.free.get_value()
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def parse_worker(ring, event_queue):
+    # Parser process: run the frame handlers' parse_frame on ring frames
+    from handler import create_parsers
+    die_with_parent()
+    frame_types = Dot11HunterUtils.get_frame_types()
+    parsers = create_parsers(event_queue)
+    log_extra = {'thread_name': multiprocessing.current_process().name}
+    while True:
+        window = settings.get().dot11.coalesce_window
+        timeout = window if window > 0 else None
+        try:
+            frm_type, geo_frame = ring.get(timeout=timeout)
+            parsers[frame_types[frm_type]].parse_frame(geo_frame)
+        except queue.Empty:
+            pass
+        except Exception as e:
+            logger.critical('{}'.format(str(e)), extra=log_extra)
+        for parser in parsers.values():
+            parser.coalescer.flush(expired_only=True)
+
+
+def persist_worker(event_queue, status_queue):
+    # Persistence process: EventHandler drains the shared event queue and
+    # publishes the status totals on status_queue
+    from event import EventHandler
+    from status import LiveStats
+    die_with_parent()
+    EventHandler(event_queue=event_queue,
+                 stats=LiveStats(channel=status_queue)).run()
+
+
+class ProcessPipeline:
+    def __init__(self):
+        self.ctx = multiprocessing.get_context('spawn')
+        self.frame_types = Dot11HunterUtils.get_frame_types()
+        self.type_index = {t: i for i, t in enumerate(self.frame_types)}
+        cfg = settings.get()
+        self.event_queue = self.ctx.Queue(
+            maxsize=cfg.default.event_queue_max_size)
+        # latest status snapshot of the persistence process
+        self.status_queue = self.ctx.Queue(maxsize=1)
+        self.rings = [ShmRing(self.ctx, cfg.process.ring_slots,
+                              cfg.process.slot_size)
+                      for _ in range(cfg.process.workers)]
+        self.next_ring = 0
+        # the rings have one producer, the capture threads take turns
+        self.put_lock = threading.Lock()
+        self.processes = []
+
+    def start(self):
+        for i, ring in enumerate(self.rings):
+            p = self.ctx.Process(target=parse_worker,
+                                 args=(ring, self.event_queue),
+                                 name='Parser-{}'.format(i), daemon=True)
+            self.processes.append(p)
+        self.processes.append(
+            self.ctx.Process(target=persist_worker,
+                             args=(self.event_queue, self.status_queue),
+                             name='EventHandler', daemon=True))
+        for p in self.processes:
+            p.start()
+        settings.subscribe(self.forward_reload)
+
+    def forward_reload(self, new, old):
+        # Children hold their own settings, make them re-read config.ini
+        for p in self.processes:
+            if p.pid is not None and p.is_alive():
+                os.kill(p.pid, signal.SIGHUP)
+
+    def put(self, frm_type, frame, ts):
+        # Round robin over the parser rings, a frame is dropped with
+        # queue.Full only when every ring is full
+        with self.put_lock:
+            for _ in range(len(self.rings)):
+                ring = self.rings[self.next_ring]
+                self.next_ring = (self.next_ring + 1) % len(self.rings)
+                try:
+                    ring.put(self.type_index[frm_type], frame, ts)
+                    return
+                except queue.Full:
+                    continue
+        raise queue.Full
+
+    def qsizes(self):
+        return [ring.qsize() for ring in self.rings]
+
+    def join(self):
+        for p in self.processes:
+            p.join()
+        for ring in self.rings:
+            ring.close(unlink=True)
@@ -0,0 +1,258 @@
+import collections
+import gc
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import settings
+from base import logger
+from metrics import REGISTRY
+
+# In-process resource profiler read from /proc, no ps or psutil. Every
+# period it samples the CPU time of each thread and of the child
+# processes, RSS, queue sizes, GC counts and the system load into a ring of
+# the last samples. On a deployed unit:
+#   kill -USR1 <pid>   stacks of every thread sampled for stack_seconds,
+#                      written with the ring as <dump_dir>/stacks-*.txt
+#   kill -USR2 <pid>   starts tracemalloc, the next USR2 writes a snapshot
+#                      to <dump_dir>/tracemalloc-*.txt and .bin and stops it
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+LOG_EXTRA = {'thread_name': 'Profiler'}
+
+Sample = collections.namedtuple('Sample', (
+    'time',
+    'rss',          # bytes
+    'cpu',          # % of one CPU used by the process since the last sample
+    'threads',      # thread name -> % of one CPU
+    'children',     # child process name -> % of one CPU
+    'queues',       # queue name -> size
+    'gc',           # (gen0, gen1, gen2) allocation counts
+    'collections',  # total collections of the three generations
+    'system',       # (cpu %, memory %, temperature C), None if unknown
+))
+
+
+def read_cpu_seconds(path):
+    # utime + stime of a /proc/.../stat file
+    with open(path) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def read_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def read_system_cpu():
+    # (busy, total) jiffies of all CPUs
+    with open('/proc/stat') as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return sum(values) - idle, sum(values)
+
+
+def read_memory_percent():
+    info = dict()
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0])
+    return 100 * (1 - info['MemAvailable'] / info['MemTotal'])
+
+
+def read_temperature():
+    try:
+        with open(THERMAL_ZONE) as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def percent(delta, seconds):
+    return round(100 * delta / seconds, 1) if seconds > 0 else 0
+
+
+class Profiler(threading.Thread):
+    # queues() returns {name: size} and children() {name: pid}, both are
+    # read once per sample
+    def __init__(self, queues=None, children=None):
+        super().__init__()
+        self.setName('Profiler')
+        self.daemon = True
+        self.queues = queues or dict
+        self.children = children or dict
+        cfg = settings.get().profiler
+        self.samples = collections.deque(maxlen=cfg.samples)
+        # previous cumulative CPU seconds, by thread id and child pid
+        self.thread_cpu = dict()
+        self.child_cpu = dict()
+        self.process_cpu = read_cpu_seconds('/proc/self/stat')
+        self.system_cpu = read_system_cpu()
+        self.last_time = time.time()
+        self.stacks = None  # sampling thread while one runs
+        self.thread_cpu_seconds = dict()    # name -> cumulative, metrics
+        REGISTRY.gauge('dot11hunter_rss_bytes', 'Resident memory',
+                       func=read_rss)
+        REGISTRY.collector('dot11hunter_thread_cpu_seconds', 'counter',
+                           'CPU time by thread',
+                           lambda: [({'thread': n}, round(s, 2)) for n, s in
+                                    self.thread_cpu_seconds.items()])
+        REGISTRY.collector('dot11hunter_gc_collections', 'counter',
+                           'Garbage collections by generation',
+                           lambda: [({'generation': i}, s['collections'])
+                                    for i, s in enumerate(gc.get_stats())])
+        settings.subscribe(self.apply_settings)
+
+    def apply_settings(self, new, old):
+        if new.profiler.samples != self.samples.maxlen:
+            self.samples = collections.deque(self.samples,
+                                             maxlen=new.profiler.samples)
+
+    def install_signals(self):
+        # From the main thread, the handlers only start threads
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                      self.start_stack_sampling())
+        signal.signal(signal.SIGUSR2, lambda signum, frame:
+                      self.toggle_tracemalloc())
+
+    def run(self):
+        while True:
+            time.sleep(settings.get().profiler.period)
+            try:
+                self.samples.append(self.sample())
+            except Exception as e:
+                logger.critical(str(e), extra=LOG_EXTRA)
+
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def sample(self):
+        now = time.time()
+        seconds = now - self.last_time
+        self.last_time = now
+        names = {t.native_id: t.name for t in threading.enumerate()}
+        threads = dict()
+        thread_cpu = dict()
+        for tid in os.listdir('/proc/self/task'):
+            try:
+                cpu = read_cpu_seconds('/proc/self/task/{}/stat'.format(tid))
+            except (OSError, IndexError, ValueError):
+                continue    # thread exited
+            tid = int(tid)
+            name = names.get(tid, str(tid))
+            thread_cpu[tid] = cpu
+            threads[name] = percent(cpu - self.thread_cpu.get(tid, cpu),
+                                    seconds)
+            self.thread_cpu_seconds[name] = cpu
+        self.thread_cpu = thread_cpu
+        children = dict()
+        child_cpu = dict()
+        for name, pid in self.children().items():
+            try:
+                cpu = read_cpu_seconds('/proc/{}/stat'.format(pid))
+            except (OSError, IndexError, ValueError):
+                continue
+            child_cpu[pid] = cpu
+            children[name] = percent(cpu - self.child_cpu.get(pid, cpu),
+                                     seconds)
+        self.child_cpu = child_cpu
+        process_cpu = read_cpu_seconds('/proc/self/stat')
+        cpu = percent(process_cpu - self.process_cpu, seconds)
+        self.process_cpu = process_cpu
+        busy, total = read_system_cpu()
+        system_cpu = percent(busy - self.system_cpu[0],
+                             total - self.system_cpu[1])
+        self.system_cpu = (busy, total)
+        return Sample(
+            time=now, rss=read_rss(), cpu=cpu, threads=threads,
+            children=children, queues=self.queues(), gc=gc.get_count(),
+            collections=tuple(s['collections'] for s in gc.get_stats()),
+            system=(system_cpu, round(read_memory_percent(), 1),
+                    read_temperature()))
+
+    def dump_path(self, kind, suffix):
+        path = settings.get().profiler.dump_dir
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, '{}-{}-{}.{}'.format(
+            kind, os.getpid(), time.strftime('%Y%m%d-%H%M%S'), suffix))
+
+    def start_stack_sampling(self):
+        if self.stacks is not None and self.stacks.is_alive():
+            return
+        self.stacks = threading.Thread(target=self.sample_stacks,
+                                       name='StackSampler', daemon=True)
+        self.stacks.start()
+
+    def sample_stacks(self):
+        # Folded stacks (thread;outer;...;inner count), as flamegraph.pl
+        # takes them, followed by the sample ring
+        cfg = settings.get().profiler
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        counts = collections.Counter()
+        deadline = time.time() + cfg.stack_seconds
+        n = 0
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[';'.join(reversed(stack))] += 1
+            n += 1
+            time.sleep(cfg.stack_interval)
+        path = self.dump_path('stacks', 'txt')
+        with open(path, 'w') as f:
+            f.write('# {} stack samples every {} s\n'.format(
+                n, cfg.stack_interval))
+            for stack, count in counts.most_common():
+                f.write('{} {}\n'.format(stack, count))
+            f.write('\n# resource samples\n')
+            for sample in list(self.samples):
+                f.write('{}\n'.format(dict(sample._asdict())))
+        logger.info('stack samples written to {}'.format(path),
+                    extra=LOG_EXTRA)
+
+    def toggle_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(settings.get().profiler.tracemalloc_frames)
+            logger.info('tracemalloc started, send SIGUSR2 again for a '
+                        'snapshot', extra=LOG_EXTRA)
+            return
+        threading.Thread(target=self.write_tracemalloc, name='Tracemalloc',
+                         daemon=True).start()
+
+    def write_tracemalloc(self):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        path = self.dump_path('tracemalloc', 'txt')
+        snapshot.dump(path[:-len('txt')] + 'bin')
+        with open(path, 'w') as f:
+            for stat in snapshot.statistics('lineno')[:100]:
+                f.write('{}\n'.format(stat))
+        logger.info('tracemalloc snapshot written to {}'.format(path),
+                    extra=LOG_EXTRA)
+
+    def summary(self):
+        # One line for the periodic log
+        sample = self.latest()
+        if sample is None:
+            return 'no profiler sample yet'
+        busiest = sorted(sample.threads.items(), key=lambda kv: -kv[1])[:4]
+        return 'rss {:.1f} MB, cpu {}%, threads {}{}, gc {}'.format(
+            sample.rss / 2 ** 20, sample.cpu,
+            ', '.join('{} {}%'.format(n, c) for n, c in busiest),
+            ''.join(', {} {}%'.format(n, c)
+                    for n, c in sample.children.items()),
+            sample.gc)
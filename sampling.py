@@ -0,0 +1,92 @@
+import threading
+import time
+import settings
+from base import logger
+from metrics import REGISTRY
+
+# Frames of a type are sampled by keeping one of every interval frames.
+# Probe requests are never sampled.
+SAMPLED_TYPES = ('beacon', 'mgmt', 'ctrl', 'data')
+
+
+class SamplingController(threading.Thread):
+    # Feedback loop over the sampling intervals used by Dot11Hunter.dispatch:
+    # a type whose queue (or the event queue) fills past high_water has its
+    # interval doubled, and once the queues drain below low_water it steps
+    # back towards the configured rate. Intervals stay between 1 /
+    # <type>_sample_rate and 1 / min_sample_rate.
+    def __init__(self, frm_queues, event_queue, rings=None):
+        super().__init__()
+        self.setName('SamplingController')
+        self.daemon = True
+        self.log_extra = {'thread_name': self.getName()}
+        self.frm_queues = frm_queues
+        self.event_queue = event_queue
+        self.rings = rings or []   # process mode shared memory rings
+        self.intervals = dict()   # read by dispatch on every frame
+        for t in SAMPLED_TYPES:
+            self.intervals[t] = self.base_interval(t)
+            REGISTRY.gauge('dot11hunter_sample_rate',
+                           'Fraction of frames kept by sampling',
+                           {'type': t},
+                           func=lambda t=t: 1 / self.intervals[t])
+        settings.subscribe(self.apply_settings)
+
+    @staticmethod
+    def base_interval(frm_type):
+        # Interval of the configured, highest, sample rate
+        return 1 / getattr(settings.get().dot11,
+                           '{}_sample_rate'.format(frm_type))
+
+    def apply_settings(self, new, old):
+        # New configured rates apply at once, adaptive sampling goes on
+        # from there
+        for t in SAMPLED_TYPES:
+            name = '{}_sample_rate'.format(t)
+            if getattr(new.dot11, name) != getattr(old.dot11, name):
+                self.intervals[t] = self.base_interval(t)
+
+    @staticmethod
+    def fill(q):
+        if q.maxsize <= 0:
+            return 0
+        return q.qsize() / q.maxsize
+
+    def frame_fills(self):
+        # Fill level of the frames waiting for each type. Rings are shared by
+        # all types in process mode.
+        if self.rings:
+            fill = max(ring.qsize() / ring.slots for ring in self.rings)
+            return dict.fromkeys(SAMPLED_TYPES, fill)
+        return {t: self.fill(self.frm_queues[t]) for t in SAMPLED_TYPES}
+
+    def run(self):
+        while True:
+            time.sleep(settings.get().sampling.period)
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.critical(str(e), extra=self.log_extra)
+
+    def adjust(self):
+        cfg = settings.get().sampling
+        max_interval = 1 / cfg.min_sample_rate
+        frame_fills = self.frame_fills()
+        event_fill = self.fill(self.event_queue)
+        for t in SAMPLED_TYPES:
+            frame_fill = frame_fills[t]
+            interval = self.intervals[t]
+            if frame_fill > cfg.high_water or event_fill > cfg.high_water:
+                new = min(interval * 2, max_interval)
+            elif frame_fill < cfg.low_water and event_fill < cfg.low_water:
+                new = max(interval * cfg.recovery, self.base_interval(t))
+            else:
+                continue
+            if new == interval:
+                continue
+            self.intervals[t] = new
+            logger.info('{} sample rate {:.3f} -> {:.3f}, frame queue {:.0%} '
+                        'full, event queue {:.0%} full'.format(
+                            t, 1 / interval, 1 / new, frame_fill,
+                            event_fill),
+                        extra=self.log_extra)
@@ -0,0 +1,351 @@
+import collections
+import configparser
+import logging
+import os
+import signal
+import threading
+
+# config.ini parsed once into an immutable, validated snapshot with
+# attribute access: settings.get().dot11.coalesce_window. reload() (SIGHUP)
+# swaps in a new snapshot in one assignment and tells the subscribers, which
+# apply what can change at run time. Hot paths keep the values they need
+# instead of looking them up per frame.
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'config.ini')
+BOOLEANS = configparser.ConfigParser.BOOLEAN_STATES
+
+
+def Int(min_value=None, max_value=None):
+    def parse(value):
+        result = int(value)
+        if min_value is not None and result < min_value:
+            raise ValueError('{} is below {}'.format(result, min_value))
+        if max_value is not None and result > max_value:
+            raise ValueError('{} is above {}'.format(result, max_value))
+        return result
+    return parse
+
+
+def Float(min_value=None, max_value=None, positive=False):
+    def parse(value):
+        result = float(value)
+        if positive and result <= 0:
+            raise ValueError('{} is not positive'.format(result))
+        if min_value is not None and result < min_value:
+            raise ValueError('{} is below {}'.format(result, min_value))
+        if max_value is not None and result > max_value:
+            raise ValueError('{} is above {}'.format(result, max_value))
+        return result
+    return parse
+
+
+def Bool(value):
+    if str(value).lower() not in BOOLEANS:
+        raise ValueError('{} is not a boolean'.format(value))
+    return BOOLEANS[str(value).lower()]
+
+
+def Str(value):
+    return str(value)
+
+
+def Choice(*choices):
+    def parse(value):
+        if value not in choices:
+            raise ValueError('{} is not one of {}'.format(
+                value, ', '.join(choices)))
+        return value
+    return parse
+
+
+def List(value):
+    # 'a, b' -> ('a', 'b')
+    return tuple(v.strip() for v in str(value).split(',') if v.strip())
+
+
+def IntList(value):
+    # '1, 6' -> (1, 6)
+    return tuple(int(v) for v in List(value))
+
+
+RATE = Float(positive=True, max_value=1)
+SCHEMA = {
+    'DEFAULT': {
+        'log_path': Str,
+        'log_level': Choice('DEBUG', 'INFO', 'WARNING', 'ERROR',
+                            'CRITICAL'),
+        'channel_interval': Float(positive=True),
+        'frm_queue_max_size': Int(1),
+        'event_queue_max_size': Int(1),
+        'log_interval': Float(positive=True),
+        'mode': Choice('thread', 'process'),
+    },
+    'DOT11': {
+        'frame_types': List,
+        'beacon_sample_rate': RATE,
+        'data_sample_rate': RATE,
+        'ctrl_sample_rate': RATE,
+        'mgmt_sample_rate': RATE,
+        'max_channel': Int(1),
+        'coalesce_window': Float(0),
+        'coalesce_max_pending': Int(1),
+    },
+    'CHANNEL': {
+        'control': Choice('nl80211', 'iwconfig', 'fake'),
+        'scheduler': Choice('adaptive', 'fixed'),
+        'min_dwell': Float(positive=True),
+        'max_dwell': Float(positive=True),
+        'smoothing': Float(positive=True, max_value=1),
+        'frame_weight': Float(0),
+        'novelty_window': Float(positive=True),
+        'anchors': IntList,
+    },
+    'SAMPLING': {
+        'adaptive': Bool,
+        'period': Float(positive=True),
+        'high_water': Float(0, 1),
+        'low_water': Float(0, 1),
+        'recovery': Float(positive=True, max_value=1),
+        'min_sample_rate': RATE,
+    },
+    'STORAGE': {
+        'backend': Choice('mysql', 'sqlite'),
+        'sqlite_path': Str,
+        'sqlite_cache_kb': Int(0),
+        'sqlite_mmap_kb': Int(0),
+    },
+    'MYSQL': {
+        'user': Str,
+        'password': Str,
+        'database': Str,
+        'host': Str,
+        'mac_update_interval': Float(0),
+        'ap_update_interval': Float(0),
+        'geo_update_interval': Float(0),
+        'association_update_interval': Float(0),
+        'batch_size': Int(1),
+        'batch_latency': Float(0),
+        'freshness_cache_max_size': Int(1),
+        'mac_id_cache_kb': Int(1),
+    },
+    'INGEST': {
+        'workers': Int(0),
+        'batch_size': Int(1),
+        'fold_max_pending': Int(1),
+    },
+    'LOCATION': {
+        'timeline_size': Int(1),
+        'max_gap': Float(0),
+        'validity': Float(0),
+        'geo_rows': Choice('raw', 'binned'),
+        'geohash_precision': Int(1, 12),
+        'time_bucket': Float(positive=True),
+        'max_bins': Int(1),
+    },
+    'PROFILER': {
+        'period': Float(positive=True),
+        'samples': Int(1),
+        'dump_dir': Str,
+        'stack_seconds': Float(positive=True),
+        'stack_interval': Float(positive=True),
+        'tracemalloc_frames': Int(1),
+    },
+    'JOURNAL': {
+        'enabled': Bool,
+        'path': Str,
+        'segment_mb': Int(1),
+        'max_mb': Int(1),
+        'fsync_interval': Float(0),
+        'retry_interval': Float(positive=True),
+        'high_water': Float(0, 1),
+        'low_water': Float(0, 1),
+    },
+    'METRICS': {
+        'listen': Str,
+    },
+    'BLUETOOTH': {
+        'uuid': Str,
+        'transport': Choice('rfcomm', 'tcp'),
+        'listen': Str,
+        'send_queue': Int(1),
+        'read_timeout': Float(0),
+        'write_timeout': Float(positive=True),
+    },
+    'CAPTURE': {
+        'backend': Choice('ring', 'scapy'),
+        'ring_block_size': Int(1),
+        'ring_block_nr': Int(1),
+        'ring_frame_size': Int(1),
+        'ring_retire_tov': Int(0),
+    },
+    'PROCESS': {
+        'workers': Int(1),
+        'ring_slots': Int(1),
+        'slot_size': Int(64),
+    },
+}
+# Settings read once at start, a reload only warns about their change
+RESTART_ONLY = {
+    ('default', 'log_path'), ('default', 'mode'),
+    ('dot11', 'frame_types'), ('metrics', 'listen'), ('bluetooth', 'uuid'),
+    ('bluetooth', 'transport'), ('bluetooth', 'listen'),
+    ('storage', 'backend'), ('storage', 'sqlite_path'),
+    ('storage', 'sqlite_cache_kb'), ('storage', 'sqlite_mmap_kb'),
+    ('mysql', 'user'), ('mysql', 'password'), ('mysql', 'database'),
+    ('mysql', 'host'), ('mysql', 'mac_id_cache_kb'),
+    ('mysql', 'freshness_cache_max_size'), ('sampling', 'adaptive'),
+    ('location', 'geo_rows'), ('channel', 'control'),
+    ('channel', 'anchors'),
+    ('journal', 'enabled'), ('journal', 'path'),
+    ('capture', 'backend'), ('capture', 'ring_block_size'),
+    ('capture', 'ring_block_nr'), ('capture', 'ring_frame_size'),
+    ('capture', 'ring_retire_tov'), ('process', 'workers'),
+    ('process', 'ring_slots'), ('process', 'slot_size'),
+}
+
+SECTIONS = {name: collections.namedtuple(name.capitalize(), keys)
+            for name, keys in SCHEMA.items()}
+Settings = collections.namedtuple('Settings',
+                                  [name.lower() for name in SCHEMA])
+
+
+def from_parser(parser):
+    # Validate every key of SCHEMA, all errors are reported at once
+    errors = []
+    sections = []
+    for name, keys in SCHEMA.items():
+        values = dict()
+        for key, parse in keys.items():
+            if name == 'DEFAULT':
+                raw = parser.defaults().get(key)
+            elif parser.has_section(name):
+                raw = parser[name].get(key)
+            else:
+                raw = None
+            if raw is None:
+                errors.append('[{}] {} is missing'.format(name, key))
+                continue
+            try:
+                values[key] = parse(raw.strip())
+            except ValueError as e:
+                errors.append('[{}] {}: {}'.format(name, key, str(e)))
+        if not errors:
+            sections.append(SECTIONS[name](**values))
+    if errors:
+        raise ValueError('invalid config: ' + '; '.join(errors))
+    return Settings(*sections)
+
+
+def load(path=None):
+    parser = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation())
+    path = path or CONFIG_PATH
+    if not parser.read(path):
+        raise ValueError('cannot read {}'.format(path))
+    return from_parser(parser)
+
+
+current = load()
+subscribers = []
+reload_lock = threading.RLock()
+wakeup_fd = None    # write end of the pipe of the reload thread
+
+
+def get():
+    return current
+
+
+def subscribe(callback):
+    # callback(new, old) runs after every reload, in the thread that
+    # reloaded (the Settings thread for SIGHUP), so it must be quick
+    subscribers.append(callback)
+
+
+def changes(old, new):
+    result = []
+    for section in Settings._fields:
+        old_section = getattr(old, section)
+        new_section = getattr(new, section)
+        for key in old_section._fields:
+            if getattr(old_section, key) != getattr(new_section, key):
+                result.append((section, key))
+    return result
+
+
+def swap(new):
+    global current
+    with reload_lock:
+        old = current
+        current = new
+        for callback in list(subscribers):
+            try:
+                callback(new, old)
+            except Exception as e:
+                logging.getLogger('main').critical(
+                    'applying settings: {}'.format(str(e)),
+                    extra={'thread_name': 'Settings'})
+    return old
+
+
+def override(**sections):
+    # New snapshot from the current one with some values replaced, e.g.
+    # override(storage={'backend': 'sqlite'}). Values are validated.
+    new = current
+    for section, values in sections.items():
+        name = section.upper()
+        parsed = {k: SCHEMA[name][k](str(v)) for k, v in values.items()}
+        new = new._replace(**{
+            section: getattr(new, section)._replace(**parsed)})
+    swap(new)
+    return new
+
+
+def reload(path=None):
+    # Re-read config.ini, an invalid file keeps the current settings
+    log = logging.getLogger('main')
+    extra = {'thread_name': 'Settings'}
+    try:
+        new = load(path)
+    except (ValueError, configparser.Error) as e:
+        log.critical('reload failed, keeping current settings: {}'.format(
+            str(e)), extra=extra)
+        return False
+    changed = changes(current, new)
+    swap(new)
+    for section, key in changed:
+        log.info('{}.{} = {}{}'.format(
+            section, key, getattr(getattr(new, section), key),
+            ' (takes effect on restart)'
+            if (section, key) in RESTART_ONLY else ''),
+            extra=extra)
+    log.info('settings reloaded, {} changed'.format(len(changed)),
+             extra=extra)
+    return True
+
+
+def install_sighup():
+    # From the main thread. The handler only wakes the Settings thread,
+    # which reloads: subscribers take locks that the code the signal
+    # interrupted may hold.
+    global wakeup_fd
+    if wakeup_fd is None:
+        read_fd, wakeup_fd = os.pipe()
+        os.set_blocking(wakeup_fd, False)
+        threading.Thread(target=reload_loop, args=(read_fd,),
+                         name='Settings', daemon=True).start()
+    signal.signal(signal.SIGHUP, handle_sighup)
+
+
+def reload_loop(read_fd):
+    while True:
+        # SIGHUPs received meanwhile make one reload
+        os.read(read_fd, 512)
+        reload()
+
+
+def handle_sighup(signum, frame):
+    try:
+        os.write(wakeup_fd, b'\0')
+    except BlockingIOError:
+        pass    # a reload is pending already
@@ -0,0 +1,144 @@
+import queue
+import time
+import settings
+
+# Running totals and the latest rows for the phone status feed, kept by
+# EventHandler as it writes so sending the status costs no queries. The
+# database is read once, when they are seeded.
+
+TABLES = ('mac', 'ap', 'association', 'geo')
+LATEST = ('mac', 'ssid', 'association')
+
+
+class LiveStats:
+    # Changes of a batch are held until its transaction commits. In process
+    # mode the persistence process publishes a snapshot per commit on
+    # channel, a queue of one read by RemoteStats in the main process.
+    def __init__(self, channel=None):
+        self.channel = channel
+        self.counts = dict.fromkeys(TABLES, 0)
+        self.latest = dict.fromkeys(LATEST)     # name -> (value, last_seen)
+        self.seeded = False
+        self.pending_counts = dict.fromkeys(TABLES, 0)
+        self.pending_latest = dict()
+
+    def seed(self, storage):
+        # A query that fails leaves its totals at zero and is raised once
+        # the others ran, the live counters run from there either way
+        if settings.get().location.geo_rows == 'binned':
+            geo_table = 'geo_bin'
+        else:
+            geo_table = 'geo'
+        error = None
+        for name, table in (('mac', 'mac'), ('ap', 'ap'),
+                            ('association', 'association'),
+                            ('geo', geo_table)):
+            try:
+                storage.execute('SELECT COUNT(id) FROM {}'.format(table))
+                self.counts[name] = storage.fetchall()[0][0]
+            except Exception as e:
+                error = error or e
+        for name, sql in (
+                ('mac', 'SELECT addr, last_seen FROM mac '
+                        'WHERE last_seen IS NOT NULL '
+                        'ORDER BY last_seen DESC LIMIT 1'),
+                ('ssid', 'SELECT ssid, last_seen FROM ap '
+                         'WHERE last_seen IS NOT NULL '
+                         'ORDER BY last_seen DESC LIMIT 1'),
+                ('association', 'SELECT mac.addr, ap.ssid, '
+                                'association.last_seen FROM association '
+                                'JOIN mac JOIN ap WHERE '
+                                'mac.id=association.mac_id AND '
+                                'ap.id=association.ap_id AND '
+                                'association.last_seen IS NOT NULL ORDER BY '
+                                'association.last_seen DESC LIMIT 1')):
+            try:
+                storage.execute(sql)
+                rows = storage.fetchall()
+            except Exception as e:
+                error = error or e
+                continue
+            if rows:
+                *value, last_seen = rows[0]
+                value = tuple(value) if len(value) > 1 else value[0]
+                self.latest[name] = (value, last_seen.timestamp())
+        self.seeded = True
+        self.publish()
+        if error is not None:
+            raise error
+
+    def add(self, table, n):
+        self.pending_counts[table] += n
+
+    def seen(self, name, value, last_seen):
+        latest = self.pending_latest.get(name) or self.latest[name]
+        if latest is None or last_seen >= latest[1]:
+            self.pending_latest[name] = (value, last_seen)
+
+    def commit(self):
+        for table, n in self.pending_counts.items():
+            self.counts[table] += n
+            self.pending_counts[table] = 0
+        self.latest.update(self.pending_latest)
+        self.pending_latest.clear()
+        self.publish()
+
+    def rollback(self):
+        self.pending_counts = dict.fromkeys(TABLES, 0)
+        self.pending_latest.clear()
+
+    def snapshot(self):
+        if not self.seeded:
+            return None
+        return {'counts': dict(self.counts), 'latest': dict(self.latest)}
+
+    def publish(self):
+        if self.channel is None:
+            return
+        snapshot = self.snapshot()
+        try:
+            self.channel.put_nowait(snapshot)
+        except queue.Full:
+            # the main process has not taken the previous one yet, replace it
+            try:
+                self.channel.get_nowait()
+                self.channel.put_nowait(snapshot)
+            except (queue.Empty, queue.Full):
+                pass
+
+
+class RemoteStats:
+    # The last snapshot published by the persistence process
+    def __init__(self, channel):
+        self.channel = channel
+        self.last = None
+
+    def snapshot(self):
+        while True:
+            try:
+                self.last = self.channel.get_nowait()
+            except queue.Empty:
+                return self.last
+
+
+def status_payload(snapshot, system, max_age=60):
+    # JSON fields sent to the phone, latest rows older than max_age seconds
+    # are left out
+    data = dict.fromkeys(('mac', 'ssid', 'association', 'mac_count',
+                          'ap_count', 'geo_count', 'association_count'))
+    if snapshot is not None:
+        now = time.time()
+        latest = {name: item[0] for name, item in snapshot['latest'].items()
+                  if item is not None and now - item[1] < max_age}
+        if latest.get('mac') is not None:
+            # same as HEX(addr) in MySQL
+            data['mac'] = '{:X}'.format(latest['mac'])
+        data['ssid'] = latest.get('ssid')
+        if latest.get('association') is not None:
+            data['association'] = '{:X} <-> {}'.format(
+                *latest['association'])
+        for table, n in snapshot['counts'].items():
+            data[table + '_count'] = n
+    data['cpu_usage'], data['mem_usage'], data['temperature'] = \
+        system if system is not None else (None, None, None)
+    return data
@@ -0,0 +1,166 @@
+import os
+import sqlite3
+from datetime import datetime
+import settings
+from base import Dot11HunterUtils
+
+# Storage backends under EventHandler and the phone status feed. SQL is
+# written once with %s placeholders; the dialect specific parts (upserts,
+# schema version) come from the backend.
+
+SQLITE_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'database', 'dot11hunter.sqlite.sql')
+
+
+def create_storage():
+    cfg = settings.get().storage
+    backend = cfg.backend
+    if backend == 'mysql':
+        return MySQLStorage()
+    if backend == 'sqlite':
+        return SQLiteStorage(cfg.sqlite_path)
+    raise ValueError('unknown storage backend: {}'.format(backend))
+
+
+class StorageBase:
+    # True if lastrowid of an upsert is the row id, updated rows included
+    upsert_sets_lastrowid = False
+    # two-argument max and min of the dialect
+    greatest = 'GREATEST'
+    least = 'LEAST'
+
+    def __init__(self):
+        self.conn = None
+        self.cursor = None
+
+    def execute(self, sql, args=()):
+        self.cursor.execute(sql, args)
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(sql, rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    def ping(self):
+        # Raises if the database does not answer
+        self.execute('SELECT 1')
+        self.fetchall()
+
+    def upsert_sql(self, table, columns, keys, updates, returning_id=False):
+        # INSERT of columns which, when the unique keys already exist,
+        # updates the row with updates: column -> expression where {new}
+        # stands for the inserted value, {values[c]} for the inserted value
+        # of column c, {greatest} and {least} for the dialect's functions
+        pass
+
+    def schema_version(self):
+        pass
+
+    @staticmethod
+    def insert_sql(table, columns):
+        return 'INSERT INTO {} ({}) VALUES ({})'.format(
+            table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+
+
+class MySQLStorage(StorageBase):
+    upsert_sets_lastrowid = True
+
+    def __init__(self):
+        super().__init__()
+        self.conn, self.cursor = Dot11HunterUtils.connect_db()
+
+    def ping(self):
+        # Reconnects a dropped connection
+        self.conn.ping(reconnect=True, attempts=1)
+        self.cursor = self.conn.cursor()
+        super().ping()
+
+    def upsert_sql(self, table, columns, keys, updates, returning_id=False):
+        values = {c: 'VALUES({})'.format(c) for c in columns}
+        sets = ['{}={}'.format(c, e.format(new=values[c], values=values,
+                                           greatest=self.greatest,
+                                           least=self.least))
+                for c, e in updates.items()]
+        if returning_id:
+            # makes lastrowid the row id on update too
+            sets.insert(0, 'id=LAST_INSERT_ID(id)')
+        return '{} ON DUPLICATE KEY UPDATE {}'.format(
+            self.insert_sql(table, columns), ', '.join(sets))
+
+    def schema_version(self):
+        from migrate import get_schema_version
+        return get_schema_version(self.cursor)
+
+
+class SQLiteStorage(StorageBase):
+    # Embedded database, WAL journal so the status feed can read while
+    # EventHandler writes
+    greatest = 'MAX'
+    least = 'MIN'
+    def __init__(self, path):
+        super().__init__()
+        self.conn = sqlite3.connect(path, timeout=30,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
+        self.cursor.execute('PRAGMA temp_store=MEMORY')
+        cfg = settings.get().storage
+        self.cursor.execute('PRAGMA cache_size=-{}'.format(
+            cfg.sqlite_cache_kb))
+        self.cursor.execute('PRAGMA mmap_size={}'.format(
+            cfg.sqlite_mmap_kb * 1024))
+        # Creates a new database and adds the tables of later schema
+        # versions to an older one
+        with open(SQLITE_SCHEMA) as f:
+            self.conn.executescript(f.read())
+
+    @staticmethod
+    def translate(sql):
+        return sql.replace('%s', '?')
+
+    def execute(self, sql, args=()):
+        self.cursor.execute(self.translate(sql), tuple(args))
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(self.translate(sql), rows)
+
+    def upsert_sql(self, table, columns, keys, updates, returning_id=False):
+        values = {c: 'excluded.{}'.format(c) for c in columns}
+        sets = ['{}={}'.format(c, e.format(new=values[c], values=values,
+                                           greatest=self.greatest,
+                                           least=self.least))
+                for c, e in updates.items()]
+        return '{} ON CONFLICT ({}) DO UPDATE SET {}'.format(
+            self.insert_sql(table, columns), ', '.join(keys), ', '.join(sets))
+
+    def schema_version(self):
+        self.cursor.execute('SELECT MAX(version) FROM schema_version')
+        return self.cursor.fetchall()[0][0] or 0
+
+
+def adapt_datetime(value):
+    return value.isoformat(' ')
+
+
+def convert_timestamp(value):
+    return datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter('timestamp', convert_timestamp)